@@ -11,9 +11,10 @@ class Lot(object):
     basis for a portfolio.
     """
 
-    def __init__(self, stock, date, acquire_price, nr, cmt=None):
+    def __init__(self, stock, date, acquire_price, nr, cmt=None, source=None):
         """
-        Make a lot with the passed stock and the passed date.
+        Make a lot with the passed stock and the passed date. If known,
+        source is the ledger line number of the buy that made the lot.
         """
 
         self.stock         = stock
@@ -22,6 +23,11 @@ class Lot(object):
         self.acquire_price = acquire_price
         self.comment       = cmt
 
+        # Ledger line numbers of the buys that went into this lot.
+        self.sources       = list()
+        if source is not None:
+            self.sources.append(source)
+
     def cost_basis(self):
         """
         Return the cost basis for this lot. This is simply the acquire price
@@ -46,17 +52,39 @@ class Lot(object):
         self.nr -= nr
         return 0
 
+    def same_basis(self, other):
+        """
+        Returns True if other is the same stock bought on the same day at the
+        same price, so that merging the two changes nothing for tax purposes.
+        """
+
+        return self.stock == other.stock and self.date == other.date and \
+            self.acquire_price == other.acquire_price
+
+    def merge(self, other):
+        """
+        Move the stocks of other, which must have the same basis, into this
+        lot. Other is left empty.
+        """
+
+        self.nr += other.nr
+        self.sources.extend(other.sources)
+        other.nr = 0
+
     def remove_all(self):
         return remove(self, self.nr)
 
     def compute_gain(self, refresh=False):
         """
-        Compute the gain for this lot and return it.
+        Compute the gain for this lot and return it, or None if there's no
+        quote to price it at (see Stock.fetch_missing).
         """
 
         if refresh:
             self.stock.refresh()
 
-        price  = self.stock.price()
+        data = self.stock.get_data()
+        if not data:
+            return None
 
-        return (price - self.acquire_price) * self.nr
+        return (data['latestPrice'] - self.acquire_price) * self.nr
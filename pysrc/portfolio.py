@@ -3,19 +3,44 @@
 # have made/lost, etc.
 #
 
-from datetime  import datetime
+import os
+import threading
+
 from stock     import Stock
 from lot       import Lot
+from st_stats  import st_stats_count, timed
+from st_limit  import PRIORITY_NORMAL, FetchQueue
+from st_ledger import *
+from st_gains  import Relief, GainLedger
 
-from termcolor import colored
 from operator  import methodcaller
 
+def refresh_queue(queue, priority=PRIORITY_NORMAL, landed=None):
+    """
+    Fetch the stocks in queue one at a time, calling landed([ stock ]) after
+    each if passed. A stock that can't be fetched keeps its old quote and
+    is counted in refresh.errors; the rest are still fetched.
+    """
+
+    stocks = queue.take()
+    while stocks:
+        try:
+            stocks[0].refresh(priority)
+        except (IOError, ValueError):
+            st_stats_count('refresh.errors')
+        else:
+            if landed:
+                landed(stocks)
+
+        stocks = queue.take()
+
 class Portfolio(object):
     """
     This wraps a list of lots. Each lot represents some stocks.
     """
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, progress=None, workers=None,
+                 coalesce=False):
         """
         Load an portfolio from a file. The file format is as follows:
 
@@ -32,6 +57,31 @@ class Portfolio(object):
                                present: it is the equity ticker, f.e NVDA, and
                                the price at which the equity was bought/sold.
               [# msg] An optional message describing the transaction.
+
+        If passed, progress is called every so often while the file is being
+        parsed as progress(bytes_parsed, total_bytes).
+
+        Big files are parsed in parallel by worker processes (see
+        st_ledger.load_ledger()); workers defaults to one per CPU. Pass 1 to
+        always parse in this process.
+
+        Lines that can't be parsed are skipped. A LedgerError for each, with
+        its line number, ends up in the errors list.
+
+        Lots that have been completely sold are dropped as the sells happen.
+        If coalesce is set, buys of the same stock on the same day at the
+        same price go into a single lot; that has no tax consequences but
+        does change which lots later sells pick. Either way each lot's
+        sources lists the ledger lines of the buys that went into it.
+
+        Cash is what was deposited less what was withdrawn; buys are not paid
+        out of it. So a sell credits only its realized gain to cash, not the
+        whole proceeds: the cost of the shares sold goes back to wherever the
+        buy was paid from. What each sell took out of which lot is recorded
+        in reliefs, and gains keeps the realized and unrealized totals (see
+        st_gains). Every transaction is kept, along with what it takes to
+        undo it, so that insert_transaction() can add one in the past without
+        replaying the whole ledger.
         """
 
         self.name         = file_path
@@ -39,19 +89,66 @@ class Portfolio(object):
         self.assets       = None     # Will be a list of stocks.
         self.asset_counts = dict()
         self.cash         = 0.0
+        self.listeners    = list()
+        self.errors       = list()
+        self.coalesce     = coalesce
+        self.reliefs      = list()
+        self.gains        = GainLedger()
+
+        # (transaction, line number) for every transaction applied, in the
+        # order they were applied, and how to undo each.
+        self.transactions = list()
+        self.undo         = list()
+
+        # Open lots by (ticker, date, price), for coalescing.
+        self.__open       = dict()
+
+        if workers != 1 and os.path.getsize(file_path) >= PARALLEL_MIN_SIZE:
+            for line_no, tr in load_ledger(file_path, self.errors, workers,
+                                           progress, line_numbers=True):
+                self.apply_transaction(tr, line_no)
+        else:
+            self.__load_serial(file_path, progress)
+
+        self.accumulate_assets()
+
+    def __load_serial(self, file_path, progress):
+        """
+        Parse the ledger a line at a time in this process.
+        """
 
         f = open(file_path)
+        total = os.fstat(f.fileno()).st_size
+        done = 0
+        nr = 0
 
         for line in f:
-            self.parse_line(line)
+            nr += 1
 
-        self.accumulate_assets()
+            try:
+                self.parse_line(line, nr)
+            except LedgerError, e:
+                e.line_no = nr
+                self.errors.append(e)
+
+            if progress:
+                done += len(line)
+                if nr % 1000 == 0:
+                    progress(done, total)
+
+        f.close()
+
+        if progress:
+            progress(total, total)
 
     def __unicode__(self):
         """
         Return a string representation of this portfolio.
         """
 
+        # Only reports need colors; don't make the UI pay for the import.
+        from termcolor import colored
+
         fmt = '%-7s %12.2f   %s %-7s   %-8d | $%12.2f  %12.2f\n'
         up  = '%-7s %-12s  %-10s  %-8s | %-12s  %12s\n' % ('Asset',
                                                            'Current price',
@@ -104,17 +201,24 @@ class Portfolio(object):
         up += 'Cash:           $%12.2f\n' % self.cash
         up += 'Portfolio value $%12.2f\n' % (total + self.cash)
         up += 'Cost basis:     $%12.2f\n' % self.cost_basis()
+        up += 'Realized gain   $%12.2f\n' % self.realized()
         up += 'Total gain      $%12.2f'   % ((total + self.cash) - self.cost_basis())
 
         return up
 
-    def refresh(self):
+    @timed('portfolio.refresh')
+    def refresh(self, priority=PRIORITY_NORMAL, queue=None, landed=None):
         """
-        Refresh this portfolio.
+        Refresh this portfolio, one stock at a time in the order queue (a
+        st_limit.FetchQueue of our stocks) hands them out; by default in the
+        order of the asset list. landed(stocks), if passed, is called with
+        each stock as soon as its quote is in.
         """
 
-        for s in self.assets:
-            s.refresh()
+        if queue is None:
+            queue = FetchQueue(self.assets)
+
+        refresh_queue(queue, priority, landed)
 
     def accumulate_assets(self):
         """
@@ -130,11 +234,27 @@ class Portfolio(object):
 
             self.asset_counts[l.stock.ticker] += l.nr
 
-        # Only bother doing this once.
-        if not self.assets:
-            self.assets = list()
-            for a in self.asset_counts.keys():
-                self.assets.append(Stock(a))
+        # Only bother rebuilding the list when tickers come or go.
+        stocks = dict([ (s.ticker, s) for s in self.assets or list() ])
+        if self.assets is None or \
+           sorted(stocks.keys()) != sorted(self.asset_counts.keys()):
+            self.assets = [ stocks.get(a) or Stock(a)
+                            for a in self.asset_counts.keys() ]
+
+        for func in list(self.listeners):
+            func(self)
+
+    def add_listener(self, func):
+        """
+        Have func(portfolio) called whenever this portfolio's holdings are
+        recounted.
+        """
+
+        self.listeners.append(func)
+
+    def remove_listener(self, func):
+        if func in self.listeners:
+            self.listeners.remove(func)
 
     def cost_basis(self):
         """
@@ -149,64 +269,160 @@ class Portfolio(object):
 
         return cb
 
-    def parse_line(self, line):
+    def realized(self):
         """
-        Parse a line. Take care of comments and blank lines here.
+        Total realized gain over every sell so far.
         """
 
-        line = line.strip();
+        return self.gains.realized()
 
-        if line == '' or line[0] == '#':
-            return
+    def unrealized(self, by_year=False):
+        """
+        Unrealized gains at the cached quotes, by ticker or by the year the
+        shares were bought; see GainLedger.unrealized(). Never fetches.
+        """
 
-        # Ok, do the real parsing now: the first bit of the string is the
-        # date. Split on the '|' to get the date bit.
-        (date_str, tr_data) = line.split('|')
-        date = datetime.strptime(date_str.strip(), '%b %d, %Y')
+        prices = dict()
+        for s in self.assets:
+            data = s.cached_data()
+            if data and data.get('latestPrice') is not None:
+                prices[s.ticker] = float(data['latestPrice'])
 
-        # Now split off a comment, in case one is there
-        if '#' in tr_data:
-            tr_data, comment = tr_data.split('#')
-        else:
-            comment = ''
+        return self.gains.unrealized(prices, by_year)
 
-        # And now split the tr_data into items and parse them.
-        tr_items = tr_data.split()
+    @timed('ledger.parse_line')
+    def parse_line(self, line, line_no=None):
+        """
+        Parse a line and apply the transaction on it. Comments and blank lines
+        are ignored; a LedgerError is raised if the line doesn't make sense.
+        """
 
-        l = None
+        tr = parse_ledger_line(line)
 
-        # This is a deposit/withdrawl.
-        if len(tr_items) == 2:
-            if tr_items[0] == 'DEPOSIT':
-                self.cash += float(tr_items[1])
-            elif tr_items[0] == 'WITHDRAWL':
-                self.cash -= float(tr_items[1])
-            else:
-                print 'Unrecognized transaction type: %s' % tr_items[0]
-
-        # Looks like we might have a stock trade.
-        elif len(tr_items) == 4:
-            if tr_items[0] == 'BUY':
-
-                # If we have a buy then we just need to add a new lot to our
-                # list of lots. Sells will go and modify the lots.
-                l = Lot(Stock(tr_items[2]),
-                        date,
-                        float(tr_items[3]),
-                        float(tr_items[1]),
-                        cmt=comment)
-            elif tr_items[0] == 'SELL':
-                self.__handle_sell(tr_items)
-            else:
-                print 'Unrecognized transaction type: %s' % tr_items[0]
-        else:
-            print 'Bad data line: "%s"' % line
+        if tr:
+            self.apply_transaction(tr, line_no)
+
+    def apply_transaction(self, tr, line_no=None):
+        """
+        Apply a parsed transaction (see st_ledger.parse_ledger_line()) to this
+        portfolio. line_no is the ledger line it came from, if known.
+        """
+
+        self.transactions.append((tr, line_no))
+        self.undo.append(self.__apply(tr, line_no))
+
+    def __apply(self, tr, line_no):
+        """
+        Do the work of apply_transaction(). Returns what __undo() needs to
+        take the transaction back: (transaction type, ...).
+        """
+
+        tr_type, date, nr, ticker, price, comment = tr
+
+        if tr_type == DEPOSIT:
+            self.cash += nr
+            return (tr_type, nr)
+        elif tr_type == WITHDRAWL:
+            self.cash -= nr
+            return (tr_type, -nr)
+        elif tr_type == BUY:
+            # If we have a buy then we just need to add a new lot to our list
+            # of lots. Sells will go and modify the lots.
+            lot = Lot(Stock(ticker), date, price, nr, cmt=comment,
+                      source=line_no)
+            self.gains.bought(ticker, date, nr, nr * price)
+
+            # Merging empties lot, so the undo entry keeps what was bought.
+            if self.coalesce:
+                key = (ticker, date, price)
+                same = self.__open.get(key)
+                if same is not None:
+                    same.merge(lot)
+                    st_stats_count('lots.coalesced')
+                    return (tr_type, lot, same, nr)
+                self.__open[key] = lot
+
+            self.lots.append(lot)
+            return (tr_type, lot, None, nr)
+        elif tr_type == SELL:
+            relieved, dropped = self.__handle_sell(ticker, nr, date, price)
+            gain = sum([ r.gain for _, r in relieved ])
+            self.cash += gain
+            return (tr_type, relieved, dropped, gain)
+
+    def __undo(self, undo):
+        """
+        Take back a transaction, given what __apply() returned for it. Only
+        the last transaction applied can be taken back.
+        """
+
+        tr_type = undo[0]
+
+        if tr_type in (DEPOSIT, WITHDRAWL):
+            self.cash -= undo[1]
+        elif tr_type == BUY:
+            _, lot, same, nr = undo
+            self.gains.bought(lot.stock.ticker, lot.date, -nr,
+                              -nr * lot.acquire_price)
+
+            if same:
+                same.nr -= nr
+                del same.sources[len(same.sources) - len(lot.sources):]
+                return
+
+            self.lots.pop()
+            if self.coalesce:
+                del self.__open[(lot.stock.ticker, lot.date,
+                                 lot.acquire_price)]
+        elif tr_type == SELL:
+            _, relieved, dropped, gain = undo
+            self.cash -= gain
+
+            for i, l in dropped:
+                self.lots.insert(i, l)
+                if self.coalesce:
+                    self.__open[(l.stock.ticker, l.date, l.acquire_price)] = l
+
+            for l, r in reversed(relieved):
+                l.nr += r.nr
+                self.gains.relieved(r, -1)
+                self.reliefs.pop()
+
+    @timed('portfolio.insert')
+    def insert_transaction(self, tr, line_no=None):
+        """
+        Add a transaction dated in the past. Everything applied after it
+        (everything dated later) is taken back, then it and they are applied
+        again in order, so the work done depends on how many transactions
+        follow it rather than on the size of the ledger. Nothing is written
+        to the ledger file. Returns how many transactions were replayed.
+        """
+
+        date = tr[1]
+
+        i = len(self.transactions)
+        while i > 0 and self.transactions[i - 1][0][1] > date:
+            i -= 1
+
+        later = self.transactions[i:]
+        for undo in reversed(self.undo[i:]):
+            self.__undo(undo)
+
+        del self.transactions[i:]
+        del self.undo[i:]
+
+        self.apply_transaction(tr, line_no)
+        for t, n in later:
+            self.apply_transaction(t, n)
+
+        st_stats_count('portfolio.replayed', len(later))
+
+        self.accumulate_assets()
 
-        # If we have a lot then add it to our list!
-        if l:
-            self.lots.append(l)
+        return len(later)
 
-    def __handle_sell(self, tr_items):
+    @timed('ledger.handle_sell')
+    def __handle_sell(self, ticker, nr, date, price):
         """
         Handle a sell. This requires thinking about which stocks to actually
         sell. For our purposes we will use a tax avoidance method. The idea is
@@ -215,10 +431,16 @@ class Portfolio(object):
 
         This isn't the only method for choosing which stocks to sell, but it
         should give a reasonable guess of what the average investor might do.
+
+        Without a quote to work out gains at (the quote daemon hasn't sent
+        one yet, say, or no provider is answering) the highest cost lots are
+        sold first: whatever the price, that's the smallest gain per share.
+
+        Each lot sold from gets a Relief recorded. Returns a list of (lot,
+        relief) pairs and the lots dropped (see __drop_exhausted()).
         """
 
-        s = Stock(tr_items[2])
-        nr = float(tr_items[1])
+        s = Stock(ticker)
         matching_lots = list()
 
         # Find lots that have the stock we are selling.
@@ -226,11 +448,167 @@ class Portfolio(object):
             if l.stock == s:
                 matching_lots.append(l)
 
+        try:
+            priced = s.get_data() is not None
+        except (IOError, ValueError):
+            priced = False
+
         # Now sort the lots by gain low to high.
-        matching_lots.sort(key=methodcaller('compute_gain'))
+        if priced:
+            matching_lots.sort(key=methodcaller('compute_gain'))
+        else:
+            st_stats_count('ledger.unpriced_sells')
+            matching_lots.sort(key=lambda l: -l.acquire_price)
+
+        exhausted = False
+        relieved = list()
 
         for l in matching_lots:
+            before = l.nr
             nr = l.remove(nr)
+            exhausted = exhausted or l.nr == 0
+
+            sold = before - l.nr
+            r = Relief(ticker, l.date, date, sold, sold * l.acquire_price,
+                       sold * price, l.sources)
+            relieved.append((l, r))
+            self.reliefs.append(r)
+            self.gains.relieved(r)
 
             if nr == 0:
                 break
+
+        dropped = list()
+        if exhausted:
+            dropped = self.__drop_exhausted()
+
+        return relieved, dropped
+
+    def __drop_exhausted(self):
+        """
+        Forget lots that have been completely sold, so that they don't have
+        to be looked at again. Returns (index, lot) for each lot dropped.
+        """
+
+        live = list()
+        dropped = list()
+
+        for i, l in enumerate(self.lots):
+            if l.nr > 0:
+                live.append(l)
+                continue
+
+            dropped.append((i, l))
+            if self.coalesce:
+                key = (l.stock.ticker, l.date, l.acquire_price)
+                if self.__open.get(key) is l:
+                    del self.__open[key]
+
+        st_stats_count('lots.dropped', len(dropped))
+
+        self.lots = live
+
+        return dropped
+
+class Consolidated(object):
+    """
+    A merged view of several portfolios: holdings, cost basis and cash are
+    summed over all of them. This looks enough like a Portfolio to be
+    displayed like one.
+
+    The totals are maintained incrementally. Each member portfolio tells us
+    when its holdings change and we swap its old contribution for its new
+    one, so nothing gets re-summed when the view is drawn.
+    """
+
+    def __init__(self, portfolios, name=None):
+        """
+        Merge the passed portfolios. If no name is passed one is made up from
+        the member names.
+        """
+
+        self.portfolios   = list(portfolios)
+        self.name         = name
+        self.assets       = list()
+        self.asset_counts = dict()
+        self.cash         = 0.0
+
+        if not self.name:
+            self.name = ' + '.join([ p.name for p in self.portfolios ])
+
+        self.__cost_basis = 0.0
+        self.__stocks     = dict()   # Ticker -> Stock
+        self.__holders    = dict()   # Ticker -> nr of members listing it.
+        self.__contrib    = dict()   # Member -> (counts, cost basis, cash)
+        self.__lock       = threading.Lock()
+
+        for p in self.portfolios:
+            self.__update(p)
+            p.add_listener(self.__update)
+
+    def close(self):
+        """
+        Stop tracking the member portfolios.
+        """
+
+        for p in self.portfolios:
+            p.remove_listener(self.__update)
+
+    def __update(self, p):
+        """
+        Replace p's contribution to the merged totals.
+        """
+
+        counts = dict(p.asset_counts)
+        cb     = p.cost_basis()
+
+        self.__lock.acquire()
+
+        old_counts, old_cb, old_cash = self.__contrib.get(p, (dict(), 0.0,
+                                                               0.0))
+
+        for t in old_counts.keys():
+            self.asset_counts[t] -= old_counts[t]
+            self.__holders[t] -= 1
+
+        for t in counts.keys():
+            self.asset_counts[t] = self.asset_counts.get(t, 0) + counts[t]
+            self.__holders[t] = self.__holders.get(t, 0) + 1
+
+        self.__cost_basis += cb - old_cb
+        self.cash         += p.cash - old_cash
+        self.__contrib[p]  = (counts, cb, p.cash)
+
+        # Only the tickers that came or went need the asset list rebuilt.
+        gone = [ t for t in old_counts.keys() if not self.__holders[t] ]
+        new  = [ t for t in counts.keys() if t not in self.__stocks ]
+
+        for t in gone:
+            del self.asset_counts[t]
+            del self.__holders[t]
+            del self.__stocks[t]
+
+        for t in new:
+            self.__stocks[t] = Stock(t)
+
+        if gone or new:
+            self.assets = self.__stocks.values()
+
+        self.__lock.release()
+
+    @timed('portfolio.refresh')
+    def refresh(self, priority=PRIORITY_NORMAL, queue=None, landed=None):
+        """
+        Refresh every stock held by any member; see Portfolio.refresh().
+        """
+
+        if queue is None:
+            queue = FetchQueue(self.assets)
+
+        refresh_queue(queue, priority, landed)
+
+    def cost_basis(self):
+        return self.__cost_basis
+
+    def realized(self):
+        return sum([ p.realized() for p in self.portfolios ])
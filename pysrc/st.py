@@ -2,24 +2,93 @@
 
 # Main st app! Yay.
 
+import time
+
+# For the start up benchmark: when we started, when the UI first appeared,
+# and when the first portfolio was drawn.
+st_start_time = time.time()
+st_first_frame_time = None
+st_first_portfolio_time = None
+st_bench_startup = False
+
 import curses
 import curses.textpad
-import time
 import threading
-import time
 import locale
+import os
 import sys
+import heapq
 from datetime import datetime
 
+# Keep imports here to what's needed to get the UI up. Anything slow to
+# import (requests, termcolor, cProfile, the streaming client) is pulled in
+# where it is first used.
 import stock
-from portfolio import Portfolio
+from portfolio import Portfolio, Consolidated
+from st_watch  import Watchlist, mover_key_change_percent, mover_key_volume
+from st_stats  import timed, st_stats_dump, st_stats_lines
+from st_stats  import st_stats_count, st_stats_counter
+from st_changes import ChangeFeed
+from st_spark   import SparkLines, SPARK_WIDTH
+from st_symbols import SymbolDirectory, SymbolFilter
+from st_limit  import PRIORITY_HIGH, FetchQueue
+from st_limit  import TIER_VISIBLE, TIER_NEARBY
+from st_query  import st_query_set_providers, st_query_providers_up
 
 # Set to true to kill the background refresh thread.
 st_refresh_thread_die = False
 st_refresh_thread_interval = 15.0 # In seconds
 
+# Optional push feed (a stream, or the local quote daemon). When set, quotes
+# arrive through it and the refresh thread just redraws as they land.
+st_quote_stream = None
+
+# Stats: whether to draw the overlay, and where (if anywhere) the refresh
+# thread should periodically write them.
+st_stats_overlay = False
+st_stats_file = None
+st_stats_interval = 5.0 # In seconds
+
+# Optional watchlist file, loaded in the background at start up.
+st_watch_file = None
+
+# Quote changes, published once per refresh cycle. The screen, alerts and
+# the optional history file only look at what moved.
+st_change_feed = ChangeFeed()
+
+# Intraday price history of the stocks we've shown, for the trend column.
+st_sparklines = SparkLines()
+st_spark_col = 80
+
+# The provider's symbol directory, for searching. Loaded in the background
+# from a local cache that is refreshed at most daily.
+st_symbols_file = os.path.expanduser('~/.st-symbols.json')
+st_symbol_dir = None
+
+# Quote history file (--history=), which doubles as the daily history the
+# risk simulation samples from. The simulation is seeded so the same history
+# always gives the same numbers.
+st_history_file = None
+st_risk_days = 10
+st_risk_paths = 10000
+st_risk_seed = 0
+
+# Merge same day, same price buys into one lot when loading portfolios.
+st_coalesce_lots = False
+
+# Optional price alerts, checked every time quotes change.
+st_alert_engine = None
+
+# Set to true to have the refresh thread profile itself. Once cleared the
+# profile is written to st_profile_file.
+st_profile_wanted = False
+st_profile_file = 'st-refresh.prof'
+
 locale.setlocale(locale.LC_ALL, '')
 
+# Only flag quotes as stale once they've missed a refresh or so.
+stock.Stock.max_age = 2 * st_refresh_thread_interval
+
 st_sort_key = stock.stock_key_name
 st_reverse_sort = True # "reverse" sort is better IMO
 
@@ -33,26 +102,92 @@ def st_refresh_thread(args):
 
     global st_refresh_thread_die
     global st_refresh_thread_interval
+    global st_quote_stream
+    global st_stats_file
+    global st_profile_wanted
 
     tracker = args
 
     accumulated_time = 0
+    stats_time = 0
+    profiler = None
 
     while not st_refresh_thread_die:
 
+        # cProfile only sees the thread that enables it, so the refresh
+        # thread has to start and stop its own profiler.
+        if st_profile_wanted and not profiler:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif not st_profile_wanted and profiler:
+            profiler.disable()
+            profiler.dump_stats(st_profile_file)
+            profiler = None
+            tracker.set_action('Wrote refresh profile to %s' % st_profile_file)
+
+        if st_stats_file and stats_time >= st_stats_interval:
+            st_stats_dump(st_stats_file)
+            stats_time = 0
+
         # Sleep in tenth second increments to keep this thread decently
         # responsive. Add up the time between increments; when we get to
         # the refresh interval, reset the accumulated time and refresh the
-        # portfolio.
-        if accumulated_time < st_refresh_thread_interval:
+        # portfolio. We also wake up to redraw whenever new quotes land in
+        # the cache (from a stream or a background revalidation) but don't
+        # fetch anything in that case.
+        fetch = False
+        if stock.Stock.updated.is_set():
+            pass
+        elif accumulated_time < st_refresh_thread_interval:
             time.sleep(.1)
             accumulated_time += .1
+            stats_time += .1
             continue
         else:
             accumulated_time = 0
+            fetch = True
 
         p = tracker.active_portfolio
-        p.refresh()
+
+        # The stream (or its fallback poller) keeps the cache up to date.
+        # Otherwise fetch what's on screen first and draw it as it lands.
+        if fetch and not st_quote_stream:
+            tracker.lock.acquire()
+            tiers = None
+            if p is tracker.drawn_for:
+                tiers = tracker.tiers
+            tracker.fetch_queue = FetchQueue(p.assets, tiers)
+            tracker.lock.release()
+
+            def landed(stocks):
+                tracker.lock.acquire()
+                tracker.repaint_landed(p, stocks)
+                tracker.lock.release()
+
+            fetched = st_stats_counter('query.bytes')
+            try:
+                p.refresh(queue=tracker.fetch_queue, landed=landed)
+            except (IOError, ValueError):
+                # No provider would answer. Keep the quotes we have and
+                # redraw anyway: the header shows the providers are down.
+                st_stats_count('refresh.errors')
+            finally:
+                tracker.fetch_queue = None
+            st_stats_count('refresh.count')
+            st_stats_count('refresh.bytes',
+                           st_stats_counter('query.bytes') - fetched)
+
+        # One trend sample per refresh interval. Watchlists are too big to
+        # keep history for and don't show it anyway.
+        if fetch and not isinstance(p, Watchlist):
+            st_sparklines.sample(p.assets)
+
+        stock.Stock.updated.clear()
+
+        # Alerts and the history file are subscribers, so they see the
+        # change set here.
+        changes = st_change_feed.publish()
 
         tracker.lock.acquire()
 
@@ -64,7 +199,13 @@ def st_refresh_thread(args):
             tracker.lock.release()
             continue
 
-        tracker.display_portfolio(p)
+        # A timed refresh redraws everything (the clock, stale markers). When
+        # we woke up because quotes landed only the rows that moved are
+        # redrawn.
+        if fetch:
+            tracker.display_portfolio(p)
+        else:
+            tracker.repaint_changes(p, changes)
 
         tracker.lock.release()
 
@@ -91,6 +232,29 @@ class ST(object):
         self.refresh_thread = None
         self.terminate = False
 
+        # What's being loaded in the background, if anything, for the header.
+        self.loading = None
+
+        # The watchlist, if one was loaded, and the portfolio to go back to
+        # when we stop looking at it.
+        self.watchlist = None
+        self.unwatched = None
+
+        # What's on screen: the portfolio last drawn and, for each ticker
+        # shown, the line it is on and its stock.
+        self.drawn_for = None
+        self.drawn = dict()
+
+        # How soon each ticker's quote is wanted given what's on screen (see
+        # st_limit.FetchQueue), and the queue of the refresh under way.
+        self.tiers = dict()
+        self.fetch_queue = None
+
+        # The row filter, if one is on, and the portfolio it filters.
+        self.filter = None
+        self.filter_for = None
+        self.symbols_loading = False
+
         # Simple layout: 3 boxes, stacked on top of each other. The top will
         # show some general stuff, the middle will show what ever info is
         # requested by the user, and the bottom will show a simple terminal
@@ -106,12 +270,17 @@ class ST(object):
         # Locks for the windows.
         self.lock = threading.Lock()
 
+        global st_first_frame_time
+
         self.clear_header()
         self.clear_main()
         self.clear_action()
 
         self.refresh()
 
+        if not st_first_frame_time:
+            st_first_frame_time = time.time()
+
         # For displaying stocks going up/down.
         curses.init_pair(1, curses.COLOR_GREEN, curses.COLOR_BLACK)
         curses.init_pair(2, curses.COLOR_RED, curses.COLOR_BLACK)
@@ -142,6 +311,20 @@ class ST(object):
         self.windows['ACTION'].erase()
         self.windows['ACTION'].addstr(0, 0, 'For help press \'h\'')
 
+    def set_action(self, msg):
+        """
+        Show a short message in the action box. Takes the window lock.
+        """
+
+        self.lock.acquire()
+
+        if not self.terminate:
+            self.windows['ACTION'].erase()
+            self.windows['ACTION'].addnstr(0, 0, msg, curses.COLS - 1)
+            self.windows['ACTION'].refresh()
+
+        self.lock.release()
+
     def clear_header(self):
         """
         Return the header to the default header text.
@@ -153,6 +336,61 @@ class ST(object):
         self.windows['HEADER'].erase()
         # if not self.active_portfolio:
         self.windows['HEADER'].addstr(0, 0, 'Portfolio: None')
+        self.__draw_loading()
+
+    def __draw_loading(self):
+        """
+        Show what's being loaded (if anything) on the right of the header.
+        """
+
+        if not self.loading:
+            return
+
+        col = 40
+        if col < curses.COLS - 1:
+            self.windows['HEADER'].addnstr(0, col, self.loading,
+                                           curses.COLS - col - 1,
+                                           curses.A_BOLD)
+
+    def set_loading(self, msg):
+        """
+        Set (or with None, clear) the loading message in the header. Only
+        redraws if the message actually changed. Takes the window lock.
+        """
+
+        if msg == self.loading:
+            return
+
+        self.lock.acquire()
+
+        self.loading = msg
+
+        if not self.terminate:
+            if self.active_portfolio:
+                self.set_header(self.active_portfolio)
+            else:
+                self.clear_header()
+            self.windows['HEADER'].refresh()
+
+        self.lock.release()
+
+    def __draw_providers(self):
+        """
+        If any quote provider is down, say so on the right of the header.
+        With none up the quotes on screen are only getting older.
+        """
+
+        up, total = st_query_providers_up()
+        if up == total:
+            return
+
+        col = 50
+        if col < curses.COLS - 1:
+            self.windows['HEADER'].addnstr(1, col,
+                                           'Providers up: %d/%d' % (up, total),
+                                           curses.COLS - col - 1,
+                                           curses.A_BOLD |
+                                           curses.color_pair(2))
 
     def set_header(self, portfolio):
         """
@@ -161,6 +399,10 @@ class ST(object):
         if self.terminate:
             return
 
+        if isinstance(portfolio, Watchlist):
+            self.__set_watchlist_header(portfolio)
+            return
+
         portfolio_fields = '%-15s %-5s %9s %14s | %-6s %11s %10s' % (
             'Company Name',
             'Symb',
@@ -180,61 +422,150 @@ class ST(object):
         w.addstr(1, 0, 'Time:')
         w.addstr(1, 6, datetime.now().strftime('%A, %d. %B %Y %I:%M%p'))
         w.addstr(2, 0, portfolio_fields, curses.A_BOLD)
+        if curses.COLS > st_spark_col + SPARK_WIDTH:
+            w.addstr(2, st_spark_col, 'Trend', curses.A_BOLD)
+        self.__draw_loading()
+        self.__draw_providers()
 
-    def __display_portfolio(self, p, w):
+    def __set_watchlist_header(self, wl):
         """
-        Actually do the portfolio write.
+        Header for the watchlist view.
         """
 
-        global st_sort_key
-        global st_reverse_sort
+        w = self.windows['HEADER']
+        w.erase()
 
-        line = 1
-        total_assets = 0
-        total_change = 0
+        w.addstr(0, 0, 'Watchlist: %s' % wl.name)
+        w.addstr(1, 0, 'Time:')
+        w.addstr(1, 6, datetime.now().strftime('%A, %d. %B %Y %I:%M%p'))
+        w.addstr(2, 0, '%d of %d symbols quoted' % (wl.nr_quoted(),
+                                                    len(wl.assets)),
+                 curses.A_BOLD)
+        self.__draw_loading()
+        self.__draw_providers()
 
-        p.assets.sort(key=st_sort_key, reverse=st_reverse_sort)
+    def __display_movers(self, w, line, col, title, stocks):
+        """
+        Draw one top movers column.
+        """
 
-        for s in p.assets:
-            # Make sure we have space to write the portfolio totals.
-            if line >= (curses.LINES - 3):
-                break
+        w.addstr(line, col, title, curses.A_BOLD)
 
-            total_assets += (p.asset_counts[s.symb()] * s.price())
-            total_change += (p.asset_counts[s.symb()] * s.change())
-
-            # Color red/green for stocks going up/down.
-            change_color = curses.color_pair(0)
-            if s.change() > 0:
-                change_color = curses.color_pair(1)
-            elif s.change() < 0:
-                change_color = curses.color_pair(2)
-
-            direction = ''
-            if s.change() > 0:
-                direction = u'\u25b2'
-            elif s.change() < 0:
-                direction = u'\u25bc'
-
-            w.addstr(line, 0,  '%-15s' % s.name()[0:14])
-            w.addstr(line, 16, '%-5s' % s.symb(), curses.A_BOLD)
-            w.addstr(line, 22, '%9.2f' % s.price())
-            w.addstr(line, 32, direction.encode('utf-8'), change_color)
-            w.addstr(line, 33, '%6.2f %5.2f%%' % (abs(s.change()),
-                                                  abs(s.change_percent()) *
-                                                  100),
-                     change_color)
+        for s in stocks:
+            line += 1
+            self.tiers[s.ticker] = TIER_VISIBLE
+
+            data = s.cached_data()
+            change = float(data.get('changePercent') or 0.0)
+
+            color = curses.color_pair(0)
+            if change > 0:
+                color = curses.color_pair(1)
+            elif change < 0:
+                color = curses.color_pair(2)
+
+            volume = data.get('latestVolume') or data.get('avgTotalVolume') or 0
+
+            w.addstr(line, col,      '%-6s' % s.ticker, curses.A_BOLD)
+            w.addstr(line, col + 7,  '%9.2f' % float(data.get('latestPrice')
+                                                     or 0.0))
+            w.addstr(line, col + 17, '%7.2f%%' % (change * 100), color)
+            w.addstr(line, col + 26, '%11d' % int(volume))
+
+    def __display_watchlist(self, wl, w):
+        """
+        Show the watchlist's top movers by percent change and by volume side
+        by side. Only the top few are picked out each frame; the list is
+        never sorted as a whole.
+        """
+
+        rows, cols = w.getmaxyx()
+        k = max(0, rows - 3)
+        stocks = self.__filtered(wl)
+
+        self.__display_movers(w, 1, 0, 'Top movers (% change)',
+                              wl.top_movers(k, mover_key_change_percent,
+                                            stocks))
+
+        if cols >= 80:
+            self.__display_movers(w, 1, 40, 'Most active (volume)',
+                                  wl.top_movers(k, mover_key_volume, stocks))
+
+    def __filtered(self, p):
+        """
+        The stocks of p to show: all of them, or just those matching the row
+        filter if there is one.
+        """
+
+        if self.filter and self.filter_for is p:
+            return self.filter.result()
+
+        return p.assets
+
+    def __display_row(self, p, w, line, s):
+        """
+        Draw the row for stock s on line. Returns (value, change) of the
+        holding, or None if there's no quote for it yet.
+        """
+
+        w.move(line, 0)
+        w.clrtoeol()
+
+        # Never wait on the network here. If there's never been a quote for
+        # this stock just hold its place until one turns up.
+        if not s.has_quote():
+            w.addstr(line, 0,  '%-15s' % '...')
+            w.addstr(line, 16, '%-5s' % s.ticker, curses.A_BOLD)
+            w.addstr(line, 22, '%9s' % '--')
             w.addstr(line, 47, '|')
-            w.addstr(line, 49, '%-6d' % p.asset_counts[s.symb()])
-            w.addstr(line, 56, '%11.2f' % (p.asset_counts[s.symb()] *
-                                           s.price()))
-            w.addstr(line, 68, '%10.2f' % (p.asset_counts[s.symb()] *
-                                           s.change()),
+            w.addstr(line, 49, '%-6d' % p.asset_counts[s.ticker])
+            return None
+
+        # Color red/green for stocks going up/down.
+        change_color = curses.color_pair(0)
+        if s.change() > 0:
+            change_color = curses.color_pair(1)
+        elif s.change() < 0:
+            change_color = curses.color_pair(2)
+
+        direction = ''
+        if s.change() > 0:
+            direction = u'\u25b2'
+        elif s.change() < 0:
+            direction = u'\u25bc'
+
+        w.addstr(line, 0,  '%-15s' % s.name()[0:14])
+        w.addstr(line, 16, '%-5s' % s.symb(), curses.A_BOLD)
+        w.addstr(line, 22, '%9.2f' % s.price())
+        if s.stale():
+            w.addstr(line, 31, '*', curses.A_DIM)
+        w.addstr(line, 32, direction.encode('utf-8'), change_color)
+        w.addstr(line, 33, '%6.2f %5.2f%%' % (abs(s.change()),
+                                              abs(s.change_percent()) * 100),
+                 change_color)
+        w.addstr(line, 47, '|')
+        w.addstr(line, 49, '%-6d' % p.asset_counts[s.symb()])
+        w.addstr(line, 56, '%11.2f' % (p.asset_counts[s.symb()] * s.price()))
+        w.addstr(line, 68, '%10.2f' % (p.asset_counts[s.symb()] * s.change()),
+                 change_color)
+
+        # Sparklines are rendered when sampled; this just draws the string.
+        if curses.COLS > st_spark_col + SPARK_WIDTH:
+            w.addstr(line, st_spark_col, st_sparklines.line(s.ticker),
                      change_color)
 
-            line += 1
+        return (p.asset_counts[s.symb()] * s.price(),
+                p.asset_counts[s.symb()] * s.change())
 
-        line += 1
+    def __display_totals(self, p, w, line, total_assets, total_change):
+        """
+        Draw the portfolio totals starting at line.
+        """
+
+        w.move(line, 0)
+        w.clrtoeol()
+        w.move(line + 1, 0)
+        w.clrtoeol()
 
         # Get overall change (of assets) for the portfolio.
         overall_change = total_assets - p.cost_basis()
@@ -258,6 +589,8 @@ class ST(object):
         w.addstr(line,     23, 'Total:')
         w.addstr(line,     30, '$%.2f' % overall_change,
                  curses.A_BOLD | overall_color)
+        w.addstr(line,     44, 'Realized:')
+        w.addstr(line,     58, '$%.2f' % p.realized())
         w.addstr(line + 1, 0,  'Assets:')
         w.addstr(line + 1, 8, '$%.2f' % total_assets)
         w.addstr(line + 1, 23, 'Cash:  $%.2f' % p.cash)
@@ -265,24 +598,193 @@ class ST(object):
         w.addstr(line + 1, 58, '$%.2f' % (p.cash + total_assets),
                  curses.A_BOLD)
 
+    def __display_portfolio(self, p, w):
+        """
+        Actually do the portfolio write.
+        """
+
+        global st_sort_key
+        global st_reverse_sort
+
+        line = 1
+        total_assets = 0
+        total_change = 0
+
+        # Only as many rows as fit on screen are ever drawn, so just pick
+        # those out rather than sorting everything. That's every line of the
+        # window bar the first one and the three the totals take up. The
+        # screenful after them is picked out too: those are next to be
+        # fetched.
+        rows, cols = w.getmaxyx()
+        visible = max(0, rows - 4)
+        stocks = self.__filtered(p)
+        if st_reverse_sort:
+            shown = heapq.nlargest(visible * 2, stocks, key=st_sort_key)
+        else:
+            shown = heapq.nsmallest(visible * 2, stocks, key=st_sort_key)
+
+        for s in shown[visible:]:
+            self.tiers[s.ticker] = TIER_NEARBY
+
+        for s in shown[:visible]:
+            self.drawn[s.ticker] = (line, s)
+            self.tiers[s.ticker] = TIER_VISIBLE
+
+            holding = self.__display_row(p, w, line, s)
+            if holding:
+                total_assets += holding[0]
+                total_change += holding[1]
+
+            line += 1
+
+        self.__display_totals(p, w, line + 1, total_assets, total_change)
+
+    def __display_stats(self, w):
+        """
+        Draw the stats overlay over the right hand side of the passed window.
+        """
+
+        lines = st_stats_lines()
+        width = max([ len(l) for l in lines ]) + 2
+        rows, cols = w.getmaxyx()
+        col = max(0, cols - width)
+
+        row = 1
+        for l in lines:
+            if row >= rows - 1:
+                break
+
+            attr = curses.A_REVERSE
+            if row == 1:
+                attr |= curses.A_BOLD
+
+            try:
+                w.addnstr(row, col, (' ' + l).ljust(width), cols - col, attr)
+            except curses.error:
+                pass
+
+            row += 1
+
+    @timed('ui.frame')
     def display_portfolio(self, p):
         """
         Display the active portfolio on the main screen. You must have the
         window lock!
         """
 
+        global st_stats_overlay
+        global st_first_portfolio_time
+
         if self.terminate:
             return
 
         w = self.windows['MAIN']
 
+        self.drawn_for = p
+        self.drawn = dict()
+        self.tiers = dict()
+
         self.clear_main()
-        self.__display_portfolio(p, w)
+        if isinstance(p, Watchlist):
+            self.__display_watchlist(p, w)
+        else:
+            self.__display_portfolio(p, w)
+
+        # A refresh under way should go for what's on screen now.
+        queue = self.fetch_queue
+        if queue:
+            queue.set_tiers(self.tiers)
+
+        if st_stats_overlay:
+            self.__display_stats(w)
         self.clear_header()
         self.set_header(p)
 
         self.refresh()
 
+        if not st_first_portfolio_time:
+            st_first_portfolio_time = time.time()
+
+    @timed('ui.repaint')
+    def repaint_changes(self, p, changes):
+        """
+        Redraw just the rows of p whose quotes are in the change set, plus
+        the totals. Falls back on a full redraw when the changes could have
+        moved rows around. You must have the window lock!
+        """
+
+        global st_sort_key
+
+        if self.terminate:
+            return
+
+        moved = [ t for t in changes.keys() if t in self.drawn ]
+
+        # Changes to stocks that aren't on screen can still push one onto it
+        # unless the sort is by name or symbol. Same goes for any stock
+        # getting its first quote, which gives it a name.
+        full = p is not self.drawn_for or isinstance(p, Watchlist) or \
+               st_sort_key not in (stock.stock_key_name, stock.stock_key_symb)
+        for t in changes.keys():
+            if changes[t].old is None:
+                full = True
+
+        if full:
+            self.display_portfolio(p)
+            return
+
+        self.__repaint_rows(p, moved)
+
+    def repaint_landed(self, p, stocks):
+        """
+        Quotes for stocks of p just landed in the middle of a refresh: redraw
+        those that are on screen where they are. Rows are put back in order
+        when the refresh is done. You must have the window lock!
+        """
+
+        if self.terminate or p is not self.drawn_for:
+            return
+
+        # Watchlists only show what stands out of all the quotes so far.
+        if isinstance(p, Watchlist):
+            self.display_portfolio(p)
+            return
+
+        self.__repaint_rows(p, [ s.ticker for s in stocks
+                                 if s.ticker in self.drawn ])
+
+    def __repaint_rows(self, p, tickers):
+        """
+        Redraw the rows for tickers, which must be on screen, and the totals.
+        """
+
+        global st_stats_overlay
+
+        if not tickers:
+            return
+
+        w = self.windows['MAIN']
+
+        for t in tickers:
+            line, s = self.drawn[t]
+            self.__display_row(p, w, line, s)
+
+        total_assets = 0
+        total_change = 0
+        last = 0
+        for line, s in self.drawn.values():
+            last = max(last, line)
+            if s.has_quote():
+                total_assets += p.asset_counts[s.ticker] * s.price()
+                total_change += p.asset_counts[s.ticker] * s.change()
+
+        self.__display_totals(p, w, last + 2, total_assets, total_change)
+
+        if st_stats_overlay:
+            self.__display_stats(w)
+
+        w.refresh()
+
     def track_portfolio(self, p):
         """
         This runs a thread that updates the main screen based on the passed
@@ -290,11 +792,16 @@ class ST(object):
         """
 
         global st_refresh_thread
+        global st_quote_stream
 
         if self.terminate:
             return
 
-        p.refresh()
+        # No refresh here: drawing the portfolio kicks off background fetches
+        # for anything we don't have a quote for yet.
+        if st_quote_stream:
+            st_quote_stream.set_tickers(p.asset_counts.keys())
+            st_quote_stream.start()
 
         self.lock.acquire()
         self.active_portfolio = p
@@ -333,51 +840,159 @@ class ST(object):
 
         # Now that we have a portfolio file, let's load it up and
         # fire off a thread to update it.
-        p = Portfolio(file_str.strip())
-        self.portfolios.append(p)
-        self.track_portfolio(p)
+        self.load_portfolios([ file_str.strip() ], activate=True)
+
+    def load_portfolios(self, file_paths, activate=False):
+        """
+        Load portfolios from the passed files in the background, showing
+        progress in the header. The first portfolio loaded becomes the active
+        one if activate is set or there is no active portfolio yet.
+        """
+
+        thr = threading.Thread(target=self.__load_portfolios,
+                               args=[ list(file_paths), activate ])
+        thr.daemon = True
+        thr.start()
+
+    def __load_portfolios(self, file_paths, activate):
+        for path in file_paths:
+            if self.terminate:
+                return
+
+            def progress(done, total):
+                self.set_loading('Loading %s: %d%%' %
+                                 (path, (100 * done) / max(total, 1)))
+
+            try:
+                p = Portfolio(path, progress=progress,
+                              coalesce=st_coalesce_lots)
+            except Exception, e:
+                self.set_loading(None)
+                self.set_action('Failed to load %s: %s' % (path, e))
+                continue
+
+            self.portfolios.append(p)
+            self.set_loading(None)
+
+            if p.errors:
+                self.set_action('%s: skipped %d bad line(s); first at %s' %
+                                (path, len(p.errors), p.errors[0]))
+
+            if activate or not self.active_portfolio:
+                self.track_portfolio(p)
+                activate = False
 
     def swap_active_portfolio(self):
         """
-        Display a list of available portfolios and allow the user to pick
-        one by number.
+        Display a list of available portfolios and let the user pick one to
+        view. Any number of portfolios are supported: the list scrolls. Keys:
+
+          up/down, j/k   Move the cursor
+          page up/down   Move a page at a time
+          <number>       Move the cursor to that entry
+          space          Mark/unmark the entry for a consolidated view
+          enter          View the marked portfolios merged together, or just
+                         the entry under the cursor if nothing is marked
+          q              Go back without changing anything
+
+        The first entry is a consolidated view of every loaded portfolio.
         """
 
-        self.lock.acquire()
+        if not self.portfolios:
+            return
 
-        self.clear_main()
+        self.lock.acquire()
 
         w = self.windows['MAIN']
-        l = 1
+        rows, cols = w.getmaxyx()
+        page = max(1, rows - 3)
 
-        for p in self.portfolios:
-            # Only support 9 portfolios since that makes this easier to deal
-            # with.
-            if l >= 10:
-                break
-
-            w.addstr(l, 0, '%2d' % l, curses.A_BOLD | curses.color_pair(1))
-            w.addstr(l, 3, p.name)
-            l += 1
+        portfolios = list(self.portfolios)
+        entries = [ 'All portfolios (consolidated)' ] + \
+                  [ p.name for p in portfolios ]
 
-        self.refresh()
+        cursor = 0
+        top = 0
+        number = ''
+        marked = set()
+        choice = None
 
-        # Wait for the user to give is a key.
         while True:
+            # Keep the cursor on screen.
+            if cursor < top:
+                top = cursor
+            elif cursor >= top + page:
+                top = cursor - page + 1
+
+            self.clear_main()
+
+            for i in range(top, min(len(entries), top + page)):
+                line = i - top + 1
+                attr = curses.A_REVERSE if i == cursor else curses.A_NORMAL
+                mark = '*' if i in marked else ' '
+
+                w.addstr(line, 0, '%4d' % i,
+                         curses.A_BOLD | curses.color_pair(1))
+                w.addnstr(line, 5, '%s %s' % (mark, entries[i]), cols - 6,
+                          attr)
+
+            w.addnstr(rows - 2, 0, 'Space marks, enter views, q goes back' +
+                      ('   Go to: %s' % number if number else ''), cols - 1)
+
+            self.refresh()
+
             c = self.stdscr.getch()
 
-            if c < ord('1') and c > ord('9'):
+            if c >= ord('0') and c <= ord('9'):
+                number += chr(c)
+                cursor = min(int(number), len(entries) - 1)
                 continue
 
-            index = c - ord('1')
-
-            if index < len(self.portfolios):
+            number = ''
+
+            if c == curses.KEY_UP or c == ord('k'):
+                cursor = max(0, cursor - 1)
+            elif c == curses.KEY_DOWN or c == ord('j'):
+                cursor = min(len(entries) - 1, cursor + 1)
+            elif c == curses.KEY_PPAGE:
+                cursor = max(0, cursor - page)
+            elif c == curses.KEY_NPAGE:
+                cursor = min(len(entries) - 1, cursor + page)
+            elif c == ord(' '):
+                if cursor in marked:
+                    marked.remove(cursor)
+                elif cursor > 0:
+                    marked.add(cursor)
+            elif c == ord('\n') or c == ord('\r') or c == curses.KEY_ENTER:
+                if marked:
+                    choice = Consolidated([ portfolios[i - 1]
+                                            for i in sorted(marked) ])
+                elif cursor == 0:
+                    choice = Consolidated(portfolios, name='All portfolios')
+                else:
+                    choice = portfolios[cursor - 1]
+                break
+            elif c == ord('q'):
                 break
 
-        self.portfolios[index].refresh()
+        if choice:
+            # Consolidated views are made on demand; stop the old one from
+            # listening to its members.
+            old = self.active_portfolio
+            if isinstance(old, Consolidated):
+                old.close()
+
+            if st_quote_stream:
+                st_quote_stream.set_tickers(choice.asset_counts.keys())
+
+            self.active_portfolio = choice
+
+        if self.active_portfolio:
+            self.display_portfolio(self.active_portfolio)
+        else:
+            self.clear_main()
+            self.refresh()
 
-        self.active_portfolio = self.portfolios[index]
-        self.display_portfolio(self.active_portfolio)
         self.lock.release()
 
     def choose_sort_key(self):
@@ -442,18 +1057,304 @@ class ST(object):
 
     def force_refresh(self):
         """
+        Refresh the active portfolio right now. The user is waiting on this so
+        it jumps the queue ahead of background refreshes.
         """
 
         if not self.active_portfolio:
             return
 
-        self.active_portfolio.refresh()
+        self.active_portfolio.refresh(PRIORITY_HIGH)
 
         self.lock.acquire()
         self.display_portfolio(self.active_portfolio)
         self.lock.release()
 
 
+    def load_watchlist(self, file_path):
+        """
+        Load a watchlist in the background and fetch its quotes.
+        """
+
+        thr = threading.Thread(target=self.__load_watchlist,
+                               args=[ file_path ])
+        thr.daemon = True
+        thr.start()
+
+    def __load_watchlist(self, file_path):
+        self.set_loading('Loading watchlist %s' % file_path)
+
+        try:
+            wl = Watchlist(file_path)
+        except IOError, e:
+            self.set_loading(None)
+            self.set_action('Failed to load %s: %s' % (file_path, e))
+            return
+
+        self.watchlist = wl
+        self.set_loading('Quoting %d symbols' % len(wl.assets))
+
+        try:
+            wl.refresh()
+        except Exception, e:
+            self.set_action('Failed to quote watchlist: %s' % e)
+
+        self.set_loading(None)
+
+        self.lock.acquire()
+        if self.active_portfolio is wl:
+            self.display_portfolio(wl)
+        self.lock.release()
+
+    def toggle_watchlist(self):
+        """
+        Switch between the watchlist and whatever we were looking at before.
+        """
+
+        if not self.watchlist:
+            self.set_action('No watchlist loaded; start st with --watch=<file>')
+            return
+
+        if self.active_portfolio is self.watchlist:
+            if self.unwatched:
+                self.track_portfolio(self.unwatched)
+            return
+
+        self.unwatched = self.active_portfolio
+        self.track_portfolio(self.watchlist)
+
+    def load_symbols(self):
+        """
+        Load the symbol directory in the background, the first time it's
+        wanted.
+        """
+
+        if self.symbols_loading:
+            return
+
+        self.symbols_loading = True
+
+        thr = threading.Thread(target=self.__load_symbols)
+        thr.daemon = True
+        thr.start()
+
+    def __load_symbols(self):
+        global st_symbol_dir
+
+        directory = SymbolDirectory(st_symbols_file)
+        directory.load()
+
+        st_symbol_dir = directory
+
+    def __read_key(self):
+        """
+        Read a key for one of the type-ahead prompts. Returns a printable
+        character, or one of 'enter', 'escape' and 'backspace', or None for
+        anything else.
+        """
+
+        c = self.stdscr.getch()
+
+        if c in (10, 13, curses.KEY_ENTER):
+            return 'enter'
+        if c == 27:
+            return 'escape'
+        if c in (8, 127, curses.KEY_BACKSPACE):
+            return 'backspace'
+        if 32 < c < 127:
+            return chr(c)
+
+        return None
+
+    def filter_rows(self):
+        """
+        Filter-as-you-type: each key narrows the rows shown to the stocks
+        whose ticker or company name starts with what's been typed. Enter
+        keeps the filter, escape drops it.
+        """
+
+        p = self.active_portfolio
+        if not p:
+            return
+
+        self.load_symbols()
+
+        self.filter = SymbolFilter(p.assets, st_symbol_dir)
+        self.filter_for = p
+
+        while True:
+            self.lock.acquire()
+            self.display_portfolio(p)
+            self.lock.release()
+
+            self.set_action('Filter: %s_  (%d of %d rows)' %
+                            (self.filter.query, len(self.filter.result()),
+                             len(p.assets)))
+
+            key = self.__read_key()
+            if key == 'enter':
+                break
+            elif key == 'escape':
+                self.filter = None
+                break
+            elif key == 'backspace':
+                self.filter.pop()
+            elif key:
+                self.filter.push(key)
+
+        if self.filter and not self.filter.query:
+            self.filter = None
+
+        self.lock.acquire()
+        self.display_portfolio(p)
+        self.clear_action()
+        if self.filter:
+            self.windows['ACTION'].addstr(0, 20, 'Filter: %s' %
+                                          self.filter.query, curses.A_BOLD)
+        self.windows['ACTION'].refresh()
+        self.lock.release()
+
+    def add_ticker(self):
+        """
+        Add a ticker to the watchlist, searching the symbol directory as the
+        user types. Enter adds the first match (or what was typed, if
+        nothing matches).
+        """
+
+        if not self.watchlist:
+            self.set_action('No watchlist to add to; start st with '
+                            '--watch=<file>')
+            return
+
+        self.load_symbols()
+
+        query = ''
+        matches = list()
+
+        while True:
+            if st_symbol_dir is None:
+                hint = '(symbol directory still loading)'
+            else:
+                hint = '  '.join([ '%s %s' % (t, st_symbol_dir.name(t)[0:20])
+                                   for t in matches ])
+            self.set_action('Add: %s_  %s' % (query, hint))
+
+            key = self.__read_key()
+            if key == 'escape':
+                self.set_action('')
+                return
+            elif key == 'enter':
+                break
+            elif key == 'backspace':
+                query = query[:-1]
+            elif key:
+                query += key
+
+            matches = list()
+            if st_symbol_dir is not None:
+                matches = st_symbol_dir.search(query, 4)
+
+        ticker = query.upper()
+        if matches:
+            ticker = matches[0]
+
+        if not ticker:
+            self.set_action('')
+            return
+
+        try:
+            added = self.watchlist.add(ticker)
+        except IOError, e:
+            self.set_action('Failed to add %s: %s' % (ticker, e))
+            return
+
+        if not added:
+            self.set_action('%s is already on the watchlist' % ticker)
+            return
+
+        stock.Stock(ticker).revalidate()
+        if st_quote_stream and self.active_portfolio is self.watchlist:
+            st_quote_stream.set_tickers(self.watchlist.asset_counts.keys())
+
+        self.set_action('Added %s to %s' % (ticker, self.watchlist.name))
+
+    def show_risk(self):
+        """
+        Run a Monte Carlo risk simulation of the active portfolio in the
+        background and show the numbers in the action box.
+        """
+
+        p = self.active_portfolio
+        if not p or isinstance(p, Watchlist):
+            self.set_action('Risk is only worked out for portfolios')
+            return
+
+        if not st_history_file:
+            self.set_action('No history to simulate from; start st with '
+                            '--history=<file>')
+            return
+
+        thr = threading.Thread(target=self.__show_risk, args=[ p ])
+        thr.daemon = True
+        thr.start()
+
+    def __show_risk(self, p):
+        self.set_action('Simulating %d paths of %d days...' % (st_risk_paths,
+                                                              st_risk_days))
+
+        try:
+            import st_risk
+        except ImportError:
+            self.set_action('Risk simulation needs numpy')
+            return
+
+        try:
+            closes = st_risk.load_daily_closes(st_history_file)
+            report = st_risk.portfolio_risk(p, closes, st_risk_days,
+                                            st_risk_paths, seed=st_risk_seed)
+        except (IOError, ValueError), e:
+            self.set_action('Risk simulation failed: %s' % e)
+            return
+
+        self.set_action(report.describe(0.9 * report.start))
+
+    def show_alert(self, alert):
+        """
+        Alert listener: put the alert in the action box.
+        """
+
+        self.set_action('ALERT: %s' % alert)
+
+    def toggle_stats(self):
+        """
+        Show or hide the stats overlay.
+        """
+
+        global st_stats_overlay
+
+        st_stats_overlay = not st_stats_overlay
+
+        if not self.active_portfolio:
+            return
+
+        self.lock.acquire()
+        self.display_portfolio(self.active_portfolio)
+        self.lock.release()
+
+    def toggle_profile(self):
+        """
+        Start or stop a cProfile capture of the refresh thread. The refresh
+        thread notices on its next tick; the profile is written when the
+        capture is stopped.
+        """
+
+        global st_profile_wanted
+
+        st_profile_wanted = not st_profile_wanted
+
+        if st_profile_wanted:
+            self.set_action('Profiling refresh thread; press \'p\' to stop')
+
     def display_help(self):
         """
         Display a help message to the main screen.
@@ -467,9 +1368,15 @@ Help                          h
 Quit                          q
 Force refresh                 r
 Load portfolio                l
-Toggle active portfolio       t
+Pick portfolio(s) to view     s
 Set refresh interval          d
 Choose sort key               k
+Toggle stats overlay          i
+Start/stop refresh profile    p
+Toggle watchlist              w
+Filter rows as you type       f or /
+Add ticker to watchlist       a
+Simulate portfolio risk       v
 
 Quit this dialog with 'q' or 'h'
 """
@@ -498,24 +1405,37 @@ Quit this dialog with 'q' or 'h'
 
         self.refresh()
 
-    def run(self, starting_portfolios=list()):
+    def run(self, starting_files=list()):
         """
         Main execution thread - listens for input from the user and handles
-        user commands.
+        user commands. The passed portfolio files are loaded in the
+        background so the UI is up straight away.
         """
 
         global st_refresh_thread_die
 
-        self.portfolios = starting_portfolios
+        self.load_portfolios(starting_files)
+
+        if st_alert_engine:
+            st_alert_engine.add_listener(self.show_alert)
 
-        if len(self.portfolios) > 0:
-            self.track_portfolio(self.portfolios[0])
+        if st_watch_file:
+            self.load_watchlist(st_watch_file)
+
+        # When benchmarking start up, poll for input so that we notice when
+        # the first portfolio has been drawn and can quit.
+        if st_bench_startup:
+            self.stdscr.timeout(100)
 
         # Loop forever - user will terminate.
         while True:
 
             c = self.stdscr.getch()
 
+            if st_bench_startup and (st_first_portfolio_time or
+                                     not starting_files):
+                c = ord('q')
+
             if c == ord('h'):
                 # Print help screen to the main window.
                 self.display_help()
@@ -526,6 +1446,9 @@ Quit this dialog with 'q' or 'h'
                 self.terminate = True
                 st_refresh_thread_die = True
                 self.lock.release()
+
+                if st_quote_stream:
+                    st_quote_stream.stop()
                 break
             elif c == ord('l'):
                 # Load a portfolio
@@ -538,6 +1461,18 @@ Quit this dialog with 'q' or 'h'
                 self.force_refresh()
             elif c == ord('k'):
                 self.choose_sort_key()
+            elif c == ord('i'):
+                self.toggle_stats()
+            elif c == ord('p'):
+                self.toggle_profile()
+            elif c == ord('w'):
+                self.toggle_watchlist()
+            elif c == ord('f') or c == ord('/'):
+                self.filter_rows()
+            elif c == ord('a'):
+                self.add_ticker()
+            elif c == ord('v'):
+                self.show_risk()
 
 
     def refresh(self):
@@ -548,7 +1483,7 @@ Quit this dialog with 'q' or 'h'
         for w in self.windows.values():
             w.refresh()
 
-def main(stdscr, starting_portfolios):
+def main(stdscr, starting_files):
     """
     Our main routine! Set everything up and away we go!
     """
@@ -561,17 +1496,109 @@ def main(stdscr, starting_portfolios):
 
     # Fire up the Stock Tracker.
     st = ST(stdscr);
-    st.run(starting_portfolios)
+    st.run(starting_files)
 
 ##
-## Treat arguments as portfolios to load.
+## Treat arguments as portfolios to load. The exceptions are --stream=<url>,
+## which points us at a push quote feed, --stats=<file> which has the stats
+## periodically written to file as JSON, --watch=<file> which loads a
+## watchlist, --alerts=<file> which loads price alert rules (alerts are
+## appended to --alert-log=<file>, st-alerts.log by default),
+## --history=<file> which appends every quote change to file (and is the
+## history risk simulations sample from),
+## --symbols=<file> which sets where the symbol directory is cached
+## (~/.st-symbols.json by default), --provider=<url> (repeatable, most
+## preferred first) which sets where quotes come from, --daemon=<socket>
+## which gets quotes from a running st_daemon.py instead of fetching them,
+## --coalesce which merges buys of a stock on the same day at the same price
+## into one lot, and
+## --bench-startup which quits as soon as the first portfolio is drawn and
+## reports how long that took.
 ##
-starting_portfolios = list()
+starting_files = list()
+alert_files = list()
+providers = list()
+alert_log = 'st-alerts.log'
 
 for i in range(1, len(sys.argv)):
-    starting_portfolios.append(Portfolio(sys.argv[i]))
+    if sys.argv[i].startswith('--stream='):
+        from st_stream import QuoteStream
+        st_quote_stream = QuoteStream(sys.argv[i][len('--stream='):],
+                                      poll_interval=st_refresh_thread_interval)
+        continue
+
+    if sys.argv[i].startswith('--symbols='):
+        st_symbols_file = sys.argv[i][len('--symbols='):]
+        continue
+
+    if sys.argv[i].startswith('--daemon='):
+        from st_daemon import DaemonClient
+        st_quote_stream = DaemonClient(sys.argv[i][len('--daemon='):])
+
+        # The daemon fetches whatever we subscribe to that it hasn't got;
+        # every st asking the provider as well would defeat the point.
+        stock.Stock.fetch_missing = False
+        continue
+
+    if sys.argv[i].startswith('--stats='):
+        st_stats_file = sys.argv[i][len('--stats='):]
+        continue
+
+    if sys.argv[i].startswith('--watch='):
+        st_watch_file = sys.argv[i][len('--watch='):]
+        continue
+
+    if sys.argv[i].startswith('--alerts='):
+        alert_files.append(sys.argv[i][len('--alerts='):])
+        continue
+
+    if sys.argv[i].startswith('--alert-log='):
+        alert_log = sys.argv[i][len('--alert-log='):]
+        continue
+
+    if sys.argv[i].startswith('--history='):
+        from st_changes import HistoryWriter
+        st_history_file = sys.argv[i][len('--history='):]
+        HistoryWriter(st_change_feed, st_history_file)
+        continue
+
+    if sys.argv[i].startswith('--provider='):
+        providers.append(sys.argv[i][len('--provider='):])
+        continue
+
+    if sys.argv[i] == '--coalesce':
+        st_coalesce_lots = True
+        continue
+
+    if sys.argv[i] == '--bench-startup':
+        st_bench_startup = True
+        continue
+
+    starting_files.append(sys.argv[i])
+
+if providers:
+    st_query_set_providers(providers)
+
+# With a push feed quotes only arrive when they change. A quiet ticker's
+# quote is as fresh as the feed, so don't go behind its back to revalidate.
+if st_quote_stream:
+    stock.Stock.max_age = None
+
+if alert_files:
+    from st_alert import AlertEngine
+    st_alert_engine = AlertEngine(st_change_feed, log_path=alert_log)
+    for f in alert_files:
+        st_alert_engine.load_rules(f)
 
 # Actually start the app!
 #
 # Handles annoying crashes, etc.
-curses.wrapper(main, starting_portfolios)
+curses.wrapper(main, starting_files)
+
+if st_bench_startup:
+    first_portfolio = 0.0
+    if st_first_portfolio_time:
+        first_portfolio = (st_first_portfolio_time - st_start_time) * 1000.0
+
+    print 'first_frame_ms=%.1f portfolio_frame_ms=%.1f' % (
+        (st_first_frame_time - st_start_time) * 1000.0, first_portfolio)
@@ -0,0 +1,396 @@
+#
+# Price alerts. Rules say things like "tell me when NVDA goes above 250" or
+# "when AMD is down more than 5% on the day". There can be thousands of them
+# so they are kept in per-ticker sorted threshold indexes: when a quote moves
+# from one value to another only the thresholds in between are looked at.
+#
+
+import time
+import bisect
+import threading
+
+from datetime import datetime
+
+from stock    import Stock
+from st_stats import timed, st_stats_count
+
+class AlertRule(object):
+    """
+    A single alert: fire when field of ticker's quote crosses threshold in
+    direction.
+    """
+
+    # Fields we can alert on.
+    PRICE  = 'price'
+    CHANGE = 'change'       # Percent change on the day, as a fraction.
+
+    # Directions.
+    ABOVE  = 'above'
+    BELOW  = 'below'
+
+    def __init__(self, ticker, field, direction, threshold, note=''):
+        self.ticker    = ticker
+        self.field     = field
+        self.direction = direction
+        self.threshold = float(threshold)
+        self.note      = note
+
+        # Fired rules are disarmed until the quote has moved back far enough
+        # past the threshold; see ThresholdIndex.
+        self.armed     = True
+
+    def key(self):
+        """
+        Rules with the same key are duplicates of each other.
+        """
+
+        return (self.ticker, self.field, self.direction, self.threshold)
+
+    def describe(self):
+        if self.field == AlertRule.CHANGE:
+            what = 'change %+.2f%%' % (self.threshold * 100)
+        else:
+            what = 'price %.2f' % self.threshold
+
+        return '%s %s %s' % (self.ticker, self.direction, what)
+
+class Alert(object):
+    """
+    A rule firing.
+    """
+
+    def __init__(self, rule, value):
+        self.rule  = rule
+        self.value = value
+        self.time  = time.time()
+
+    def __str__(self):
+        if self.rule.field == AlertRule.CHANGE:
+            now = '%+.2f%%' % (self.value * 100)
+        else:
+            now = '%.2f' % self.value
+
+        s = '%s (now %s)' % (self.rule.describe(), now)
+        if self.rule.note:
+            s += ' # %s' % self.rule.note
+
+        return s
+
+class ThresholdIndex(object):
+    """
+    The rules for one ticker, one field and one direction, sorted by
+    threshold. A second list sorted by re-arm point gives the hysteresis:
+    an 'above' rule that has fired only re-arms once the value drops back
+    below threshold - margin (and the other way round for 'below' rules).
+
+    Everything is a bisect plus a walk over the rules actually affected, so
+    a move costs O(log n + hits).
+    """
+
+    def __init__(self, direction, margin):
+        """
+        margin(threshold) gives the hysteresis margin for a threshold. It must
+        not shrink faster than the threshold grows, so that re-arm points
+        sort the same way thresholds do.
+        """
+
+        self.direction  = direction
+        self.margin     = margin
+
+        self.thresholds = list()
+        self.rules      = list()
+        self.rearms     = list()
+        self.rearm_of   = list()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __rearm_point(self, t):
+        if self.direction == AlertRule.ABOVE:
+            return t - self.margin(t)
+
+        return t + self.margin(t)
+
+    def add(self, rule):
+        i = bisect.bisect_right(self.thresholds, rule.threshold)
+        self.thresholds.insert(i, rule.threshold)
+        self.rules.insert(i, rule)
+
+        rp = self.__rearm_point(rule.threshold)
+        i = bisect.bisect_right(self.rearms, rp)
+        self.rearms.insert(i, rp)
+        self.rearm_of.insert(i, rule)
+
+    def remove(self, rule):
+        i = self.rules.index(rule)
+        del self.thresholds[i]
+        del self.rules[i]
+
+        i = self.rearm_of.index(rule)
+        del self.rearms[i]
+        del self.rearm_of[i]
+
+    def move(self, old, new):
+        """
+        The value went from old (None if never seen) to new. Re-arm what
+        needs re-arming and return the rules that fire.
+        """
+
+        fired = list()
+
+        if self.direction == AlertRule.ABOVE:
+            # Fire: old < t <= new.
+            lo = 0
+            if old is not None:
+                lo = bisect.bisect_right(self.thresholds, old)
+            hi = bisect.bisect_right(self.thresholds, new)
+
+            # Re-arm: new < rearm <= old.
+            if old is not None and new < old:
+                rlo = bisect.bisect_right(self.rearms, new)
+                rhi = bisect.bisect_right(self.rearms, old)
+                for rule in self.rearm_of[rlo:rhi]:
+                    rule.armed = True
+        else:
+            # Fire: new <= t < old.
+            lo = bisect.bisect_left(self.thresholds, new)
+            hi = len(self.thresholds)
+            if old is not None:
+                hi = bisect.bisect_left(self.thresholds, old)
+
+            # Re-arm: old <= rearm < new.
+            if old is not None and new > old:
+                rlo = bisect.bisect_left(self.rearms, old)
+                rhi = bisect.bisect_left(self.rearms, new)
+                for rule in self.rearm_of[rlo:rhi]:
+                    rule.armed = True
+
+        for rule in self.rules[lo:hi]:
+            if rule.armed:
+                rule.armed = False
+                fired.append(rule)
+
+        return fired
+
+class AlertEngine(object):
+    """
+    Holds all the alert rules and checks them as quotes change.
+
+    The engine subscribes to a change feed (see st_changes). Each change set
+    marks the tickers in it that have rules dirty, and only the dirty
+    tickers are then evaluated.
+    """
+
+    def __init__(self, feed, log_path=None, price_margin=0.005,
+                 change_margin=0.0025):
+        """
+        Check rules against the changes published by feed. log_path, if
+        passed, is a file every alert is appended to.
+
+        Hysteresis: price rules re-arm once the price is back price_margin
+        (a fraction of the threshold) on the other side of the threshold;
+        change rules once the change is back change_margin (in absolute
+        fraction, so 0.0025 is a quarter of a percent).
+        """
+
+        self.log_path      = log_path
+        self.price_margin  = price_margin
+        self.change_margin = change_margin
+
+        self.indexes   = dict()     # (ticker, field, direction) -> index
+        self.keys      = dict()     # Rule key -> rule, to catch duplicates.
+        self.last      = dict()     # (ticker, field) -> last value seen.
+        self.dirty     = set()
+        self.listeners = list()
+        self.history   = list()     # Recent alerts, newest last.
+
+        self.__lock    = threading.Lock()
+
+        self.feed      = feed
+        feed.subscribe(self.changes_published)
+
+    def close(self):
+        self.feed.unsubscribe(self.changes_published)
+
+    def __margin(self, field):
+        if field == AlertRule.CHANGE:
+            m = self.change_margin
+            return lambda t: m
+
+        m = self.price_margin
+        return lambda t: abs(t) * m
+
+    def add_rule(self, rule):
+        """
+        Add a rule. If an identical rule is already present that one is
+        returned instead and nothing is added.
+        """
+
+        self.__lock.acquire()
+
+        have = self.keys.get(rule.key())
+        if have:
+            self.__lock.release()
+            return have
+
+        ikey = (rule.ticker, rule.field, rule.direction)
+        index = self.indexes.get(ikey)
+        if index is None:
+            index = ThresholdIndex(rule.direction, self.__margin(rule.field))
+            self.indexes[ikey] = index
+
+        index.add(rule)
+        self.keys[rule.key()] = rule
+
+        # Check the new rule against the quote we already have, if any.
+        self.dirty.add(rule.ticker)
+        self.last.pop((rule.ticker, rule.field), None)
+
+        self.__lock.release()
+
+        return rule
+
+    def remove_rule(self, rule):
+        self.__lock.acquire()
+
+        ikey = (rule.ticker, rule.field, rule.direction)
+        index = self.indexes.get(ikey)
+        if index is not None and rule in index.rules:
+            index.remove(rule)
+            del self.keys[rule.key()]
+            if not len(index):
+                del self.indexes[ikey]
+
+        self.__lock.release()
+
+    def nr_rules(self):
+        return len(self.keys)
+
+    def load_rules(self, file_path):
+        """
+        Load rules from a file, one per line:
+
+          <ticker> <price|change> <above|below> <threshold> [# note]
+
+        Change thresholds are in percent, f.e 'AMD change below -5'. Blank
+        lines and lines starting with '#' are ignored. Returns the number of
+        rules loaded.
+        """
+
+        nr = 0
+
+        for line in open(file_path):
+            line = line.strip()
+            if line == '' or line[0] == '#':
+                continue
+
+            note = ''
+            if '#' in line:
+                line, note = line.split('#', 1)
+                note = note.strip()
+
+            items = line.split()
+            if len(items) != 4 or \
+               items[1] not in (AlertRule.PRICE, AlertRule.CHANGE) or \
+               items[2] not in (AlertRule.ABOVE, AlertRule.BELOW):
+                raise ValueError('Bad alert rule: "%s"' % line.strip())
+
+            threshold = float(items[3].rstrip('%'))
+            if items[1] == AlertRule.CHANGE:
+                threshold /= 100.0
+
+            self.add_rule(AlertRule(items[0].upper(), items[1], items[2],
+                                    threshold, note))
+            nr += 1
+
+        return nr
+
+    def add_listener(self, func):
+        """
+        Have func(alert) called for every alert fired.
+        """
+
+        self.listeners.append(func)
+
+    def __has_rules(self, ticker):
+        for field in (AlertRule.PRICE, AlertRule.CHANGE):
+            for direction in (AlertRule.ABOVE, AlertRule.BELOW):
+                if (ticker, field, direction) in self.indexes:
+                    return True
+
+        return False
+
+    def changes_published(self, changes):
+        """
+        Change feed subscriber: evaluate the rules of the tickers that moved.
+        """
+
+        self.__lock.acquire()
+        for ticker in changes.keys():
+            if self.__has_rules(ticker):
+                self.dirty.add(ticker)
+        self.__lock.release()
+
+        self.evaluate()
+
+    @timed('alert.evaluate')
+    def evaluate(self):
+        """
+        Check the rules for every dirty ticker. Returns the alerts fired.
+        """
+
+        self.__lock.acquire()
+        dirty = self.dirty
+        self.dirty = set()
+
+        fired = list()
+
+        for ticker in dirty:
+            data = Stock(ticker).cached_data()
+            if not data:
+                continue
+
+            for field, name in ((AlertRule.PRICE, 'latestPrice'),
+                                (AlertRule.CHANGE, 'changePercent')):
+                value = data.get(name)
+                if value is None:
+                    continue
+
+                value = float(value)
+                old = self.last.get((ticker, field))
+                if old == value:
+                    continue
+                self.last[(ticker, field)] = value
+
+                for direction in (AlertRule.ABOVE, AlertRule.BELOW):
+                    index = self.indexes.get((ticker, field, direction))
+                    if index is None:
+                        continue
+
+                    for rule in index.move(old, value):
+                        fired.append(Alert(rule, value))
+
+        self.__lock.release()
+
+        st_stats_count('alert.evaluated', len(dirty))
+
+        if fired:
+            st_stats_count('alert.fired', len(fired))
+            self.__publish(fired)
+
+        return fired
+
+    def __publish(self, alerts):
+        self.history.extend(alerts)
+        del self.history[:-100]
+
+        if self.log_path:
+            f = open(self.log_path, 'a')
+            for a in alerts:
+                when = datetime.fromtimestamp(a.time)
+                f.write('%s | %s\n' % (when.strftime('%b %d, %Y %H:%M:%S'), a))
+            f.close()
+
+        for func in list(self.listeners):
+            for a in alerts:
+                func(a)
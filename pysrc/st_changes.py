@@ -0,0 +1,155 @@
+#
+# Quote change feed. Every quote landing in the Stock cache is diffed against
+# the last one for that ticker; the tickers that actually moved are collected
+# and handed to subscribers once per refresh cycle. Anything downstream
+# (redraws, alerts, history) only has to look at what changed.
+#
+
+import time
+import threading
+
+from stock    import Stock
+from st_stats import st_stats_count, st_stats_record
+
+# The quote fields we care about moving. Volume comes from latestVolume when
+# the provider has it.
+FIELDS = ( 'latestPrice', 'change', 'changePercent', 'latestVolume' )
+
+def quote_values(data):
+    """
+    Pull the fields we track out of quote data as a tuple.
+    """
+
+    return tuple([ data.get(f) for f in FIELDS ])
+
+class QuoteChange(object):
+    """
+    One ticker's move within a cycle. old is None if this is the first quote
+    we've seen for it. old and new are tuples of the FIELDS values.
+    """
+
+    def __init__(self, ticker, old, new):
+        self.ticker = ticker
+        self.old    = old
+        self.new    = new
+
+    def price(self):
+        return self.new[0]
+
+    def moved(self, field):
+        """
+        Returns True if the named field (one of FIELDS) changed.
+        """
+
+        i = FIELDS.index(field)
+
+        return self.old is None or self.old[i] != self.new[i]
+
+class ChangeFeed(object):
+    """
+    Collects quote changes as they land and publishes them as one change set
+    per cycle.
+
+    A change set is a dict of ticker -> QuoteChange. A ticker that moves
+    several times in one cycle appears once, with old being the value at the
+    start of the cycle; a ticker that moved and then moved back isn't in it
+    at all.
+    """
+
+    def __init__(self):
+        self.last        = dict()   # Ticker -> values last seen.
+        self.pending     = dict()   # Ticker -> values at the cycle start.
+        self.subscribers = list()
+
+        self.__lock      = threading.Lock()
+
+        Stock.add_listener(self.quote_landed)
+
+    def close(self):
+        Stock.remove_listener(self.quote_landed)
+
+    def subscribe(self, func):
+        """
+        Have func(changes) called with each non-empty change set.
+        """
+
+        self.subscribers.append(func)
+
+    def unsubscribe(self, func):
+        if func in self.subscribers:
+            self.subscribers.remove(func)
+
+    def quote_landed(self, ticker, data):
+        """
+        Stock cache listener; runs in whatever thread fetched the quote.
+        """
+
+        new = quote_values(data)
+
+        self.__lock.acquire()
+
+        old = self.last.get(ticker)
+        if old != new:
+            self.last[ticker] = new
+            if ticker not in self.pending:
+                self.pending[ticker] = old
+
+        self.__lock.release()
+
+    def publish(self):
+        """
+        End the current cycle: hand the tickers that moved to every
+        subscriber and return the change set.
+        """
+
+        start = time.time()
+
+        self.__lock.acquire()
+        pending = self.pending
+        self.pending = dict()
+
+        changes = dict()
+        for ticker in pending.keys():
+            old = pending[ticker]
+            new = self.last[ticker]
+            if old != new:
+                changes[ticker] = QuoteChange(ticker, old, new)
+
+        self.__lock.release()
+
+        st_stats_count('changes.published', len(changes))
+
+        if changes:
+            for func in list(self.subscribers):
+                func(changes)
+
+        st_stats_record('changes.publish', (time.time() - start) * 1000.0)
+
+        return changes
+
+class HistoryWriter(object):
+    """
+    Change feed subscriber that appends every move to a history file, one
+    comma separated line per change:
+
+      <unix time>,<ticker>,<price>,<change>,<change percent>,<volume>
+    """
+
+    def __init__(self, feed, file_path):
+        self.file_path = file_path
+        self.feed      = feed
+
+        feed.subscribe(self.write)
+
+    def close(self):
+        self.feed.unsubscribe(self.write)
+
+    def write(self, changes):
+        now = time.time()
+
+        f = open(self.file_path, 'a')
+        for ticker in sorted(changes.keys()):
+            vals = [ '' if v is None else str(v)
+                     for v in changes[ticker].new ]
+            f.write('%.3f,%s,%s\n' % (now, ticker, ','.join(vals)))
+        f.close()
@@ -0,0 +1,468 @@
+#!/usr/bin/python
+
+#
+# Local quote daemon. One daemon owns fetching and the quote cache; any number
+# of st instances on the same host subscribe to it over a Unix domain socket
+# instead of each polling the provider for the same tickers. Run it with:
+#
+#   st_daemon.py <socket path> [poll interval]
+#
+# and start st with --daemon=<socket path>.
+#
+# The protocol is a stream of frames, each a 4 byte big endian payload length
+# and a 1 byte frame type followed by a compact JSON payload:
+#
+#   'S' client -> daemon: the list of tickers the client wants. Replaces
+#       whatever it subscribed to before.
+#   'Q' daemon -> client: a dict of ticker -> quote data. Sent straight after
+#       each 'S' with whatever the daemon already has for those tickers, then
+#       after each poll with the quotes that changed.
+#
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import struct
+import threading
+
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from SocketServer import StreamRequestHandler
+
+from stock      import Stock
+from st_query   import st_query_batch
+from st_stats   import st_stats_count
+from st_watch   import BATCH_SIZE
+from st_changes import ChangeFeed
+
+# Frame header: payload length, frame type.
+FRAME = struct.Struct('!IB')
+
+MSG_SUBSCRIBE = 'S'
+MSG_QUOTES    = 'Q'
+
+def send_frame(sock, kind, obj):
+    """
+    Send one frame. The caller serializes writers to the same socket.
+    """
+
+    payload = json.dumps(obj, separators=(',', ':'))
+    sock.sendall(FRAME.pack(len(payload), ord(kind)) + payload)
+
+def read_frame(f):
+    """
+    Read one frame from the file object f. Returns (type, payload), or None
+    if the other end went away.
+    """
+
+    header = f.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None
+
+    size, kind = FRAME.unpack(header)
+
+    payload = f.read(size)
+    if len(payload) < size:
+        return None
+
+    return (chr(kind), json.loads(payload))
+
+class DaemonClientHandler(StreamRequestHandler):
+    """
+    Daemon side of a single client connection.
+    """
+
+    def setup(self):
+        StreamRequestHandler.setup(self)
+
+        self.tickers = set()
+        self.lock    = threading.Lock()
+
+    def send(self, kind, obj):
+        """
+        Send a frame to the client. Returns False if the client is gone.
+        """
+
+        self.lock.acquire()
+
+        try:
+            send_frame(self.request, kind, obj)
+            ok = True
+        except socket.error:
+            ok = False
+
+        self.lock.release()
+
+        return ok
+
+    def handle(self):
+        self.server.client_connected(self)
+
+        try:
+            while True:
+                frame = read_frame(self.rfile)
+                if not frame:
+                    break
+
+                kind, payload = frame
+                if kind == MSG_SUBSCRIBE:
+                    self.tickers = set([ str(t).upper() for t in payload ])
+                    self.server.subscribed(self)
+        except (socket.error, ValueError):
+            pass
+        finally:
+            self.server.client_disconnected(self)
+
+    # Clients hanging up is normal; don't complain when there is nobody left
+    # to flush to.
+    def finish(self):
+        try:
+            StreamRequestHandler.finish(self)
+        except IOError:
+            pass
+
+class QuoteDaemon(ThreadingMixIn, UnixStreamServer):
+    """
+    Polls the provider for every ticker any client is subscribed to, one set
+    of batch queries per interval no matter how many clients there are, and
+    pushes the quotes that changed to the clients that want them.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, interval=15.0):
+        # Clean up after a daemon that died without removing its socket, but
+        # don't steal the socket from one that is still running.
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                probe.close()
+                raise IOError(errno.EADDRINUSE,
+                              'A quote daemon is already running', path)
+            except socket.error:
+                os.unlink(path)
+
+        UnixStreamServer.__init__(self, path, DaemonClientHandler)
+
+        self.path     = path
+        self.interval = interval
+        self.clients  = list()
+        self.polls    = 0
+
+        # Tickers someone subscribed to that we have no quote for yet. These
+        # are fetched straight away rather than at the next poll.
+        self.missing  = set()
+
+        self.feed     = ChangeFeed()
+        self.feed.subscribe(self.__broadcast)
+
+        self.__lock   = threading.Lock()
+        self.__wake   = threading.Event()
+        self.__die    = False
+        self.__thread = None
+        self.__poller = None
+
+    def client_connected(self, client):
+        self.__lock.acquire()
+        self.clients.append(client)
+        self.__lock.release()
+
+        st_stats_count('daemon.clients')
+
+    def client_disconnected(self, client):
+        self.__lock.acquire()
+        if client in self.clients:
+            self.clients.remove(client)
+        self.__lock.release()
+
+    def tickers(self):
+        """
+        Return every ticker any client is subscribed to.
+        """
+
+        self.__lock.acquire()
+        tickers = set()
+        for c in self.clients:
+            tickers |= c.tickers
+        self.__lock.release()
+
+        return sorted(tickers)
+
+    def subscribed(self, client):
+        """
+        A client changed its subscription: send it the snapshot of what we
+        have and go and get what we don't.
+        """
+
+        snapshot = dict()
+        missing = set()
+
+        for t in client.tickers:
+            data = Stock(t).cached_data()
+            if data:
+                snapshot[t] = data
+            else:
+                missing.add(t)
+
+        client.send(MSG_QUOTES, snapshot)
+
+        if missing:
+            self.__lock.acquire()
+            self.missing |= missing
+            self.__lock.release()
+            self.__wake.set()
+
+    def __broadcast(self, changes):
+        """
+        Change feed subscriber: push each client the changed quotes it's
+        subscribed to.
+        """
+
+        self.__lock.acquire()
+        clients = list(self.clients)
+        self.__lock.release()
+
+        for c in clients:
+            quotes = dict()
+            for t in c.tickers:
+                if t in changes:
+                    quotes[t] = Stock(t).cached_data()
+
+            if quotes:
+                c.send(MSG_QUOTES, quotes)
+
+    def poll(self, tickers=None):
+        """
+        Fetch tickers (by default everything subscribed to) from the provider
+        and push out whatever changed.
+        """
+
+        if tickers is None:
+            tickers = self.tickers()
+
+        if not tickers:
+            return
+
+        for i in range(0, len(tickers), BATCH_SIZE):
+            try:
+                quotes = st_query_batch(tickers[i:i + BATCH_SIZE])
+            except (IOError, ValueError):
+                st_stats_count('daemon.poll_errors')
+                continue
+
+            for symb in quotes.keys():
+                Stock.set_data(symb, quotes[symb])
+
+        self.polls += 1
+        st_stats_count('daemon.polls')
+
+        self.feed.publish()
+
+    def __run(self):
+        next_poll = 0
+
+        while not self.__die:
+            self.__lock.acquire()
+            missing = sorted(self.missing)
+            self.missing = set()
+            self.__lock.release()
+
+            if time.time() >= next_poll:
+                self.poll()
+                next_poll = time.time() + self.interval
+            elif missing:
+                self.poll(missing)
+
+            self.__wake.wait(max(0.0, next_poll - time.time()))
+            self.__wake.clear()
+
+    def start(self):
+        """
+        Start polling and serving clients in background threads.
+        """
+
+        self.__die = False
+
+        self.__poller = threading.Thread(target=self.__run)
+        self.__poller.daemon = True
+        self.__poller.start()
+
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__die = True
+        self.__wake.set()
+
+        self.shutdown()
+        self.server_close()
+        self.feed.close()
+
+        # Hang up on everyone so their handler threads finish.
+        self.__lock.acquire()
+        clients = list(self.clients)
+        self.__lock.release()
+
+        for c in clients:
+            try:
+                c.request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        for t in (self.__poller, self.__thread):
+            if t:
+                t.join()
+        self.__poller = None
+        self.__thread = None
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class DaemonClient(object):
+    """
+    st side of the daemon: subscribes to a set of tickers and puts the quotes
+    the daemon pushes into the Stock cache. Looks like a QuoteStream to the
+    rest of st.
+    """
+
+    def __init__(self, path, tickers=list(), retry_interval=1.0):
+        self.path           = path
+        self.tickers        = list(tickers)
+        self.retry_interval = retry_interval
+
+        # Set whenever quotes land in the cache.
+        self.updated        = threading.Event()
+
+        self.__die          = False
+        self.__sock         = None
+        self.__lock         = threading.Lock()
+        self.__thread       = None
+
+    def set_tickers(self, tickers):
+        """
+        Change the set of tickers we are subscribed to.
+        """
+
+        self.__lock.acquire()
+
+        self.tickers = list(tickers)
+        if self.__sock:
+            try:
+                send_frame(self.__sock, MSG_SUBSCRIBE, self.tickers)
+            except socket.error:
+                pass
+
+        self.__lock.release()
+
+    def start(self):
+        if self.__thread:
+            return
+
+        self.__die = False
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__die = True
+
+        sock = self.__sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def streaming(self):
+        """
+        Returns True if we are connected to the daemon.
+        """
+
+        return self.__sock is not None
+
+    def __run(self):
+        while not self.__die:
+            try:
+                self.__read_daemon()
+            except (socket.error, ValueError):
+                pass
+
+            # Daemon not running (yet) or went away; keep trying.
+            waited = 0
+            while waited < self.retry_interval and not self.__die:
+                time.sleep(.1)
+                waited += .1
+
+    def __read_daemon(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+
+        self.__lock.acquire()
+        send_frame(sock, MSG_SUBSCRIBE, self.tickers)
+        self.__sock = sock
+        self.__lock.release()
+
+        f = sock.makefile('rb')
+
+        try:
+            while not self.__die:
+                frame = read_frame(f)
+                if not frame:
+                    break
+
+                kind, quotes = frame
+                if kind != MSG_QUOTES:
+                    continue
+
+                for symb in quotes.keys():
+                    Stock.set_data(symb, quotes[symb])
+
+                if quotes:
+                    self.updated.set()
+        finally:
+            self.__lock.acquire()
+            self.__sock = None
+            self.__lock.release()
+
+            f.close()
+            sock.close()
+
+def main(args):
+    """
+    Usage: st_daemon.py <socket path> [poll interval]
+    """
+
+    if len(args) < 2:
+        print 'Usage: %s <socket path> [poll interval]' % args[0]
+        return 1
+
+    interval = 15.0
+    if len(args) > 2:
+        interval = float(args[2])
+
+    daemon = QuoteDaemon(args[1], interval)
+    daemon.start()
+
+    print 'Serving quotes on %s, polling every %.1fs' % (args[1], interval)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+
+    daemon.stop()
+
+    print 'Did %d polls' % daemon.polls
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
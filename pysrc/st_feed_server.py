@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+#
+# A local stand-in for a push quote feed. Replays recorded ticks over SSE in
+# the format st_stream.QuoteStream expects, so streaming can be tested (and
+# load tested) without touching the real provider.
+#
+# Ticks are read from a file with one JSON quote delta per line, f.e:
+#
+#   {"symbol": "NVDA", "latestPrice": 231.40, "change": 1.20}
+#   {"symbol": "AMD", "latestPrice": 101.02}
+#
+# Blank lines and lines starting with '#' are ignored.
+#
+
+import sys
+import json
+import time
+import threading
+import urlparse
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer   import ThreadingMixIn
+
+def load_ticks(file_path):
+    """
+    Load recorded ticks from a file. Returns a list of (symbol, data) pairs
+    where data is the raw JSON line.
+    """
+
+    ticks = list()
+
+    for line in open(file_path):
+        line = line.strip()
+
+        if line == '' or line[0] == '#':
+            continue
+
+        ticks.append((json.loads(line)['symbol'], line))
+
+    return ticks
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves one subscriber. Each tick gets an id equal to its position in the
+    replay (counting across loops) so a reconnecting client can resume with
+    Last-Event-ID.
+    """
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+    # Subscribers hanging up mid replay is normal; don't complain when the
+    # unflushed tail of the replay can't be written.
+    def handle(self):
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except IOError:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except IOError:
+            pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+
+        symbols = None
+        if 'symbols' in query:
+            symbols = set(query['symbols'][0].split(','))
+
+        start = 0
+        last_id = self.headers.getheader('Last-Event-ID')
+        if last_id:
+            try:
+                start = int(last_id) + 1
+            except ValueError:
+                pass
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        self.server.client_connected()
+
+        try:
+            self.__replay(start, symbols)
+        except IOError:
+            # Client went away.
+            pass
+        finally:
+            self.server.client_disconnected()
+
+    def __replay(self, start, symbols):
+        ticks = self.server.ticks
+        nr = len(ticks)
+        delay = 0.0
+        if self.server.rate > 0:
+            delay = 1.0 / self.server.rate
+
+        tick_id = start
+
+        # Nothing to replay, however many times round.
+        if nr == 0:
+            return
+
+        while not self.server.stopping:
+            if tick_id >= nr and not self.server.loop:
+                break
+
+            symb, data = ticks[tick_id % nr]
+
+            if symbols is None or symb in symbols:
+                self.wfile.write('id: %d\ndata: %s\n\n' % (tick_id, data))
+                self.wfile.flush()
+                self.server.count_tick()
+
+            tick_id += 1
+
+            if delay:
+                time.sleep(delay)
+
+class FeedServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server replaying ticks to any number of subscribers.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, ticks, rate=10.0, loop=False, verbose=False):
+        """
+        Serve ticks on address, a (host, port) pair. Port 0 picks a free
+        port; check server_address after construction to find it.
+
+        rate is ticks sent per second to each client; 0 sends as fast as
+        possible. If loop is set the replay wraps around forever.
+        """
+
+        HTTPServer.__init__(self, address, FeedHandler)
+
+        self.ticks    = ticks
+        self.rate     = rate
+        self.loop     = loop
+        self.verbose  = verbose
+        self.stopping = False
+
+        self.clients  = 0
+        self.sent     = 0
+        self.__lock   = threading.Lock()
+        self.__thread = None
+
+    def client_connected(self):
+        self.__lock.acquire()
+        self.clients += 1
+        self.__lock.release()
+
+    def client_disconnected(self):
+        self.__lock.acquire()
+        self.clients -= 1
+        self.__lock.release()
+
+    def count_tick(self):
+        self.__lock.acquire()
+        self.sent += 1
+        self.__lock.release()
+
+    def url(self):
+        """
+        The URL a QuoteStream should use to reach this server.
+        """
+
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        """
+        Serve in a background thread.
+        """
+
+        self.__thread = threading.Thread(target=self.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop serving. Active replays end at their next tick.
+        """
+
+        self.stopping = True
+        self.shutdown()
+        self.server_close()
+
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+def main(args):
+    """
+    Usage: st_feed_server.py <ticks file> [port] [rate] [loop]
+    """
+
+    if len(args) < 2:
+        print 'Usage: %s <ticks file> [port] [rate] [loop]' % args[0]
+        return 1
+
+    port = 8765
+    rate = 10.0
+    loop = False
+
+    if len(args) > 2:
+        port = int(args[2])
+    if len(args) > 3:
+        rate = float(args[3])
+    if len(args) > 4:
+        loop = args[4] == 'loop'
+
+    server = FeedServer(('127.0.0.1', port), load_ticks(args[1]),
+                        rate=rate, loop=loop, verbose=True)
+
+    print 'Replaying %d ticks at %s' % (len(server.ticks), server.url())
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    print 'Sent %d ticks' % server.sent
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
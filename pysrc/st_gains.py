@@ -0,0 +1,128 @@
+#
+# Realized and unrealized gains. Every time a sell takes shares out of a lot
+# a Relief is recorded: what the shares cost, what they sold for and how long
+# they were held. A GainLedger keeps running totals of those by ticker and by
+# year, along with the shares still held and what they cost, so that gains
+# can be reported without going back over the lots.
+#
+# Everything here can be taken back out again (see Portfolio's
+# insert_transaction(), which rewinds to the date of the new transaction and
+# replays from there).
+#
+
+from st_ledger import long_term
+
+class Relief(object):
+    """
+    nr shares of ticker, bought on acquired for cost in total, sold on sold
+    for proceeds. sources are the ledger lines of the buys they came from.
+    """
+
+    def __init__(self, ticker, acquired, sold, nr, cost, proceeds,
+                 sources=list()):
+        self.ticker    = ticker
+        self.acquired  = acquired
+        self.sold      = sold
+        self.nr        = nr
+        self.cost      = cost
+        self.proceeds  = proceeds
+        self.sources   = list(sources)
+
+        self.gain      = proceeds - cost
+        self.days      = (sold - acquired).days
+        self.long_term = long_term(acquired, sold)
+
+    def __repr__(self):
+        return '<Relief %s %g %s..%s $%.2f>' % (self.ticker, self.nr,
+                                                self.acquired.date(),
+                                                self.sold.date(), self.gain)
+
+class GainLedger(object):
+    """
+    Running totals. Realized gains are kept by ticker and by the year of
+    the sale, split into short and long term. Shares still held are kept as
+    (nr, cost) by ticker and year bought, which is all unrealized gains need
+    besides a price.
+    """
+
+    def __init__(self):
+        self.realized_by_ticker = dict()    # Ticker -> gain.
+        self.realized_by_year   = dict()    # Year -> [ short, long ].
+        self.held               = dict()    # (Ticker, year) -> [ nr, cost ].
+
+    def bought(self, ticker, date, nr, cost):
+        """
+        Shares were bought (or, with negative nr and cost, the buy was taken
+        back).
+        """
+
+        key = (ticker, date.year)
+
+        held = self.held.get(key)
+        if held is None:
+            held = [ 0.0, 0.0 ]
+            self.held[key] = held
+
+        held[0] += nr
+        held[1] += cost
+
+        if held[0] < 1e-9:
+            del self.held[key]
+
+    def relieved(self, relief, sign=1):
+        """
+        Count relief. Pass sign=-1 to take it back out.
+        """
+
+        gain = relief.gain * sign
+
+        self.realized_by_ticker[relief.ticker] = \
+            self.realized_by_ticker.get(relief.ticker, 0.0) + gain
+
+        year = self.realized_by_year.get(relief.sold.year)
+        if year is None:
+            year = [ 0.0, 0.0 ]
+            self.realized_by_year[relief.sold.year] = year
+        year[int(relief.long_term)] += gain
+
+        self.bought(relief.ticker, relief.acquired, -relief.nr * sign,
+                    -relief.cost * sign)
+
+    def realized(self, ticker=None, year=None):
+        """
+        Realized gain, for ticker or year if passed, otherwise in total.
+        """
+
+        if ticker is not None:
+            return self.realized_by_ticker.get(ticker, 0.0)
+
+        if year is not None:
+            return sum(self.realized_by_year.get(year, [ 0.0 ]))
+
+        return sum(self.realized_by_ticker.values())
+
+    def short_long(self, year):
+        """
+        Return the (short term, long term) realized gain for year.
+        """
+
+        return tuple(self.realized_by_year.get(year, [ 0.0, 0.0 ]))
+
+    def unrealized(self, prices, by_year=False):
+        """
+        Unrealized gains at prices (a dict of ticker -> price), by ticker or,
+        if by_year is set, by the year the shares were bought. Tickers
+        without a price are left out.
+        """
+
+        gains = dict()
+
+        for (ticker, year), (nr, cost) in self.held.items():
+            price = prices.get(ticker)
+            if price is None:
+                continue
+
+            key = year if by_year else ticker
+            gains[key] = gains.get(key, 0.0) + nr * price - cost
+
+        return gains
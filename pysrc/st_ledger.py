@@ -0,0 +1,253 @@
+#
+# Ledger parsing. Turns the lines of a portfolio file into transactions; see
+# Portfolio for the file format. For very large ledgers there's a bulk
+# loader that memory maps the file and parses line aligned chunks of it in
+# parallel worker processes.
+#
+
+import os
+import mmap
+import multiprocessing
+
+from datetime import datetime
+
+# Transaction types.
+BUY       = 'BUY'
+SELL      = 'SELL'
+DEPOSIT   = 'DEPOSIT'
+WITHDRAWL = 'WITHDRAWL'
+
+DATE_FORMAT = '%b %d, %Y'
+
+# Files smaller than this aren't worth starting worker processes for.
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+
+class LedgerError(ValueError):
+    """
+    A line of a ledger that can't be parsed. If known, line_no is the 1 based
+    line number in the file.
+    """
+
+    def __init__(self, msg, line_no=None):
+        ValueError.__init__(self, msg)
+
+        self.msg     = msg
+        self.line_no = line_no
+
+    def __str__(self):
+        if self.line_no is None:
+            return self.msg
+
+        return 'line %d: %s' % (self.line_no, self.msg)
+
+# Parsed dates, by date string. Ledgers repeat dates a lot and strptime is
+# slow, so each process remembers what it has already parsed.
+__date_cache = dict()
+
+def parse_date(date_str):
+    """
+    Parse a ledger date, going through the date cache.
+    """
+
+    date = __date_cache.get(date_str)
+
+    if date is None:
+        date = datetime.strptime(date_str, DATE_FORMAT)
+        __date_cache[date_str] = date
+
+    return date
+
+def long_term(bought, sold):
+    """
+    Returns True if shares bought on bought and sold on sold were held for
+    more than a year.
+    """
+
+    try:
+        anniversary = bought.replace(year=bought.year + 1)
+    except ValueError:
+        # Bought on Feb 29th.
+        anniversary = bought.replace(year=bought.year + 1, month=3, day=1)
+
+    return sold > anniversary
+
+def parse_ledger_line(line):
+    """
+    Parse a single ledger line. Returns None for blank lines and comments,
+    otherwise a transaction tuple:
+
+      (tr_type, date, quantity, ticker, price, comment)
+
+    ticker and price are None for deposits and withdrawls. Raises a
+    LedgerError if the line doesn't make sense.
+    """
+
+    line = line.strip()
+
+    if line == '' or line[0] == '#':
+        return None
+
+    # The first bit of the string is the date. Split on the '|' to get the
+    # date bit.
+    if '|' not in line:
+        raise LedgerError('Bad data line: "%s"' % line)
+
+    (date_str, tr_data) = line.split('|', 1)
+
+    try:
+        date = parse_date(date_str.strip())
+    except ValueError:
+        raise LedgerError('Bad date: "%s"' % date_str.strip())
+
+    # Now split off a comment, in case one is there
+    if '#' in tr_data:
+        tr_data, comment = tr_data.split('#', 1)
+    else:
+        comment = ''
+
+    # And now split the tr_data into items and parse them.
+    tr_items = tr_data.split()
+
+    try:
+        # This is a deposit/withdrawl.
+        if len(tr_items) == 2:
+            if tr_items[0] in (DEPOSIT, WITHDRAWL):
+                return (tr_items[0], date, float(tr_items[1]), None, None,
+                        comment)
+
+        # Looks like we might have a stock trade.
+        elif len(tr_items) == 4:
+            if tr_items[0] in (BUY, SELL):
+                return (tr_items[0], date, float(tr_items[1]), tr_items[2],
+                        float(tr_items[3]), comment)
+        else:
+            raise LedgerError('Bad data line: "%s"' % line)
+    except ValueError, e:
+        if isinstance(e, LedgerError):
+            raise
+        raise LedgerError('Bad number: "%s"' % line)
+
+    raise LedgerError('Unrecognized transaction type: %s' % tr_items[0])
+
+def __parse_chunk(args):
+    """
+    Worker side of the bulk loader: parse the lines in [start, end) of the
+    file. Returns (nr of lines, transactions, errors) where transactions is a
+    list of (line number, transaction) pairs and errors a list of (line
+    number, message) pairs, line numbers being relative to the start of the
+    chunk.
+    """
+
+    file_path, start, end = args
+
+    f = open(file_path, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    mm.seek(start)
+
+    trs = list()
+    errors = list()
+    nr = 0
+
+    while mm.tell() < end:
+        line = mm.readline()
+        nr += 1
+
+        try:
+            tr = parse_ledger_line(line)
+        except LedgerError, e:
+            errors.append((nr, e.msg))
+            continue
+
+        if tr:
+            trs.append((nr, tr))
+
+    mm.close()
+    f.close()
+
+    return (nr, trs, errors)
+
+def ledger_chunks(file_path, nr_chunks):
+    """
+    Split the file into about nr_chunks (start, end) byte ranges, each of
+    which starts at the beginning of a line and ends just after a newline
+    (or at the end of the file).
+    """
+
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return list()
+
+    f = open(file_path, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    step = max(1, size / nr_chunks)
+    chunks = list()
+    start = 0
+
+    while start < size:
+        end = mm.find('\n', min(start + step, size - 1))
+        if end < 0:
+            end = size
+        else:
+            end += 1
+
+        chunks.append((start, end))
+        start = end
+
+    mm.close()
+    f.close()
+
+    return chunks
+
+def load_ledger(file_path, errors, workers=None, progress=None,
+                line_numbers=False):
+    """
+    Parse a whole ledger file in parallel worker processes, yielding the
+    transactions in file order. Lines that can't be parsed don't stop the
+    load: a LedgerError with the line number is appended to the passed
+    errors list for each.
+
+    If line_numbers is set (line number, transaction) pairs are yielded
+    instead, line numbers being 1 based.
+
+    workers defaults to the number of CPUs. progress, if passed, is called
+    as progress(bytes_parsed, total_bytes) as chunks complete.
+    """
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+
+    # A few chunks per worker keeps them all busy even if some chunks are
+    # slower to parse than others.
+    chunks = ledger_chunks(file_path, workers * 4)
+    total = os.path.getsize(file_path)
+
+    pool = multiprocessing.Pool(workers)
+
+    try:
+        line_base = 0
+        done = 0
+
+        # imap hands results back in chunk order, so the transactions come
+        # out in file order and the BUY/SELL replay stays correct.
+        results = pool.imap(__parse_chunk,
+                            [ (file_path, s, e) for s, e in chunks ])
+
+        for i, (nr, trs, errs) in enumerate(results):
+            for line_no, msg in errs:
+                errors.append(LedgerError(msg, line_base + line_no))
+
+            for line_no, tr in trs:
+                if line_numbers:
+                    yield (line_base + line_no, tr)
+                else:
+                    yield tr
+
+            line_base += nr
+            done += chunks[i][1] - chunks[i][0]
+
+            if progress:
+                progress(done, total)
+    finally:
+        pool.terminate()
+        pool.join()
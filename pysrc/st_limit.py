@@ -0,0 +1,273 @@
+#
+# Tools for keeping quote fetches polite: a token bucket rate limiter that
+# queues callers by priority, single-flight coalescing so concurrent
+# fetches of the same thing share one request, and a fetch queue that hands
+# out the stocks on screen before the ones that aren't.
+#
+
+import time
+import heapq
+import threading
+
+from st_stats import st_stats_record
+
+# Priorities for queued requests. Lower goes first.
+PRIORITY_HIGH   = 0     # Someone is staring at the screen waiting for this.
+PRIORITY_NORMAL = 1     # Periodic refreshes.
+PRIORITY_LOW    = 2     # Background work nobody is waiting on.
+
+# Where a stock is relative to the screen, for ordering a refresh. Lower goes
+# first.
+TIER_VISIBLE    = 0     # Drawn right now.
+TIER_NEARBY     = 1     # Next in the current sort order, just off screen.
+TIER_REST       = 2     # Everything else.
+
+class TokenBucket(object):
+    """
+    A token bucket: tokens accrue at rate per second up to burst. Each request
+    takes one token. Callers that can't get a token wait in a queue ordered
+    by priority (then arrival) - nothing is ever dropped. A waiter queued
+    with a key can be moved up later with promote().
+    """
+
+    def __init__(self, rate, burst):
+        self.rate    = float(rate)
+        self.burst   = float(burst)
+        self.tokens  = float(burst)
+        self.stamp   = time.time()
+
+        self.__cond  = threading.Condition(threading.Lock())
+        self.__queue = list()
+        self.__seq   = 0
+        self.__keys  = dict()   # Key -> queued [ priority, seq ] entry.
+
+    def set_rate(self, rate, burst):
+        """
+        Change the budget. Waiters pick up the new rate straight away.
+        """
+
+        self.__cond.acquire()
+        self.__refill()
+        self.rate   = float(rate)
+        self.burst  = float(burst)
+        self.tokens = min(self.tokens, self.burst)
+        self.__cond.notify_all()
+        self.__cond.release()
+
+    def __refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def waiting(self):
+        """
+        Return how many callers are queued for a token.
+        """
+
+        return len(self.__queue)
+
+    def acquire(self, priority=PRIORITY_NORMAL, key=None):
+        """
+        Take a token, waiting for one if need be. Returns the number of
+        seconds spent waiting. If key is given, promote() can raise the
+        priority of this wait while it's queued.
+        """
+
+        start = time.time()
+
+        self.__cond.acquire()
+
+        self.__seq += 1
+        me = [ priority, self.__seq ]
+        heapq.heappush(self.__queue, me)
+
+        if key is not None:
+            self.__keys[key] = me
+
+        while True:
+            self.__refill()
+
+            if self.__queue[0] is me and self.tokens >= 1.0:
+                heapq.heappop(self.__queue)
+                self.tokens -= 1.0
+
+                if key is not None and self.__keys.get(key) is me:
+                    del self.__keys[key]
+
+                # Let the next in line have a look.
+                self.__cond.notify_all()
+                break
+
+            # Sleep until the next token should be ready; anyone getting a
+            # token or changing the rate wakes us up sooner.
+            wait = None
+            if self.rate > 0:
+                wait = max(0.001, (1.0 - self.tokens) / self.rate)
+
+            self.__cond.wait(wait)
+
+        self.__cond.release()
+
+        return time.time() - start
+
+    def promote(self, key, priority):
+        """
+        If a caller is queued with key, make it wait at priority from now on
+        (if that's sooner than it already was). Returns True if it was moved.
+        """
+
+        self.__cond.acquire()
+
+        me = self.__keys.get(key)
+        moved = me is not None and priority < me[0]
+        if moved:
+            me[0] = priority
+            heapq.heapify(self.__queue)
+            self.__cond.notify_all()
+
+        self.__cond.release()
+
+        return moved
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls by key. The first caller for a key does the
+    work; anyone asking for the same key while it's running waits and gets
+    the same result (or exception).
+
+    on_join, if given, is called as on_join(key, *args, **kwargs) with the
+    arguments of each caller that joins a call already in flight, so that
+    the running call can be told about them (a more urgent priority, say).
+    """
+
+    class Call(object):
+        def __init__(self):
+            self.done   = threading.Event()
+            self.result = None
+            self.error  = None
+
+    def __init__(self, on_join=None):
+        self.__lock     = threading.Lock()
+        self.__calls    = dict()
+        self.__on_join  = on_join
+
+        # How many calls were answered by someone else's call.
+        self.coalesced  = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) unless a call for key is already in flight,
+        in which case wait for that one and return its result.
+        """
+
+        self.__lock.acquire()
+
+        call = self.__calls.get(key)
+        if call:
+            self.coalesced += 1
+            self.__lock.release()
+
+            if self.__on_join:
+                self.__on_join(key, *args, **kwargs)
+
+            call.done.wait()
+            if call.error:
+                raise call.error
+
+            return call.result
+
+        call = SingleFlight.Call()
+        self.__calls[key] = call
+        self.__lock.release()
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            self.__lock.acquire()
+            del self.__calls[key]
+            self.__lock.release()
+
+            call.done.set()
+
+        return call.result
+
+    def in_flight(self):
+        """
+        Return how many distinct keys are currently being fetched.
+        """
+
+        return len(self.__calls)
+
+class FetchQueue(object):
+    """
+    The stocks a refresh still has to fetch, handed out by tier (a dict of
+    ticker -> TIER_*, anything missing being TIER_REST) and in their original
+    order within a tier.
+
+    The view can change while a refresh is under way; set_tiers() reorders
+    whatever hasn't been handed out yet.
+    """
+
+    def __init__(self, stocks, tiers=None):
+        self.stocks  = list(stocks)
+        self.start   = time.time()
+
+        self.__lock  = threading.Lock()
+        self.__heap  = list()
+
+        # Whether there were any visible stocks, and whether they have all
+        # been seen to.
+        self.__shown = False
+        self.__done  = False
+
+        self.__fill(range(0, len(self.stocks)), tiers or dict())
+
+    def __fill(self, indexes, tiers):
+        self.__heap = [ (tiers.get(self.stocks[i].ticker, TIER_REST), i)
+                        for i in indexes ]
+        heapq.heapify(self.__heap)
+
+        for t, _ in self.__heap:
+            if t == TIER_VISIBLE:
+                self.__shown = True
+                break
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def set_tiers(self, tiers):
+        """
+        Reorder the stocks not handed out yet for a new view.
+        """
+
+        self.__lock.acquire()
+        self.__fill([ i for _, i in self.__heap ], tiers)
+        self.__lock.release()
+
+    def take(self, nr=1):
+        """
+        Hand out up to nr stocks, most wanted first. Returns an empty list
+        once everything has been handed out.
+        """
+
+        self.__lock.acquire()
+
+        # Once nothing visible is left the callers have fetched everything
+        # that is on screen: that's what the user was waiting for.
+        if self.__shown and not self.__done and \
+           (not self.__heap or self.__heap[0][0] != TIER_VISIBLE):
+            self.__done = True
+            st_stats_record('refresh.visible',
+                            (time.time() - self.start) * 1000.0)
+
+        taken = list()
+        while self.__heap and len(taken) < nr:
+            taken.append(self.stocks[heapq.heappop(self.__heap)[1]])
+
+        self.__lock.release()
+
+        return taken
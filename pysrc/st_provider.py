@@ -0,0 +1,305 @@
+#
+# Quote providers. st can be pointed at several providers speaking the same
+# API; each one has a circuit breaker so a provider that keeps failing is
+# left alone for a while, and requests are hedged: if the first provider
+# hasn't answered by its usual p95 latency the same request goes to the next
+# one and whichever answers first wins.
+#
+
+import json
+import time
+import zlib
+import Queue
+import urlparse
+import threading
+
+from st_stats import Histogram, st_stats_count, st_stats_record
+
+# Until a provider has this many latency samples its p95 means nothing, so
+# hedge after DEFAULT_HEDGE_DELAY seconds instead.
+MIN_HEDGE_SAMPLES   = 20
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_DELAY     = 0.05
+
+class ProviderError(IOError):
+    """
+    No provider could answer a request.
+    """
+
+    pass
+
+class Provider(object):
+    """
+    One quote provider at url, with a circuit breaker:
+
+      closed    - all is well, requests go through.
+      open      - max_failures requests in a row failed. Nothing is sent to
+                  the provider for reset_timeout seconds.
+      half-open - the timeout ran out. A single trial request is let through;
+                  if it works the breaker closes again, otherwise it reopens.
+    """
+
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, url, name=None, max_failures=3, reset_timeout=30.0,
+                 timeout=10.0):
+        """
+        timeout is how long, in seconds, a single request may take before it
+        counts as failed.
+        """
+
+        if not url.endswith('/'):
+            url += '/'
+
+        self.url           = url
+        self.name          = name or urlparse.urlparse(url).netloc or url
+        self.max_failures  = max_failures
+        self.reset_timeout = reset_timeout
+        self.timeout       = timeout
+
+        self.state         = Provider.CLOSED
+        self.failures      = 0
+        self.opened        = 0
+        self.trial         = False
+        self.latency       = Histogram()
+
+        # For conditional requests: (path, params) -> (ETag, Last-Modified,
+        # decoded JSON) of the last good answer.
+        self.validators    = dict()
+
+        self.__lock        = threading.Lock()
+
+    def up(self):
+        """
+        Returns False if the breaker is open. No side effects.
+        """
+
+        return self.state != Provider.OPEN
+
+    def allow(self):
+        """
+        Ask the breaker whether a request may be sent now. A True from a
+        half-open breaker hands out its one trial request, so only call this
+        when actually about to send, and report back with success() or
+        failure().
+        """
+
+        self.__lock.acquire()
+
+        if self.state == Provider.OPEN and \
+           time.time() - self.opened >= self.reset_timeout:
+            self.state = Provider.HALF_OPEN
+            self.trial = False
+
+        ok = self.state == Provider.CLOSED
+        if self.state == Provider.HALF_OPEN and not self.trial:
+            self.trial = True
+            ok = True
+
+        self.__lock.release()
+
+        return ok
+
+    def success(self, ms):
+        self.__lock.acquire()
+        self.latency.add(ms)
+        self.failures = 0
+        self.state    = Provider.CLOSED
+        self.trial    = False
+        self.__lock.release()
+
+    def failure(self):
+        self.__lock.acquire()
+
+        self.failures += 1
+        if self.state == Provider.HALF_OPEN or \
+           self.failures >= self.max_failures:
+            if self.state != Provider.OPEN:
+                st_stats_count('provider.tripped')
+            self.state  = Provider.OPEN
+            self.opened = time.time()
+            self.trial  = False
+
+        self.__lock.release()
+
+    def hedge_delay(self):
+        """
+        How long to give this provider before hedging, in seconds.
+        """
+
+        if self.latency.nr < MIN_HEDGE_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+
+        return max(MIN_HEDGE_DELAY, self.latency.percentile(95) / 1000.0)
+
+    def get(self, path, params=None):
+        """
+        GET path from the provider and return the decoded JSON. Raises on
+        any failure, including HTTP errors.
+
+        Responses are asked for compressed, and if the provider gave us an
+        ETag or Last-Modified for the same request before we send them back:
+        a 304 reuses the answer we already have. Bytes on the wire, bytes
+        after decompression and 304s are counted in the query.* stats.
+        """
+
+        import requests
+
+        key = (path, tuple(sorted((params or dict()).items())))
+        have = self.validators.get(key)
+
+        headers = { 'Accept-Encoding' : 'gzip, deflate' }
+        if have:
+            if have[0]:
+                headers['If-None-Match'] = have[0]
+            if have[1]:
+                headers['If-Modified-Since'] = have[1]
+
+        req = requests.get(self.url + path, params=params, headers=headers,
+                           timeout=self.timeout, stream=True)
+
+        # Read the body as it came over the wire so we can count it, and
+        # decompress it ourselves.
+        raw = req.raw.read(decode_content=False)
+        st_stats_count('query.bytes', len(raw))
+
+        if req.status_code == 304:
+            # Not modified since an answer we never had is no answer at all.
+            if not have:
+                raise ProviderError('%s answered 304 to an unconditional '
+                                    'request' % self.name)
+
+            st_stats_count('query.not_modified')
+            return have[2]
+
+        req.raise_for_status()
+
+        encoding = req.headers.get('Content-Encoding', '')
+        if encoding == 'gzip':
+            raw = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            try:
+                raw = zlib.decompress(raw)
+            except zlib.error:
+                raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+        st_stats_count('query.bytes.decoded', len(raw))
+
+        obj = json.loads(raw)
+
+        etag = req.headers.get('ETag')
+        modified = req.headers.get('Last-Modified')
+        if etag or modified:
+            self.validators[key] = (etag, modified, obj)
+
+        return obj
+
+class ProviderSet(object):
+    """
+    An ordered list of providers, most preferred first.
+    """
+
+    def __init__(self, providers):
+        self.providers = list(providers)
+
+    def nr_up(self):
+        """
+        Return how many providers don't have their breaker open.
+        """
+
+        return len([ p for p in self.providers if p.up() ])
+
+    def __attempt(self, p, path, params, results):
+        start = time.time()
+
+        try:
+            obj = p.get(path, params)
+        except Exception, e:
+            p.failure()
+            st_stats_count('provider.errors')
+            results.put((p, None, e))
+            return
+
+        ms = (time.time() - start) * 1000.0
+        p.success(ms)
+        st_stats_record('provider.' + p.name, ms)
+        results.put((p, obj, None))
+
+    def __launch(self, tried, path, params, results):
+        """
+        Send the request to the first provider not yet tried whose breaker
+        lets it through. Returns that provider, or None.
+        """
+
+        for p in self.providers:
+            if p in tried or not p.allow():
+                continue
+
+            tried.append(p)
+
+            t = threading.Thread(target=self.__attempt,
+                                 args=(p, path, params, results))
+            t.daemon = True
+            t.start()
+
+            return p
+
+        return None
+
+    def get(self, path, params=None):
+        """
+        GET path, failing over and hedging across the providers. Returns the
+        decoded JSON of the first good answer; raises ProviderError if every
+        provider failed or was unavailable.
+
+        Requests that lose a hedge are left to finish in the background so
+        their latency still counts towards their provider's health.
+        """
+
+        results = Queue.Queue()
+        tried = list()
+        error = None
+
+        p = self.__launch(tried, path, params, results)
+        if not p:
+            raise ProviderError('No quote provider available')
+
+        outstanding = 1
+        hedge_at = time.time() + p.hedge_delay()
+
+        while outstanding:
+            wait = None
+            if hedge_at:
+                wait = max(0.0, hedge_at - time.time())
+
+            try:
+                p, obj, err = results.get(True, wait)
+            except Queue.Empty:
+                # The last provider we sent to is slow. Only hedge once; if
+                # the hedge is slow as well just wait for whoever is first.
+                hedge_at = None
+                if self.__launch(tried, path, params, results):
+                    st_stats_count('provider.hedged')
+                    outstanding += 1
+                continue
+
+            outstanding -= 1
+
+            if err is None:
+                if p is not tried[0]:
+                    st_stats_count('provider.fallback_won')
+                return obj
+
+            error = err
+
+            # Fail over straight away rather than waiting to hedge.
+            q = self.__launch(tried, path, params, results)
+            if q:
+                st_stats_count('provider.failover')
+                outstanding += 1
+                if hedge_at:
+                    hedge_at = time.time() + q.hedge_delay()
+
+        raise ProviderError('All quote providers failed, last error: %s' %
+                            error)
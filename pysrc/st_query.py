@@ -2,20 +2,121 @@
 # Implement routines for querying the alphavantage stock data base.
 #
 
-import requests
-import json
+from st_stats    import timed, st_stats_count, st_stats_record
+from st_limit    import TokenBucket, PRIORITY_NORMAL, PRIORITY_LOW
+from st_provider import Provider, ProviderSet
 
+# The default provider, used unless st_query_set_providers() says otherwise.
 API_URL = 'https://api.iextrading.com/1.0/'
 
-def st_query_quote(stock):
+# Where quotes come from: a ProviderSet, most preferred provider first. Made
+# from API_URL the first time it's needed.
+st_query_providers = None
+
+# The quote fields st actually uses. Providers are asked for just these
+# rather than the whole quote.
+QUOTE_FIELDS = [ 'symbol', 'companyName', 'latestPrice', 'change',
+                 'changePercent', 'open', 'avgTotalVolume', 'latestVolume' ]
+
+# Request budget for the provider, shared by every caller in the process.
+# Callers over budget queue up by priority.
+st_query_limiter = TokenBucket(10.0, 20.0)
+
+def st_query_set_budget(rate, burst):
+    """
+    Set the provider request budget: rate requests per second with bursts of
+    up to burst requests.
+    """
+
+    st_query_limiter.set_rate(rate, burst)
+
+def st_query_set_providers(urls):
+    """
+    Get quotes from the providers at the given API urls, in order of
+    preference. Requests fail over and are hedged between them.
+    """
+
+    global st_query_providers
+
+    st_query_providers = ProviderSet([ Provider(u) for u in urls ])
+
+def st_query_providers_up():
+    """
+    Returns (providers up, providers) for showing provider health.
+    """
+
+    p = __st_query_provider_set()
+
+    return (p.nr_up(), len(p.providers))
+
+def __st_query_provider_set():
+    global st_query_providers
+
+    if st_query_providers is None:
+        st_query_providers = ProviderSet([ Provider(API_URL) ])
+
+    return st_query_providers
+
+def __st_query_get(path, params=None):
+    return __st_query_provider_set().get(path, params)
+
+def __st_query_wait(priority, key=None):
+    waited = st_query_limiter.acquire(priority, key)
+    st_stats_record('query.limiter_wait', waited * 1000.0)
+
+def st_query_promote(stock, priority):
+    """
+    If a quote request for stock is queued for the request budget, have it
+    wait at priority from now on, if that's more urgent.
+    """
+
+    st_query_limiter.promote(stock, priority)
+
+@timed('query.quote')
+def st_query_quote(stock, priority=PRIORITY_NORMAL):
+    """
+    Query information about a stock. Waits for the request budget first;
+    priority is one of the st_limit PRIORITY_* values.
     """
-    Query information about a stock.
+
+    __st_query_wait(priority, stock)
+    st_stats_count('query.requests')
+
+    return __st_query_get('stock/' + stock + '/quote',
+                          { 'filter' : ','.join(QUOTE_FIELDS) })
+
+@timed('query.batch')
+def st_query_batch(stocks, priority=PRIORITY_NORMAL):
     """
+    Query quotes for a list of stocks with a single request. Returns a dict
+    mapping each ticker to the same quote data st_query_quote() would return.
+    Tickers the provider doesn't know about are simply left out.
+    """
+
+    __st_query_wait(priority)
+    st_stats_count('query.requests')
 
-    url = API_URL + 'stock/' + stock + '/quote'
+    obj = __st_query_get('stock/market/batch',
+                         { 'symbols' : ','.join(stocks),
+                           'types'   : 'quote',
+                           'filter'  : ','.join(QUOTE_FIELDS) })
 
-    # print '> Query URL: ' + url
+    quotes = dict()
+    for symb in obj.keys():
+        if 'quote' in obj[symb]:
+            quotes[symb] = obj[symb]['quote']
+
+    return quotes
+
+def st_query_symbols():
+    """
+    Fetch the provider's symbol directory: a list of dicts with at least
+    'symbol' and 'name'. It's big and rarely needed, so it waits behind
+    everything else for the request budget.
+    """
 
-    req = requests.get(url)
+    __st_query_wait(PRIORITY_LOW)
+    st_stats_count('query.requests')
 
-    return json.loads(req.content)
+    return __st_query_get('ref-data/symbols',
+                          { 'filter' : 'symbol,name' })
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+#
+# Lot relief strategies. When shares are sold, which lots they come out of
+# decides the realized gain, how much of it is short versus long term and the
+# cost basis left behind. This replays a whole ledger under several relief
+# strategies and reports each, one worker process per strategy.
+#
+# The ledger is parsed once, before the workers are started. They inherit the
+# parsed transactions from this process when they are forked, so nothing is
+# parsed or pickled per strategy: each worker hands back only its totals.
+#
+
+import os
+import sys
+import heapq
+import multiprocessing
+
+from collections import deque
+
+from st_ledger import *
+
+# Relief strategies.
+FIFO     = 'fifo'       # Oldest lots first.
+LIFO     = 'lifo'       # Newest lots first.
+HIFO     = 'hifo'       # Highest cost lots first.
+
+STRATEGIES = [ FIFO, LIFO, HIFO ]
+
+# Ledgers with fewer trades than this are quicker to replay in this process
+# than to start worker processes for.
+PARALLEL_MIN_TRADES = 50000
+
+# The trades being replayed: set before the worker pool is forked so the
+# workers share it rather than each getting a copy sent to them.
+__trades = list()
+
+def ledger_trades(file_path, errors, workers=None):
+    """
+    Parse a ledger into the list of BUY and SELL transactions in it, using
+    the parallel bulk loader for big files. Lines that can't be parsed end
+    up in errors, as for Portfolio.
+    """
+
+    if workers != 1 and os.path.getsize(file_path) >= PARALLEL_MIN_SIZE:
+        trs = load_ledger(file_path, errors, workers)
+    else:
+        trs = list()
+        nr = 0
+        for line in open(file_path):
+            nr += 1
+            try:
+                tr = parse_ledger_line(line)
+            except LedgerError, e:
+                e.line_no = nr
+                errors.append(e)
+                continue
+            if tr:
+                trs.append(tr)
+
+    return [ tr for tr in trs if tr[0] in (BUY, SELL) ]
+
+class ReliefResult(object):
+    """
+    What replaying a ledger with one relief strategy came to.
+    """
+
+    def __init__(self, strategy):
+        self.strategy   = strategy
+        self.proceeds   = 0.0
+        self.short_term = 0.0   # Realized gain on lots held a year or less.
+        self.long_term  = 0.0   # Realized gain on lots held over a year.
+        self.cost_basis = 0.0   # Of the lots left at the end.
+        self.sells      = 0
+        self.lots       = 0     # Lots left at the end.
+
+        # Shares sold that there were no lots left for.
+        self.unmatched  = 0.0
+
+    def realized(self):
+        return self.short_term + self.long_term
+
+    def __eq__(self, other):
+        return isinstance(other, ReliefResult) and \
+            self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return '%-8s realized $%12.2f  short $%12.2f  long $%12.2f  ' \
+               'basis $%12.2f' % (self.strategy, self.realized(),
+                                  self.short_term, self.long_term,
+                                  self.cost_basis)
+
+class LotQueue(object):
+    """
+    The open lots of one ticker, kept in the order a strategy sells from
+    them. A lot is a [date, price, nr] list.
+    """
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.seq      = 0
+
+        if strategy == HIFO:
+            self.lots = list()      # Heap of (-price, seq, lot).
+        elif strategy in (FIFO, LIFO):
+            self.lots = deque()
+        else:
+            raise ValueError('Unknown relief strategy: %s' % strategy)
+
+    def __len__(self):
+        return len(self.lots)
+
+    def add(self, lot):
+        if self.strategy == HIFO:
+            heapq.heappush(self.lots, (-lot[1], self.seq, lot))
+            self.seq += 1
+        else:
+            self.lots.append(lot)
+
+    def all(self):
+        if self.strategy == HIFO:
+            return [ entry[2] for entry in self.lots ]
+
+        return list(self.lots)
+
+    def relieve(self, nr):
+        """
+        Take nr shares out of the lots. Returns a list of
+        (lot, shares taken from it) and the number of shares there weren't
+        lots for.
+        """
+
+        taken = list()
+
+        while nr > 0 and self.lots:
+            if self.strategy == HIFO:
+                lot = self.lots[0][2]
+            elif self.strategy == LIFO:
+                lot = self.lots[-1]
+            else:
+                lot = self.lots[0]
+
+            n = min(nr, lot[2])
+            taken.append((lot, n))
+            lot[2] -= n
+            nr -= n
+
+            if lot[2] > 0:
+                continue
+
+            if self.strategy == HIFO:
+                heapq.heappop(self.lots)
+            elif self.strategy == LIFO:
+                self.lots.pop()
+            else:
+                self.lots.popleft()
+
+        return taken, nr
+
+def replay(trades, strategy):
+    """
+    Replay BUY and SELL transactions with strategy. Returns a ReliefResult.
+    """
+
+    result = ReliefResult(strategy)
+    queues = dict()
+
+    for tr_type, date, nr, ticker, price, comment in trades:
+        queue = queues.get(ticker)
+        if queue is None:
+            queue = LotQueue(strategy)
+            queues[ticker] = queue
+
+        if tr_type == BUY:
+            queue.add([ date, price, nr ])
+            continue
+
+        taken, unmatched = queue.relieve(nr)
+
+        for lot, n in taken:
+            gain = (price - lot[1]) * n
+            if long_term(lot[0], date):
+                result.long_term += gain
+            else:
+                result.short_term += gain
+
+        result.proceeds += (nr - unmatched) * price
+        result.unmatched += unmatched
+        result.sells += 1
+
+    for queue in queues.values():
+        for lot in queue.all():
+            result.cost_basis += lot[1] * lot[2]
+            result.lots += 1
+
+    return result
+
+def __replay_shared(strategy):
+    """
+    Worker side of compare(): replay the shared trades with strategy.
+    """
+
+    return replay(__trades, strategy)
+
+def compare(trades, strategies=STRATEGIES, workers=None):
+    """
+    Replay trades (as returned by ledger_trades()) under each of strategies
+    and return a ReliefResult for each, in the same order. Strategies are
+    replayed in parallel worker processes, one per CPU unless workers says
+    otherwise, if there are enough trades to make that worth it.
+    """
+
+    global __trades
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+
+    workers = min(workers, len(strategies))
+
+    if workers <= 1 or len(trades) < PARALLEL_MIN_TRADES:
+        return [ replay(trades, s) for s in strategies ]
+
+    __trades = trades
+    pool = multiprocessing.Pool(workers)
+
+    try:
+        return pool.map(__replay_shared, strategies, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+        __trades = list()
+
+def main(args):
+    """
+    Usage: st_relief.py <portfolio> [strategy ...]
+    """
+
+    if len(args) < 2:
+        print 'Usage: %s <portfolio> [%s ...]' % (args[0],
+                                                 '|'.join(STRATEGIES))
+        return 1
+
+    strategies = args[2:] or STRATEGIES
+    for s in strategies:
+        if s not in STRATEGIES:
+            print 'Unknown strategy: %s' % s
+            return 1
+
+    errors = list()
+    trades = ledger_trades(args[1], errors)
+
+    for e in errors:
+        print 'Warning: %s' % e
+
+    for r in compare(trades, strategies):
+        print r
+        if r.unmatched:
+            print '         %.2f shares sold with no lots to sell from' % \
+                r.unmatched
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
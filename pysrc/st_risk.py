@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+#
+# Monte Carlo risk for a portfolio: value at risk, expected shortfall and the
+# chance of ending up below some value after N trading days. Paths are built
+# from locally stored daily history, either by bootstrapping whole days of
+# returns (which keeps the correlations between holdings as they were) or by
+# sampling a multivariate normal fitted to them. The paths are simulated in
+# batches as NumPy matrix operations, spread over worker processes when
+# there's enough work to be worth it.
+#
+# Daily history is read from a file with one price per line, either
+#
+#   <YYYY-MM-DD>,<ticker>,<close>
+#
+# or the lines st --history=<file> writes (unix time first). The last price
+# seen for a ticker on a day is its close for that day.
+#
+
+import sys
+import multiprocessing
+
+from datetime import datetime
+
+import numpy as np
+
+from st_stats import timed
+
+# Ways of generating paths.
+BOOTSTRAP = 'bootstrap'
+NORMAL    = 'normal'
+
+# Paths are simulated in chunks of this many. Each chunk gets its own seed
+# derived from the base seed, so results don't depend on how many workers
+# there are.
+CHUNK_PATHS = 2000
+
+# Below this much work (paths * days * holdings) worker processes cost more
+# than they save.
+PARALLEL_MIN_WORK = 20 * 1000 * 1000
+
+def load_daily_closes(file_path):
+    """
+    Load daily history. Returns a dict of ticker -> dict of day -> close,
+    days being YYYY-MM-DD strings.
+    """
+
+    closes = dict()
+
+    for line in open(file_path):
+        items = line.strip().split(',')
+        if len(items) < 3 or not items[2] or line[0] == '#':
+            continue
+
+        try:
+            if '-' in items[0]:
+                day = items[0]
+            else:
+                day = datetime.fromtimestamp(float(items[0])).strftime(
+                    '%Y-%m-%d')
+            price = float(items[2])
+        except ValueError:
+            continue
+
+        closes.setdefault(items[1].upper(), dict())[day] = price
+
+    return closes
+
+def returns_matrix(closes, tickers):
+    """
+    Daily log returns for tickers as a (days, tickers) array, over the days
+    on which every one of them has a close.
+    """
+
+    days = None
+    for t in tickers:
+        have = set(closes.get(t, dict()).keys())
+        days = have if days is None else days & have
+
+    days = sorted(days or list())
+    if len(days) < 3:
+        raise ValueError('Not enough daily history for %s' %
+                         ', '.join(tickers))
+
+    prices = np.array([ [ closes[t][d] for t in tickers ] for d in days ])
+
+    return np.diff(np.log(prices), axis=0)
+
+def __simulate_chunk(args):
+    """
+    Simulate one chunk of paths. Returns the final value of each path for
+    holdings currently worth values.
+    """
+
+    returns, values, horizon, paths, method, seed = args
+
+    rng = np.random.RandomState(seed)
+
+    if method == BOOTSTRAP:
+        # Whole days at a time, so the holdings move together like they did.
+        days = rng.randint(0, len(returns), size=(paths, horizon))
+        total = returns[days].sum(axis=1)
+    else:
+        mean = returns.mean(axis=0)
+        cov = np.atleast_2d(np.cov(returns, rowvar=False))
+        chol = np.linalg.cholesky(cov + np.eye(len(cov)) * 1e-12)
+        z = rng.standard_normal((paths, horizon, len(values)))
+        total = (z.dot(chol.T) + mean).sum(axis=1)
+
+    return np.exp(total).dot(values)
+
+@timed('risk.simulate')
+def simulate(returns, values, horizon, paths, method=BOOTSTRAP, seed=None,
+             workers=None):
+    """
+    Simulate paths of horizon days for holdings worth values (one per column
+    of returns). Returns the final values of the paths as an array.
+
+    Pass a seed for reproducible results. workers defaults to the number of
+    CPUs, but small simulations always run in this process.
+    """
+
+    values = np.asarray(values, dtype=float)
+
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1 - paths / CHUNK_PATHS)
+
+    chunks = list()
+    for i in range(0, paths, CHUNK_PATHS):
+        chunks.append((returns, values, horizon, min(CHUNK_PATHS, paths - i),
+                       method, seed + i / CHUNK_PATHS))
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+
+    if workers == 1 or len(chunks) == 1 or \
+       paths * horizon * len(values) < PARALLEL_MIN_WORK:
+        return np.concatenate(map(__simulate_chunk, chunks))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return np.concatenate(pool.map(__simulate_chunk, chunks))
+    finally:
+        pool.terminate()
+        pool.join()
+
+class RiskReport(object):
+    """
+    The outcome of a simulation: start is what the portfolio is worth now,
+    values what each path ended up worth. Cash is included in both.
+    """
+
+    def __init__(self, start, values, horizon, missing=list(),
+                 unpriced=list()):
+        self.start    = start
+        self.values   = np.sort(values)
+        self.horizon  = horizon
+
+        # Holdings with no history, held at today's value.
+        self.missing  = list(missing)
+
+        # Holdings with no price and no history. There's nothing to value
+        # them at, so they're left out of start and of every path.
+        self.unpriced = list(unpriced)
+
+    def var(self, confidence=0.95):
+        """
+        The loss that confidence of the paths do no worse than.
+        """
+
+        return self.start - np.percentile(self.values,
+                                          (1.0 - confidence) * 100)
+
+    def expected_shortfall(self, confidence=0.95):
+        """
+        The average loss over the paths that do worse than var(confidence).
+        """
+
+        cutoff = np.percentile(self.values, (1.0 - confidence) * 100)
+
+        return self.start - self.values[self.values <= cutoff].mean()
+
+    def prob_below(self, floor):
+        """
+        The fraction of paths that end up worth less than floor.
+        """
+
+        return float((self.values < floor).mean())
+
+    def describe(self, floor=None, confidence=0.95):
+        s = '%dd VaR%d $%.2f  ES $%.2f' % (self.horizon, confidence * 100,
+                                           self.var(confidence),
+                                           self.expected_shortfall(confidence))
+        if floor is not None:
+            s += '  P(< $%.2f) %.1f%%' % (floor, self.prob_below(floor) * 100)
+        if self.missing:
+            s += '  (no history: %s)' % ', '.join(self.missing)
+        if self.unpriced:
+            s += '  (not valued: %s)' % ', '.join(self.unpriced)
+
+        return s
+
+def portfolio_risk(portfolio, closes, horizon=10, paths=10000,
+                   method=BOOTSTRAP, seed=None, workers=None):
+    """
+    Simulate portfolio over horizon trading days using the daily closes
+    from load_daily_closes(). Holdings are valued at their cached quote, or
+    their last close if there's no quote; holdings with neither are left
+    out of the value and the VaR altogether (see RiskReport.unpriced).
+    Returns a RiskReport.
+    """
+
+    tickers = list()
+    values = list()
+    fixed = portfolio.cash
+    missing = list()
+    unpriced = list()
+
+    stocks = dict([ (s.ticker, s) for s in portfolio.assets ])
+
+    for t in sorted(portfolio.asset_counts.keys()):
+        nr = portfolio.asset_counts[t]
+        if not nr:
+            continue
+
+        history = closes.get(t)
+
+        price = None
+        if t in stocks:
+            data = stocks[t].cached_data()
+            if data and data.get('latestPrice') is not None:
+                price = float(data['latestPrice'])
+        if price is None and history:
+            price = history[max(history.keys())]
+        if price is None:
+            unpriced.append(t)
+            continue
+
+        if not history or len(history) < 3:
+            missing.append(t)
+            fixed += nr * price
+            continue
+
+        tickers.append(t)
+        values.append(nr * price)
+
+    start = fixed + sum(values)
+
+    if not tickers:
+        return RiskReport(start, np.array([ start ]), horizon, missing,
+                          unpriced)
+
+    returns = returns_matrix(closes, tickers)
+    finals = simulate(returns, values, horizon, paths, method, seed, workers)
+
+    return RiskReport(start, finals + fixed, horizon, missing, unpriced)
+
+def main(args):
+    """
+    Usage: st_risk.py <portfolio> <history> [days] [paths] [seed]
+    """
+
+    from portfolio import Portfolio
+
+    if len(args) < 3:
+        print 'Usage: %s <portfolio> <history> [days] [paths] [seed]' % args[0]
+        return 1
+
+    horizon = 10
+    paths = 10000
+    seed = None
+
+    if len(args) > 3:
+        horizon = int(args[3])
+    if len(args) > 4:
+        paths = int(args[4])
+    if len(args) > 5:
+        seed = int(args[5])
+
+    p = Portfolio(args[1])
+    closes = load_daily_closes(args[2])
+
+    for method in (BOOTSTRAP, NORMAL):
+        report = portfolio_risk(p, closes, horizon, paths, method, seed)
+        print '%-10s %s' % (method, report.describe(0.9 * report.start))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
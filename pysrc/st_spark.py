@@ -0,0 +1,125 @@
+#
+# Intraday sparklines. Each tracked stock gets a fixed size ring buffer of
+# prices, sampled once per refresh, so memory stays the same however long st
+# runs. The sparkline text is rebuilt when a sample is added, not when the
+# screen is drawn: a frame just writes out the string it already has.
+#
+
+from array import array
+
+# One sample per 15 second refresh covers a 6.5 hour trading day.
+RING_SIZE   = 1560
+
+# Characters wide a sparkline is drawn.
+SPARK_WIDTH = 12
+
+# Lowest to highest.
+SPARK_CHARS = [ c.encode('utf-8') for c in u'\u2581\u2582\u2583\u2584'
+                                           u'\u2585\u2586\u2587\u2588' ]
+
+class PriceRing(object):
+    """
+    The last size prices of a stock, in a preallocated array of doubles.
+    Adding a price past the end overwrites the oldest one.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.prices = array('d', [ 0.0 ]) * size
+        self.size   = size
+        self.head   = 0         # Where the next price goes.
+        self.count  = 0
+
+        # The rendered sparkline, kept up to date by SparkLines.
+        self.spark  = ''
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """
+        Prices oldest first.
+        """
+
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError('PriceRing index out of range')
+
+        return self.prices[(self.head - self.count + i) % self.size]
+
+    def add(self, price):
+        self.prices[self.head] = price
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def render(self, width=SPARK_WIDTH):
+        """
+        Return the prices as a sparkline at most width characters wide. With
+        more prices than characters each character shows the last price of
+        its share of the ring.
+        """
+
+        if not self.count:
+            return ''
+
+        lo = hi = self[0]
+        for i in range(1, self.count):
+            p = self[i]
+            if p < lo:
+                lo = p
+            elif p > hi:
+                hi = p
+
+        span = hi - lo
+        top = len(SPARK_CHARS) - 1
+        cols = min(width, self.count)
+
+        chars = list()
+        for c in range(0, cols):
+            p = self[(c + 1) * self.count / cols - 1]
+            if span:
+                chars.append(SPARK_CHARS[int((p - lo) / span * top + 0.5)])
+            else:
+                chars.append(SPARK_CHARS[top / 2])
+
+        return ''.join(chars)
+
+class SparkLines(object):
+    """
+    Ring buffers and sparklines for every stock sampled so far, by ticker.
+    """
+
+    def __init__(self, size=RING_SIZE, width=SPARK_WIDTH):
+        self.size  = size
+        self.width = width
+        self.rings = dict()
+
+    def sample(self, stocks):
+        """
+        Add the current cached price of each of stocks to its ring. Stocks
+        without a quote are skipped. Never fetches anything.
+        """
+
+        for s in stocks:
+            data = s.cached_data()
+            if not data or data.get('latestPrice') is None:
+                continue
+
+            ring = self.rings.get(s.ticker)
+            if ring is None:
+                ring = PriceRing(self.size)
+                self.rings[s.ticker] = ring
+
+            ring.add(float(data['latestPrice']))
+            ring.spark = ring.render(self.width)
+
+    def line(self, ticker):
+        """
+        Return the sparkline for ticker, ready to draw.
+        """
+
+        ring = self.rings.get(ticker)
+        if ring is None:
+            return ''
+
+        return ring.spark
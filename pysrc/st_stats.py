@@ -0,0 +1,236 @@
+#
+# Performance instrumentation. Keeps latency histograms and counters for the
+# interesting bits of st (quote fetches, refreshes, ledger parsing, frames)
+# so that when things lag we can see where the time went.
+#
+
+import os
+import json
+import time
+import threading
+
+from functools import wraps
+
+# Upper bounds (in milliseconds) of the histogram buckets. Anything slower
+# than the last bound lands in a final overflow bucket.
+BUCKETS = [ 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100,
+            250, 500, 1000, 2500, 5000, 10000 ]
+
+class Histogram(object):
+    """
+    A latency histogram with fixed buckets. Cheap to update and good enough
+    for eyeballing percentiles.
+    """
+
+    def __init__(self):
+        self.counts = [ 0 ] * (len(BUCKETS) + 1)
+        self.nr     = 0
+        self.total  = 0.0
+        self.min    = None
+        self.max    = None
+
+    def add(self, ms):
+        """
+        Record a single sample, in milliseconds.
+        """
+
+        i = 0
+        while i < len(BUCKETS) and ms > BUCKETS[i]:
+            i += 1
+
+        self.counts[i] += 1
+        self.nr        += 1
+        self.total     += ms
+
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def mean(self):
+        if not self.nr:
+            return 0.0
+
+        return self.total / self.nr
+
+    def percentile(self, pct):
+        """
+        Return the upper bound of the bucket holding the pct'th percentile.
+        The overflow bucket reports the largest sample seen.
+        """
+
+        if not self.nr:
+            return 0.0
+
+        want = pct / 100.0 * self.nr
+        seen = 0
+
+        for i in range(0, len(self.counts)):
+            seen += self.counts[i]
+            if seen >= want and self.counts[i]:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+
+        return self.max
+
+    def to_dict(self):
+        return { 'count'   : self.nr,
+                 'mean_ms' : self.mean(),
+                 'min_ms'  : self.min or 0.0,
+                 'max_ms'  : self.max or 0.0,
+                 'p50_ms'  : self.percentile(50),
+                 'p95_ms'  : self.percentile(95),
+                 'p99_ms'  : self.percentile(99),
+                 'buckets' : self.counts }
+
+# All of the stats, keyed by name.
+st_stats_lock       = threading.Lock()
+st_stats_histograms = dict()
+st_stats_counters   = dict()
+st_stats_started    = time.time()
+
+def st_stats_record(name, ms):
+    """
+    Add a latency sample to the named histogram.
+    """
+
+    st_stats_lock.acquire()
+
+    h = st_stats_histograms.get(name)
+    if not h:
+        h = Histogram()
+        st_stats_histograms[name] = h
+
+    h.add(ms)
+
+    st_stats_lock.release()
+
+def st_stats_count(name, nr=1):
+    """
+    Bump the named counter.
+    """
+
+    st_stats_lock.acquire()
+    st_stats_counters[name] = st_stats_counters.get(name, 0) + nr
+    st_stats_lock.release()
+
+def st_stats_histogram(name):
+    """
+    Return the named histogram or None if nothing has been recorded yet.
+    """
+
+    return st_stats_histograms.get(name)
+
+def st_stats_counter(name):
+    return st_stats_counters.get(name, 0)
+
+def st_stats_hit_rate(prefix):
+    """
+    Return the hit rate for a pair of '<prefix>.hit' and '<prefix>.miss'
+    counters, or None if neither has been bumped.
+    """
+
+    hit  = st_stats_counter(prefix + '.hit')
+    miss = st_stats_counter(prefix + '.miss')
+
+    if not hit + miss:
+        return None
+
+    return float(hit) / (hit + miss)
+
+def timed(name):
+    """
+    Decorator that records how long each call to the wrapped function takes
+    into the named histogram.
+    """
+
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                st_stats_record(name, (time.time() - start) * 1000.0)
+
+        return wrapper
+
+    return decorate
+
+def st_stats_snapshot():
+    """
+    Return all the stats as a plain dict suitable for dumping as JSON.
+    """
+
+    st_stats_lock.acquire()
+
+    snap = { 'time'       : time.time(),
+             'uptime'     : time.time() - st_stats_started,
+             'latency'    : dict(),
+             'counters'   : dict(st_stats_counters) }
+
+    for name in st_stats_histograms.keys():
+        snap['latency'][name] = st_stats_histograms[name].to_dict()
+
+    st_stats_lock.release()
+
+    return snap
+
+def st_stats_dump(file_path):
+    """
+    Write a snapshot of the stats to file_path. The file is replaced
+    atomically so readers never see a partial write.
+    """
+
+    tmp = file_path + '.tmp'
+
+    f = open(tmp, 'w')
+    json.dump(st_stats_snapshot(), f, indent=2, sort_keys=True)
+    f.close()
+
+    os.rename(tmp, file_path)
+
+def st_stats_lines():
+    """
+    Return a list of short strings describing the stats, for the overlay.
+    """
+
+    lines = list()
+    lines.append('%-22s %6s %8s %8s %8s' % ('Stat', 'count',
+                                           'p50 ms', 'p95 ms', 'max ms'))
+
+    st_stats_lock.acquire()
+    names = sorted(st_stats_histograms.keys())
+    for name in names:
+        h = st_stats_histograms[name]
+        lines.append('%-22s %6d %8.2f %8.2f %8.2f' % (name[0:22], h.nr,
+                                                     h.percentile(50),
+                                                     h.percentile(95),
+                                                     h.max or 0.0))
+    st_stats_lock.release()
+
+    rate = st_stats_hit_rate('stock.cache')
+    if rate is not None:
+        lines.append('%-22s %6.1f%%' % ('quote cache hit rate', rate * 100))
+
+    lines.append('%-22s %6d' % ('quote requests',
+                                st_stats_counter('query.requests')))
+
+    if st_stats_counter('query.bytes'):
+        lines.append('%-22s %6.1f' % ('quote KB fetched',
+                                      st_stats_counter('query.bytes') / 1024.0))
+        lines.append('%-22s %6d' % ('quotes not modified',
+                                    st_stats_counter('query.not_modified')))
+
+    refreshes = st_stats_counter('refresh.count')
+    if refreshes:
+        lines.append('%-22s %6.1f' % ('KB per refresh (mean)',
+                                      st_stats_counter('refresh.bytes') /
+                                      1024.0 / refreshes))
+
+    frames = st_stats_histogram('ui.frame')
+    if frames and frames.nr:
+        lines.append('%-22s %6.1f' % ('frame ms (mean)', frames.mean()))
+
+    return lines
@@ -0,0 +1,234 @@
+#
+# Streaming quote client. Subscribes to a server-sent events (SSE) push feed
+# for a set of tickers and merges each quote delta into the Stock cache as it
+# arrives. If the feed goes away we fall back to polling with batch queries
+# until the feed can be reached again.
+#
+
+import json
+import time
+import threading
+
+import requests
+
+from stock    import Stock
+from st_query import st_query_batch
+
+class QuoteStream(object):
+    """
+    A push quote feed for some set of tickers.
+
+    The feed is expected to be an SSE stream at the passed URL. The tickers
+    are passed in the 'symbols' query parameter and each event's data is a
+    JSON object with at least a 'symbol' key, plus whatever quote fields
+    changed:
+
+      id: 42
+      data: {"symbol": "NVDA", "latestPrice": 231.4, "change": 1.2}
+
+    The id of the last event seen is sent back as Last-Event-ID when we
+    reconnect so the feed can resume where we left off.
+    """
+
+    def __init__(self, url, tickers=list(), poll_interval=15.0,
+                 retry_interval=5.0, max_failures=3):
+        """
+        Make a stream for the passed feed URL. Nothing happens until start()
+        is called.
+
+        After max_failures consecutive failed connects the stream falls back
+        to polling every poll_interval seconds. While polling, a reconnect to
+        the feed is attempted every retry_interval seconds.
+        """
+
+        self.url            = url
+        self.tickers        = list(tickers)
+        self.poll_interval  = poll_interval
+        self.retry_interval = retry_interval
+        self.max_failures   = max_failures
+
+        self.last_id        = None
+        self.failures       = 0
+        self.polling        = False
+
+        # Set whenever new quote data lands in the cache; the UI can wait on
+        # this to know when a redraw is worth it.
+        self.updated        = threading.Event()
+
+        self.__die          = False
+        self.__resp         = None
+        self.__lock         = threading.Lock()
+        self.__thread       = None
+
+    def set_tickers(self, tickers):
+        """
+        Change the set of tickers we are subscribed to. If connected, the
+        current connection is dropped and we resubscribe.
+        """
+
+        self.__lock.acquire()
+        self.tickers = list(tickers)
+        resp = self.__resp
+        self.__lock.release()
+
+        if resp:
+            resp.close()
+
+    def start(self):
+        """
+        Fire off the background thread that reads the feed.
+        """
+
+        if self.__thread:
+            return
+
+        self.__die = False
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop reading the feed and wait for the background thread to exit.
+        """
+
+        self.__die = True
+
+        resp = self.__resp
+        if resp:
+            resp.close()
+
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def streaming(self):
+        """
+        Returns True if quotes are currently being pushed to us.
+        """
+
+        return self.__resp is not None and not self.polling
+
+    def __sleep(self, seconds):
+        """
+        Sleep in tenth second increments so that stop() stays responsive.
+        """
+
+        while seconds > 0 and not self.__die:
+            time.sleep(.1)
+            seconds -= .1
+
+    def __run(self):
+        while not self.__die:
+            try:
+                self.__read_feed()
+                self.failures = 0
+            except (requests.RequestException, ValueError):
+                self.failures += 1
+
+            if self.__die:
+                break
+
+            if self.failures < self.max_failures:
+                self.__sleep(min(self.retry_interval,
+                                 0.5 * (2 ** self.failures)))
+                continue
+
+            # The feed is no good right now. Keep quotes flowing with batch
+            # polls and every so often see if the feed is back.
+            self.polling = True
+            self.__poll()
+            self.__sleep(min(self.poll_interval, self.retry_interval))
+
+    def __poll(self):
+        """
+        Do a single batch poll for all our tickers.
+        """
+
+        tickers = list(self.tickers)
+        if not tickers:
+            return
+
+        try:
+            quotes = st_query_batch(tickers)
+        except (requests.RequestException, ValueError):
+            return
+
+        for symb in quotes.keys():
+            Stock.set_data(symb, quotes[symb])
+
+        self.updated.set()
+
+    def __read_feed(self):
+        """
+        Connect to the feed and apply events until the connection drops.
+        """
+
+        headers = dict()
+        if self.last_id is not None:
+            headers['Last-Event-ID'] = self.last_id
+
+        self.__lock.acquire()
+        params = { 'symbols' : ','.join(self.tickers) }
+        self.__lock.release()
+
+        resp = requests.get(self.url, params=params, headers=headers,
+                            stream=True, timeout=(5.0, 60.0))
+        resp.raise_for_status()
+
+        self.__resp = resp
+        self.polling = False
+        self.failures = 0
+
+        event_id = None
+        data = list()
+
+        try:
+            for line in resp.iter_lines(chunk_size=1):
+                if self.__die:
+                    break
+
+                # A blank line dispatches the event we've been building.
+                if not line:
+                    if data:
+                        self.__dispatch(event_id, '\n'.join(data))
+                    event_id = None
+                    data = list()
+                    continue
+
+                # Comments - usually just keep alives.
+                if line[0] == ':':
+                    continue
+
+                if ':' in line:
+                    field, value = line.split(':', 1)
+                    if value[0:1] == ' ':
+                        value = value[1:]
+                else:
+                    field, value = line, ''
+
+                if field == 'id':
+                    event_id = value
+                elif field == 'data':
+                    data.append(value)
+        except (requests.RequestException, AttributeError):
+            # Closing the response from another thread (stop() or
+            # set_tickers()) shows up here as one of these.
+            pass
+        finally:
+            self.__resp = None
+            resp.close()
+
+    def __dispatch(self, event_id, data):
+        """
+        Merge a single event's quote into the stock cache.
+        """
+
+        delta = json.loads(data)
+        symb = delta.get('symbol')
+
+        if symb and Stock.apply_delta(symb, delta):
+            self.updated.set()
+
+        if event_id is not None:
+            self.last_id = event_id
@@ -0,0 +1,218 @@
+#
+# Symbol search. Keeps a local copy of the provider's symbol directory,
+# refreshed at most once a day, indexed as sorted arrays so that ticker and
+# company name prefix searches are a couple of bisects. Also the incremental
+# row filter behind the filter-as-you-type mode.
+#
+
+import os
+import json
+import time
+import bisect
+
+from st_query import st_query_symbols
+from st_stats import st_stats_count, timed
+
+# Don't hit the provider for the directory more than once a day.
+MAX_AGE = 24 * 60 * 60.0
+
+def name_words(name):
+    """
+    Split a company name into lower case words for prefix search.
+    """
+
+    return name.lower().replace(',', ' ').replace('.', ' ').split()
+
+class SymbolDirectory(object):
+    """
+    Every symbol the provider knows about with its company name, cached in
+    file_path as a JSON list of [symbol, name] pairs.
+    """
+
+    def __init__(self, file_path, max_age=MAX_AGE):
+        self.file_path = file_path
+        self.max_age   = max_age
+
+        self.symbols   = list()     # Sorted tickers.
+        self.names     = dict()     # Ticker -> company name.
+        self.words     = list()     # Sorted (name word, ticker) pairs.
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def fresh(self):
+        """
+        Returns True if the cache file is there and young enough to use.
+        """
+
+        try:
+            age = time.time() - os.path.getmtime(self.file_path)
+        except OSError:
+            return False
+
+        return age < self.max_age
+
+    def load(self):
+        """
+        Load the directory, from the cache if it is fresh, otherwise from the
+        provider (writing the cache). If the provider can't be reached an old
+        cache is better than nothing. Returns the number of symbols.
+        """
+
+        pairs = None
+
+        if not self.fresh():
+            try:
+                pairs = [ (str(s['symbol']), s.get('name') or '')
+                          for s in st_query_symbols() if s.get('symbol') ]
+                self.__save(pairs)
+                st_stats_count('symbols.fetched')
+            except (IOError, ValueError, KeyError, TypeError):
+                st_stats_count('symbols.fetch_errors')
+
+        if pairs is None:
+            try:
+                pairs = json.load(open(self.file_path))
+            except (IOError, ValueError):
+                pairs = list()
+
+        self.index(pairs)
+
+        return len(self.symbols)
+
+    def __save(self, pairs):
+        """
+        Write the cache. It's replaced atomically so a crash mid write can't
+        leave a broken cache behind.
+        """
+
+        tmp = self.file_path + '.tmp'
+        f = open(tmp, 'w')
+        json.dump(pairs, f, separators=(',', ':'))
+        f.close()
+
+        os.rename(tmp, self.file_path)
+
+    def index(self, pairs):
+        """
+        Build the indexes from (symbol, name) pairs.
+        """
+
+        names = dict()
+        words = list()
+
+        for symbol, name in pairs:
+            symbol = str(symbol).upper()
+            names[symbol] = name
+            for w in name_words(name):
+                words.append((w, symbol))
+
+        words.sort()
+
+        self.names   = names
+        self.symbols = sorted(names.keys())
+        self.words   = words
+
+    def name(self, ticker):
+        return self.names.get(ticker)
+
+    def search(self, prefix, limit=10):
+        """
+        Return up to limit tickers whose symbol, or a word of whose company
+        name, starts with prefix. Symbol matches come first.
+        """
+
+        found = list()
+        seen = set()
+
+        if not prefix:
+            return found
+
+        up = prefix.upper()
+        i = bisect.bisect_left(self.symbols, up)
+        while i < len(self.symbols) and len(found) < limit and \
+              self.symbols[i].startswith(up):
+            found.append(self.symbols[i])
+            seen.add(self.symbols[i])
+            i += 1
+
+        low = prefix.lower()
+        i = bisect.bisect_left(self.words, (low,))
+        while i < len(self.words) and len(found) < limit and \
+              self.words[i][0].startswith(low):
+            symbol = self.words[i][1]
+            if symbol not in seen:
+                found.append(symbol)
+                seen.add(symbol)
+            i += 1
+
+        return found
+
+class SymbolFilter(object):
+    """
+    Narrows a list of stocks as a query is typed a character at a time. A
+    stock matches if its ticker, or any word of its company name, starts
+    with the query.
+
+    Typing a character can only narrow the match, so each keystroke only
+    looks at the stocks that matched before it. Backspace just goes back to
+    the previous result.
+    """
+
+    def __init__(self, stocks, directory=None):
+        # Search keys for every stock, worked out once up front.
+        self.keys = dict()
+        for s in stocks:
+            name = None
+            if directory:
+                name = directory.name(s.ticker)
+            if not name:
+                data = s.cached_data()
+                if data:
+                    name = data.get('companyName')
+
+            self.keys[s] = (s.ticker.lower(), name_words(name or ''))
+
+        self.query   = ''
+        self.results = [ list(stocks) ]
+
+    def result(self):
+        """
+        Return the stocks matching the current query.
+        """
+
+        return self.results[-1]
+
+    @timed('ui.filter')
+    def push(self, c):
+        """
+        Add a character to the query.
+        """
+
+        self.query += c.lower()
+        q = self.query
+
+        matches = list()
+        for s in self.results[-1]:
+            ticker, words = self.keys[s]
+            if ticker.startswith(q):
+                matches.append(s)
+                continue
+
+            for w in words:
+                if w.startswith(q):
+                    matches.append(s)
+                    break
+
+        self.results.append(matches)
+
+    def pop(self):
+        """
+        Remove the last character of the query.
+        """
+
+        if not self.query:
+            return
+
+        self.query = self.query[:-1]
+        self.results.pop()
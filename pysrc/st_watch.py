@@ -0,0 +1,146 @@
+#
+# Watchlists: big lists of tickers to keep an eye on that aren't tied to a
+# portfolio ledger. Quotes are fetched with batch queries and the screen only
+# ever shows the top movers, picked with a partial selection rather than a
+# full sort.
+#
+
+import heapq
+
+from stock    import Stock
+from st_query import st_query_batch
+from st_stats import timed, st_stats_count
+from st_limit import PRIORITY_NORMAL, FetchQueue
+
+# The most symbols the provider will take in one batch query.
+BATCH_SIZE = 100
+
+def mover_key_change_percent(data):
+    """
+    Rank by the size of the day's move, up or down.
+    """
+
+    return abs(float(data.get('changePercent') or 0.0))
+
+def mover_key_volume(data):
+    """
+    Rank by today's volume, falling back on the average if the provider
+    hasn't got today's yet.
+    """
+
+    return float(data.get('latestVolume') or data.get('avgTotalVolume') or 0)
+
+class Watchlist(object):
+    """
+    A list of tickers loaded from a file. The file has one ticker per line;
+    blank lines and lines starting with '#' are ignored.
+
+    Looks enough like a Portfolio (name, assets, asset_counts, refresh()) to
+    be made active in the UI, though it holds no shares.
+    """
+
+    def __init__(self, file_path, batch_size=BATCH_SIZE):
+        self.name         = file_path
+        self.batch_size   = batch_size
+        self.assets       = list()
+        self.asset_counts = dict()
+        self.cash         = 0.0
+
+        for line in open(file_path):
+            ticker = line.split('#', 1)[0].strip().upper()
+
+            if not ticker or ticker in self.asset_counts:
+                continue
+
+            self.assets.append(Stock(ticker))
+            self.asset_counts[ticker] = 0
+
+    def cost_basis(self):
+        return 0.0
+
+    def realized(self):
+        return 0.0
+
+    def add(self, ticker):
+        """
+        Add a ticker to the watchlist and append it to the file. Returns
+        False if it was already on the list.
+        """
+
+        ticker = ticker.upper()
+        if ticker in self.asset_counts:
+            return False
+
+        f = open(self.name, 'a')
+        f.write('%s\n' % ticker)
+        f.close()
+
+        self.assets.append(Stock(ticker))
+        self.asset_counts[ticker] = 0
+
+        return True
+
+    @timed('watchlist.refresh')
+    def refresh(self, priority=PRIORITY_NORMAL, queue=None, landed=None):
+        """
+        Refresh every ticker, batch_size tickers per request, taking them
+        from queue (see Portfolio.refresh()) if passed. landed(stocks) is
+        called with each batch once it is in. A batch that can't be fetched
+        keeps its old quotes, as for Portfolio.refresh().
+        """
+
+        if queue is None:
+            queue = FetchQueue(self.assets)
+
+        stocks = queue.take(self.batch_size)
+        while stocks:
+            try:
+                quotes = st_query_batch([ s.ticker for s in stocks ],
+                                        priority)
+            except (IOError, ValueError):
+                st_stats_count('refresh.errors')
+                stocks = queue.take(self.batch_size)
+                continue
+
+            st_stats_count('watchlist.batches')
+
+            for symb in quotes.keys():
+                Stock.set_data(symb, quotes[symb])
+
+            if landed:
+                landed(stocks)
+
+            stocks = queue.take(self.batch_size)
+
+    def top_movers(self, k, key=mover_key_change_percent, stocks=None):
+        """
+        Return up to k stocks with the biggest key(quote data), biggest
+        first. Stocks without a quote yet are left out. This is a heap based
+        partial selection: O(n log k) rather than a full sort.
+
+        stocks, if passed, is the subset of the watchlist to pick from.
+        """
+
+        if stocks is None:
+            stocks = self.assets
+
+        quoted = list()
+        for s in stocks:
+            data = s.cached_data()
+            if data:
+                quoted.append((key(data), s))
+
+        return [ s for _, s in heapq.nlargest(k, quoted,
+                                              key=lambda pair: pair[0]) ]
+
+    def nr_quoted(self):
+        """
+        Return how many of the tickers have a quote.
+        """
+
+        nr = 0
+        for s in self.assets:
+            if s.cached_data():
+                nr += 1
+
+        return nr
@@ -1,6 +1,12 @@
 
+import time
+import threading
+import Queue
+
 from asset    import Asset
 from st_query import *
+from st_stats import st_stats_count
+from st_limit import SingleFlight, PRIORITY_HIGH, PRIORITY_NORMAL
 
 class Stock(Asset):
     """
@@ -11,30 +17,227 @@ class Stock(Asset):
     # data and constant refreshing.
     __data_cache = dict()
 
+    # When each cache entry last landed, by ticker.
+    __data_stamp = dict()
+
+    # Quotes older than this (in seconds) are still handed out but get a
+    # background revalidation scheduled. None when a push feed keeps the
+    # cache up to date: it only sends quotes that changed, so an old quote
+    # is just a quiet one and is never stale.
+    max_age = 15.0
+
+    # Whether reading a stock that has never had a quote fetches it. Off
+    # when something else (the quote daemon) already fetches every ticker it
+    # is asked about.
+    fetch_missing = True
+
+    # Set whenever new quote data lands in the cache, from whatever source.
+    # The UI waits on this to know a redraw is worthwhile.
+    updated = threading.Event()
+
+    # Called as func(ticker, data) whenever a quote lands in the cache.
+    __listeners = list()
+
+    # Background revalidation: a queue of tickers to refresh, the set of
+    # tickers already queued, and the worker threads draining the queue.
+    __revalidate_queue   = Queue.Queue()
+    __revalidate_pending = set()
+    __revalidate_lock    = threading.Lock()
+    __revalidate_workers = list()
+    revalidate_threads   = 4
+
+    # Fetches currently in flight, by ticker. The refresh thread, forced
+    # refreshes and cache misses all end up here; concurrent refreshes of
+    # one ticker share a single request. An urgent caller joining a fetch
+    # still queued for the request budget moves it up to its own priority.
+    __flights = SingleFlight(st_query_promote)
+
     def __init__(self, ticker):
         super(Stock, self).__init__(ticker, Asset.STOCK)
 
-    def refresh(self):
+    def refresh(self, priority=PRIORITY_NORMAL):
+        """
+        Refresh the stock data. If a refresh of this ticker is already under
+        way we just wait for that one instead of asking again.
+        """
+
+        Stock.__flights.do(self.ticker, self.__fetch, priority)
+
+    def __fetch(self, priority):
+        stock_data = st_query_quote(self.ticker, priority)
+
+        Stock.set_data(self.ticker, stock_data)
+
+    @staticmethod
+    def set_data(ticker, stock_data):
+        """
+        Replace the cached data for ticker. Used by anything that fetches
+        quotes on behalf of many stocks at once (batch polls, streams).
         """
-        Refresh the stock data.
+
+        Stock.__data_cache[ticker] = stock_data
+        Stock.__data_stamp[ticker] = time.time()
+        Stock.updated.set()
+
+        for func in Stock.__listeners:
+            func(ticker, stock_data)
+
+    @staticmethod
+    def add_listener(func):
+        """
+        Have func(ticker, data) called whenever a quote lands in the cache.
+        It's called from whatever thread fetched the quote, so keep it quick.
+        """
+
+        Stock.__listeners = Stock.__listeners + [ func ]
+
+    @staticmethod
+    def remove_listener(func):
+        Stock.__listeners = [ f for f in Stock.__listeners if f != func ]
+
+    @staticmethod
+    def apply_delta(ticker, delta):
         """
+        Merge a partial quote into the cached data for ticker. The merged dict
+        is built on the side and swapped in so that readers in other threads
+        never see a half updated quote.
+
+        A delta for a ticker with no quote yet has nothing to merge into: it
+        is dropped and a full quote fetched in the background, for later
+        deltas to land on. Returns True if the delta was applied.
+        """
+
+        base = Stock.__data_cache.get(ticker)
+        if not base:
+            st_stats_count('stock.delta_dropped')
+            Stock(ticker).revalidate()
+            return False
+
+        data = dict(base)
+        data.update(delta)
+
+        Stock.set_data(ticker, data)
+
+        return True
+
+    @staticmethod
+    def __revalidate_worker():
+        while True:
+            ticker = Stock.__revalidate_queue.get()
+
+            try:
+                Stock(ticker).refresh()
+            except Exception:
+                # Leave the stale quote in place; the next read past max_age
+                # will try again.
+                st_stats_count('stock.revalidate.error')
+
+            Stock.__revalidate_lock.acquire()
+            Stock.__revalidate_pending.discard(ticker)
+            Stock.__revalidate_lock.release()
+
+    def revalidate(self):
+        """
+        Schedule a background refresh of this stock, unless one is already
+        queued. Never blocks.
+        """
+
+        Stock.__revalidate_lock.acquire()
+
+        if self.ticker in Stock.__revalidate_pending:
+            Stock.__revalidate_lock.release()
+            return
+
+        Stock.__revalidate_pending.add(self.ticker)
+
+        while len(Stock.__revalidate_workers) < Stock.revalidate_threads:
+            t = threading.Thread(target=Stock.__revalidate_worker)
+            t.daemon = True
+            t.start()
+            Stock.__revalidate_workers.append(t)
 
-        stock_data = st_query_quote(self.ticker)
+        Stock.__revalidate_lock.release()
 
-        Stock.__data_cache[self.ticker] = stock_data
+        st_stats_count('stock.revalidate')
+        Stock.__revalidate_queue.put(self.ticker)
 
     def __get_data(self):
         return Stock.__data_cache.get(self.ticker)
 
+    def age(self):
+        """
+        Return how many seconds old the cached quote is, or None if there has
+        never been a quote for this stock.
+        """
+
+        stamp = Stock.__data_stamp.get(self.ticker)
+        if stamp is None:
+            return None
+
+        return time.time() - stamp
+
+    def stale(self):
+        """
+        Returns True if the cached quote is older than max_age. Never True
+        if max_age is None.
+        """
+
+        if Stock.max_age is None:
+            return False
+
+        age = self.age()
+
+        return age is not None and age > Stock.max_age
+
+    def cached_data(self):
+        """
+        Return the cached data, or None, with no side effects at all: nothing
+        is fetched or scheduled. For scanning big lists of stocks.
+        """
+
+        return self.__get_data()
+
+    def peek_data(self):
+        """
+        Return the cached data without ever blocking: None if there has never
+        been a quote. A missing (if fetch_missing is set) or stale quote gets
+        a background revalidation scheduled.
+        """
+
+        data = self.__get_data()
+
+        if (not data and Stock.fetch_missing) or self.stale():
+            self.revalidate()
+
+        return data
+
+    def has_quote(self):
+        """
+        Returns True if there's a quote for this stock, however old. Kicks
+        off a background fetch if there isn't one.
+        """
+
+        return self.peek_data() is not None
+
     def get_data(self):
         """
-        Get the latest data refreshing the stock if it's not present.
+        Get the latest data. A cached quote is returned straight away, even if
+        it is stale (a background revalidation is scheduled for it); only
+        when there has never been a quote do we block on the network. If
+        fetch_missing is off that returns None instead.
         """
 
         data = self.__get_data()
         if not data:
-            self.refresh()
-            data = self.__get_data()
+            st_stats_count('stock.cache.miss')
+            if Stock.fetch_missing:
+                self.refresh(PRIORITY_HIGH)
+                data = self.__get_data()
+        else:
+            st_stats_count('stock.cache.hit')
+
+            if self.stale():
+                self.revalidate()
 
         return data
 
@@ -78,9 +281,6 @@ class Stock(Asset):
         A string describing this stock.
         """
 
-        # Do a refresh first; without this there's not a lot to display.
-        self.refresh()
-
         (p, c, o, v) = self.get_price()
 
         if c > 0:
@@ -90,11 +290,16 @@ class Stock(Asset):
         else:
             arrow = ' '
 
-        return '%6s: $%-8.2f  %s%6.2f%%   | $%-8.2f  vol %d' % (self.ticker,
-                                                                p,
-                                                                arrow, c * 100,
-                                                                o,
-                                                                v)
+        s = '%6s: $%-8.2f  %s%6.2f%%   | $%-8.2f  vol %d' % (self.ticker,
+                                                             p,
+                                                             arrow, c * 100,
+                                                             o,
+                                                             v)
+
+        if self.stale():
+            s += '  (%ds old)' % self.age()
+
+        return s
     def __eq__(self, s):
         if not isinstance(s, Stock):
             return NotImplemented
@@ -130,19 +335,29 @@ class Stock(Asset):
 
 #
 # These functions provide sorting key functions for sorting lists of stocks.
+# They never block: stocks that have yet to see a quote sort as None, which
+# puts them together at one end of the list.
 #
 
 def stock_key_name(s):
+    if not s.has_quote():
+        return None
     return s.name()
 
 def stock_key_symb(s):
-    return s.symb()
+    return s.ticker
 
 def stock_key_price(s):
+    if not s.has_quote():
+        return None
     return s.price()
 
 def stock_key_change_percent(s):
+    if not s.has_quote():
+        return None
     return s.change_percent()
 
 def stock_key_change(s):
+    if not s.has_quote():
+        return None
     return s.change()
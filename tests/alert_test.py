@@ -0,0 +1,103 @@
+#
+# Check price alerts fire on crossings, only once until the price backs off
+# (hysteresis), and that only moved tickers get evaluated.
+#
+
+import sys
+import time
+
+from st_alert   import *
+from st_changes import ChangeFeed
+from stock      import Stock
+from st_stats   import st_stats_counter
+from st_testing import temp_file, temp_path
+
+print 'Testing price alerts!'
+
+log = temp_path(suffix='.log')
+feed = ChangeFeed()
+engine = AlertEngine(feed, log_path=log, price_margin=0.01)
+
+fired = list()
+engine.add_listener(fired.append)
+
+engine.load_rules(temp_file("""
+# Some rules.
+NVDA price above 250 # breakout
+NVDA price below 200
+NVDA price above 250
+AMD change below -5
+"""))
+
+# Thousands of rules on a ticker that never moves.
+for i in range(0, 5000):
+    engine.add_rule(AlertRule('INTC', AlertRule.PRICE, AlertRule.ABOVE,
+                              100 + i * 0.1))
+
+print 'Loaded %d rules' % engine.nr_rules()
+if engine.nr_rules() != 5003:
+    print 'FAIL: duplicate rule was not dropped'
+    sys.exit(1)
+
+def quote(ticker, price, change=0.0):
+    Stock.set_data(ticker, { 'symbol'        : ticker,
+                             'latestPrice'   : price,
+                             'changePercent' : change })
+
+def expect(what, nr):
+    del fired[:]
+    feed.publish()
+    print '%-32s %s' % (what, [ str(a) for a in fired ])
+    if len(fired) != nr:
+        print 'FAIL: expected %d alerts' % nr
+        sys.exit(1)
+
+quote('INTC', 50.0)
+quote('NVDA', 240.0)
+quote('AMD', 10.0, -0.01)
+expect('first quotes', 0)
+
+quote('NVDA', 251.0)
+expect('NVDA crosses 250', 1)
+
+# With a 1% margin the rule re-arms below 247.50. Dipping under 250 but not
+# that far and coming back up doesn't fire it again.
+quote('NVDA', 249.0)
+expect('NVDA dips under 250', 0)
+quote('NVDA', 252.0)
+expect('NVDA back over 250', 0)
+quote('NVDA', 247.6)
+expect('NVDA just over the reset level', 0)
+quote('NVDA', 253.0)
+expect('NVDA still not re-armed', 0)
+
+quote('NVDA', 240.0)
+expect('NVDA backs off', 0)
+quote('NVDA', 255.0)
+expect('NVDA crosses 250 again', 1)
+
+quote('NVDA', 150.0)
+quote('AMD', 9.0, -0.06)
+expect('NVDA and AMD drop', 2)
+
+# INTC hasn't moved so it shouldn't even be looked at.
+before = st_stats_counter('alert.evaluated')
+quote('INTC', 50.0)
+expect('INTC unchanged', 0)
+if st_stats_counter('alert.evaluated') != before:
+    print 'FAIL: unchanged ticker was evaluated'
+    sys.exit(1)
+
+start = time.time()
+quote('INTC', 200.0)
+expect('INTC through a wall of rules', 1001)
+print '  took %.2f ms' % ((time.time() - start) * 1000)
+
+lines = open(log).readlines()
+if len(lines) != 1005:
+    print 'FAIL: expected 1005 lines in the alert log, got %d' % len(lines)
+    sys.exit(1)
+
+engine.close()
+feed.close()
+print 'Done!'
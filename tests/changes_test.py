@@ -0,0 +1,99 @@
+#
+# Feed quotes into the cache and check the change sets the change feed
+# publishes: only moved tickers, coalesced per cycle, and nothing for moves
+# that undo themselves.
+#
+
+import os
+import sys
+import time
+import tempfile
+
+from st_changes import *
+from stock      import Stock
+
+print 'Testing the quote change feed!'
+
+def quote(ticker, price, change=0.0):
+    Stock.set_data(ticker, { 'symbol'        : ticker,
+                             'latestPrice'   : price,
+                             'change'        : change,
+                             'changePercent' : change / price,
+                             'latestVolume'  : 1000 })
+
+feed = ChangeFeed()
+
+hist = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+hist.close()
+writer = HistoryWriter(feed, hist.name)
+
+seen = list()
+feed.subscribe(seen.append)
+
+def expect(what, tickers):
+    changes = feed.publish()
+    print '%-32s %s' % (what, sorted(changes.keys())[:4])
+    if sorted(changes.keys()) != sorted(tickers):
+        print 'FAIL: expected %s' % sorted(tickers)
+        sys.exit(1)
+    return changes
+
+quote('NVDA', 250.0)
+quote('AMD', 100.0)
+changes = expect('first quotes', [ 'NVDA', 'AMD' ])
+if changes['NVDA'].old is not None:
+    print 'FAIL: first quote should have no old value'
+    sys.exit(1)
+
+expect('nothing landed', [])
+
+quote('NVDA', 250.0)
+quote('AMD', 100.0)
+expect('same quotes again', [])
+
+quote('NVDA', 251.0, 1.0)
+quote('NVDA', 252.0, 2.0)
+changes = expect('NVDA moves twice', [ 'NVDA' ])
+if changes['NVDA'].old[0] != 250.0 or changes['NVDA'].price() != 252.0:
+    print 'FAIL: expected 250.0 -> 252.0'
+    sys.exit(1)
+if not changes['NVDA'].moved('change') or \
+   changes['NVDA'].moved('latestVolume'):
+    print 'FAIL: wrong fields flagged as moved'
+    sys.exit(1)
+
+quote('AMD', 99.0, -1.0)
+quote('AMD', 100.0)
+expect('AMD moves and moves back', [])
+
+if len(seen) != 2:
+    print 'FAIL: subscriber called %d times, expected 2' % len(seen)
+    sys.exit(1)
+
+# A big cycle where only a few of the tickers move.
+for i in range(0, 10000):
+    quote('c%05d' % i, 10.0)
+feed.publish()
+
+for i in range(0, 10000):
+    quote('c%05d' % i, 10.0 + (i % 100 == 0))
+
+start = time.time()
+changes = expect('10000 quotes, 100 moved', [ 'c%05d' % i
+                                             for i in range(0, 10000, 100) ])
+print '  publish took %.2f ms' % ((time.time() - start) * 1000)
+
+writer.close()
+feed.close()
+
+lines = open(hist.name).readlines()
+os.unlink(hist.name)
+if len(lines) != 2 + 1 + 10000 + 100:
+    print 'FAIL: %d history lines' % len(lines)
+    sys.exit(1)
+if lines[2].strip().split(',')[1:4] + lines[2].strip().split(',')[5:] != \
+   [ 'NVDA', '252.0', '2.0', '1000' ]:
+    print 'FAIL: bad history line: %s' % lines[2].strip()
+    sys.exit(1)
+
+print 'Done!'
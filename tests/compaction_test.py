@@ -0,0 +1,87 @@
+#
+# Lot compaction: sold out lots are dropped, same day same price buys can be
+# coalesced, and every lot can be traced back to the ledger lines it came
+# from, with the serial and the parallel loader alike.
+#
+
+import st_query
+
+# Quotes are set by hand below; never go to the network.
+st_query.API_URL = 'http://127.0.0.1:1/'
+
+from portfolio  import *
+from stock      import Stock
+from st_testing import temp_file, check
+
+print 'Testing lot compaction!'
+
+Stock.set_data('NVDA', { 'symbol' : 'NVDA', 'latestPrice' : 50.0 })
+Stock.set_data('AMD', { 'symbol' : 'AMD', 'latestPrice' : 10.0 })
+
+# Dividend reinvestment: lots of little buys on the same days.
+path = temp_file("""# Line 1
+Jan 04, 2016 | BUY 100 NVDA 20.00
+Mar 01, 2016 | BUY 1 NVDA 30.00 # DRIP
+Mar 01, 2016 | BUY 2 NVDA 30.00 # DRIP
+Mar 01, 2016 | BUY 3 NVDA 31.00 # DRIP
+Apr 01, 2016 | BUY 10 AMD 5.00
+Mar 01, 2016 | BUY 4 NVDA 30.00 # DRIP
+Jun 01, 2016 | SELL 10 AMD 9.00
+""")
+
+plain = Portfolio(path)
+merged = Portfolio(path, coalesce=True)
+
+# The AMD lot was sold out and is gone.
+check('lots', [ (l.stock.ticker, l.nr) for l in plain.lots ],
+      [ ('NVDA', 100), ('NVDA', 1), ('NVDA', 2), ('NVDA', 3), ('NVDA', 4) ])
+check('sources', [ l.sources for l in plain.lots ],
+      [ [ 2 ], [ 3 ], [ 4 ], [ 5 ], [ 7 ] ])
+check('counts', plain.asset_counts, { 'NVDA' : 110 })
+
+# The three $30 buys on Mar 1st become one lot, remembering all three lines.
+check('merged', [ (l.nr, l.acquire_price, l.sources) for l in merged.lots ],
+      [ (100, 20.0, [ 2 ]), (7, 30.0, [ 3, 4, 7 ]), (3, 31.0, [ 5 ]) ])
+check('counts', merged.asset_counts, plain.asset_counts)
+check('basis', merged.cost_basis(), plain.cost_basis())
+
+# Sells go for the smallest gain on a whole lot first, so the merged lot is
+# picked later than its parts would have been.
+f = open(path, 'a')
+f.write('Jul 01, 2016 | SELL 5 NVDA 45.00\n')
+f.close()
+
+plain = Portfolio(path)
+merged = Portfolio(path, coalesce=True)
+
+check('lots', [ (l.nr, l.sources) for l in plain.lots ],
+      [ (100, [ 2 ]), (1, [ 5 ]), (4, [ 7 ]) ])
+check('merged', [ (l.nr, l.sources) for l in merged.lots ],
+      [ (100, [ 2 ]), (5, [ 3, 4, 7 ]) ])
+
+# Sell everything: nothing is left to look at.
+f = open(path, 'a')
+f.write('Aug 01, 2016 | SELL 105 NVDA 45.00\n')
+f.write('Sep 01, 2016 | BUY 5 NVDA 30.00\n')
+f.close()
+
+for coalesce in (False, True):
+    p = Portfolio(path, coalesce=coalesce)
+    check('sold out', [ (l.nr, l.sources) for l in p.lots ], [ (5, [ 11 ]) ])
+
+# The parallel loader knows its line numbers too.
+lines = [ '# Header' ]
+for i in range(0, 30000):
+    lines.append('Mar %02d, 2016 | BUY 1 NVDA %d.00' % (i % 3 + 1, i % 2 + 1))
+lines.append('Apr 01, 2016 | SELL 29990 NVDA 50.00')
+path = temp_file('\n'.join(lines) + '\n')
+
+got = [ line_no for line_no, tr in load_ledger(path, list(), workers=2,
+                                               line_numbers=True) ]
+check('line numbers', got == range(2, len(lines) + 1), True)
+
+# 30000 buys coalesce into 6 lots; the sell leaves the last few of one.
+p = Portfolio(path, workers=1, coalesce=True)
+check('left', [ (l.nr, len(l.sources)) for l in p.lots ], [ (10, 5000) ])
+
+print 'Done!'
@@ -0,0 +1,52 @@
+#
+# Merge a couple of portfolios and make sure the consolidated totals track
+# the members as they change.
+#
+
+import sys
+
+from datetime   import datetime
+from portfolio  import *
+from lot        import Lot
+from stock      import Stock
+from st_testing import temp_file, check
+
+print 'Testing consolidated portfolios!'
+
+a = Portfolio(temp_file("""
+Jan 02, 2015 | DEPOSIT 1000
+Jan 05, 2015 | BUY 10 NVDA 20.00
+Jan 06, 2015 | BUY 5 AMD 3.00
+"""))
+
+b = Portfolio(temp_file("""
+Feb 02, 2015 | DEPOSIT 500
+Feb 05, 2015 | BUY 4 NVDA 25.00
+Feb 06, 2015 | BUY 2 INTC 30.00
+"""))
+
+c = Consolidated([ a, b ])
+
+check('counts', c.asset_counts, { 'NVDA' : 14, 'AMD' : 5, 'INTC' : 2 })
+check('cash', c.cash, 1500.0)
+check('cost basis', c.cost_basis(), 200.0 + 15.0 + 100.0 + 60.0)
+check('assets', sorted([ s.ticker for s in c.assets ]),
+      [ 'AMD', 'INTC', 'NVDA' ])
+
+# Now change one of the members: drop all the INTC and buy some more AMD.
+b.lots = [ l for l in b.lots if l.stock.ticker != 'INTC' ]
+b.lots.append(Lot(Stock('AMD'), datetime(2015, 3, 1), 4.0, 10))
+b.cash -= 40
+b.accumulate_assets()
+
+check('counts', c.asset_counts, { 'NVDA' : 14, 'AMD' : 15 })
+check('cash', c.cash, 1460.0)
+check('cost basis', c.cost_basis(), 200.0 + 15.0 + 100.0 + 40.0)
+check('assets', sorted([ s.ticker for s in c.assets ]), [ 'AMD', 'NVDA' ])
+
+c.close()
+if a.listeners or b.listeners:
+    print 'FAIL: listeners left behind'
+    sys.exit(1)
+
+print 'Done!'
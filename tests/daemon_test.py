@@ -0,0 +1,131 @@
+#
+# Start a quote daemon against a local stand-in provider, subscribe a bunch
+# of clients to it and check that they all get quotes for the cost of one
+# upstream poll, and that late joiners get the snapshot straight away.
+#
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import urlparse
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from st_daemon  import *
+from st_query   import st_query_set_providers
+from stock      import Stock
+from st_stats   import st_stats_counter
+from st_testing import temp_path
+
+print 'Testing the quote daemon!'
+
+class BatchHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hits += 1
+
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        quotes = dict()
+        for symb in query['symbols'][0].split(','):
+            quotes[symb] = { 'quote' : { 'symbol'      : symb,
+                                         'latestPrice' : 100.0 +
+                                                         self.server.hits } }
+
+        body = json.dumps(quotes)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+provider = HTTPServer(('127.0.0.1', 0), BatchHandler)
+provider.hits = 0
+t = threading.Thread(target=provider.serve_forever)
+t.daemon = True
+t.start()
+
+st_query_set_providers([ 'http://127.0.0.1:%d/' % provider.server_address[1] ])
+
+path = temp_path(suffix='.sock')
+daemon = QuoteDaemon(path, interval=0.5)
+daemon.start()
+
+def connect(tickers):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    send_frame(sock, MSG_SUBSCRIBE, tickers)
+    return (sock, sock.makefile('rb'))
+
+# A pile of terminals watching overlapping sets of tickers.
+clients = list()
+for i in range(0, 8):
+    clients.append(connect([ 'NVDA', 'AMD', 'T%d' % i ]))
+
+# And one real st side client.
+client = DaemonClient(path, [ 'NVDA', 'INTC' ])
+client.start()
+
+time.sleep(2.0)
+
+print 'clients %d, polls %d, upstream requests %d' % (len(daemon.clients),
+                                                      daemon.polls,
+                                                      provider.hits)
+if provider.hits != daemon.polls:
+    print 'FAIL: expected one upstream request per poll'
+    sys.exit(1)
+
+for i, (sock, f) in enumerate(clients):
+    got = set()
+    while not set([ 'NVDA', 'AMD', 'T%d' % i ]) <= got:
+        kind, quotes = read_frame(f)
+        got |= set(quotes.keys())
+    sock.close()
+
+if not Stock('INTC').cached_data():
+    print 'FAIL: daemon client didn\'t fill the stock cache'
+    sys.exit(1)
+
+# Behind the daemon, st never goes to the provider itself: quotes for quiet
+# tickers are as fresh as the daemon's and missing ones are on their way.
+Stock.max_age = None
+Stock.fetch_missing = False
+revalidated = st_stats_counter('stock.revalidate')
+for t in [ 'NVDA', 'INTC', 'NOPE' ]:
+    Stock(t).has_quote()
+if st_stats_counter('stock.revalidate') != revalidated:
+    print 'FAIL: daemon client revalidated quotes with the provider'
+    sys.exit(1)
+
+# A late joiner gets everything the daemon has straight away.
+start = time.time()
+sock, f = connect([ 'NVDA', 'AMD', 'INTC' ])
+kind, snapshot = read_frame(f)
+elapsed = (time.time() - start) * 1000
+print 'snapshot of %d quotes in %.2f ms' % (len(snapshot), elapsed)
+if kind != MSG_QUOTES or sorted(snapshot.keys()) != [ 'AMD', 'INTC', 'NVDA' ]:
+    print 'FAIL: bad snapshot: %s %s' % (kind, snapshot)
+    sys.exit(1)
+
+# Followed by updates as polls move the price.
+kind, quotes = read_frame(f)
+if quotes['NVDA']['latestPrice'] <= snapshot['NVDA']['latestPrice']:
+    print 'FAIL: no update after the snapshot'
+    sys.exit(1)
+sock.close()
+
+client.stop()
+daemon.stop()
+provider.shutdown()
+
+# Give the daemon's connection threads a moment to wind down.
+time.sleep(0.2)
+
+if os.path.exists(path):
+    print 'FAIL: socket left behind'
+    sys.exit(1)
+
+print 'Done!'
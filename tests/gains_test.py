@@ -0,0 +1,153 @@
+#
+# Realized and unrealized gains: check the reliefs and totals on a small
+# ledger, then insert transactions in the past and make sure the result is
+# the same as loading a ledger that had them all along, having replayed only
+# what came after them.
+#
+
+import sys
+import random
+
+import st_query
+
+# Quotes are set by hand below; never go to the network.
+st_query.API_URL = 'http://127.0.0.1:1/'
+
+from portfolio  import *
+from stock      import Stock
+from st_stats   import st_stats_counter
+from st_testing import temp_file, check
+
+print 'Testing gains!'
+
+Stock.set_data('NVDA', { 'symbol' : 'NVDA', 'latestPrice' : 50.0 })
+Stock.set_data('AMD', { 'symbol' : 'AMD', 'latestPrice' : 10.0 })
+
+def load(lines, coalesce=False):
+    return Portfolio(temp_file('\n'.join(lines) + '\n'), coalesce=coalesce)
+
+def rounded(d):
+    return dict([ (k, round(v, 6)) for k, v in d.items() ])
+
+lines = [ 'Jan 04, 2016 | DEPOSIT 10000',
+          'Jan 04, 2016 | BUY 100 NVDA 20.00',
+          'Jun 01, 2016 | BUY 10 AMD 5.00',
+          'Mar 01, 2017 | BUY 50 NVDA 60.00',
+          'Feb 01, 2017 | SELL 10 AMD 8.00',
+          'Jun 01, 2017 | SELL 70 NVDA 40.00' ]
+
+p = load(lines)
+
+# The NVDA sell goes for the smallest gain at today's $50 first: the $60 lot
+# (a loss), then 20 of the $20 lot.
+check('reliefs', [ (r.ticker, r.nr, r.gain, r.long_term, r.sources)
+                   for r in p.reliefs ],
+      [ ('AMD', 10, 30.0, False, [ 3 ]),
+        ('NVDA', 50, -1000.0, False, [ 4 ]),
+        ('NVDA', 20, 400.0, True, [ 2 ]) ])
+# Buys aren't paid out of cash, so sells only credit what they made.
+check('cash', p.cash, 10000 - 570.0)
+check('realized', p.realized(), -570.0)
+check('by ticker', rounded(p.gains.realized_by_ticker),
+      { 'AMD' : 30.0, 'NVDA' : -600.0 })
+check('2017', p.gains.short_long(2017), (-970.0, 400.0))
+check('unrealized', p.unrealized(), { 'NVDA' : 80 * 30.0 })
+check('by year', p.unrealized(by_year=True), { 2016 : 80 * 30.0 })
+check('counts', p.asset_counts, { 'NVDA' : 80 })
+
+# A buy inserted in the past: only what follows it is replayed.
+tr = parse_ledger_line('Apr 01, 2017 | BUY 30 NVDA 45.00')
+check('replayed', p.insert_transaction(tr), 1)
+
+fresh = load(lines[:4] + [ 'Apr 01, 2017 | BUY 30 NVDA 45.00' ] + lines[4:])
+
+def state(p):
+    return (sorted([ (l.stock.ticker, l.date, l.acquire_price, l.nr)
+                     for l in p.lots ]),
+            [ (r.ticker, r.acquired, r.sold, r.nr, r.gain)
+              for r in p.reliefs ],
+            round(p.cash, 6), rounded(p.gains.realized_by_ticker),
+            sorted([ (k, tuple([ round(x, 6) for x in v ]))
+                     for k, v in p.gains.held.items() ]),
+            p.asset_counts)
+
+check('inserted', state(p) == state(fresh), True)
+
+# Selling at what was paid changes nothing but the shares.
+p = load([ 'Jan 04, 2016 | BUY 100 NVDA 20.00',
+           'Feb 04, 2016 | SELL 100 NVDA 20.00' ])
+check('round trip', (p.cash, p.realized(), p.cost_basis()), (0.0, 0.0, 0.0))
+
+# A buy coalesced into a lot bought earlier in the file is taken back by
+# what it bought, not by what the merge left in it.
+p = load([ 'Mar 01, 2016 | BUY 1 NVDA 30.00',
+           'Jan 01, 2016 | DEPOSIT 10',
+           'Mar 01, 2016 | BUY 2 NVDA 30.00' ], coalesce=True)
+p.insert_transaction(parse_ledger_line('Feb 01, 2016 | DEPOSIT 100'))
+check('coalesced', (p.lots[0].nr, p.asset_counts, p.gains.held),
+      (3, { 'NVDA' : 3 }, { ('NVDA', 2016) : [ 3.0, 90.0 ] }))
+
+# Behind the quote daemon nothing is fetched, not even to order lots for a
+# sell: with no quote the dearest lots go first.
+Stock.fetch_missing = False
+requests = st_stats_counter('query.requests')
+lines = [ 'Jan 04, 2016 | BUY 10 XYZ 20.00',
+          'Feb 04, 2016 | BUY 10 XYZ 30.00',
+          'Mar 04, 2016 | BUY 10 XYZ 25.00',
+          'Jun 01, 2016 | SELL 15 XYZ 40.00' ]
+p = load(lines)
+check('unpriced', [ (l.acquire_price, l.nr) for l in p.lots ],
+      [ (20.0, 10), (25.0, 5) ])
+check('requests', st_stats_counter('query.requests'), requests)
+Stock.fetch_missing = True
+
+# With no provider answering the sell is ordered the same way.
+p = load(lines)
+check('no provider', [ (l.acquire_price, l.nr) for l in p.lots ],
+      [ (20.0, 10), (25.0, 5) ])
+
+# Lots of random ledgers with random insertions, coalescing or not, half of
+# them out of date order.
+random.seed(11)
+months = 'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
+
+def random_line(year):
+    day = '%s %02d, %d' % (random.choice(months), random.randint(1, 28), year)
+    if random.random() < 0.1:
+        return '%s | DEPOSIT %d' % (day, random.randint(1, 1000))
+    op = 'SELL' if random.random() < 0.3 else 'BUY'
+    return '%s | %s %d %s %d.00' % (day, op, random.randint(1, 20),
+                                    random.choice([ 'NVDA', 'AMD' ]),
+                                    random.randint(1, 3) * 10)
+
+replayed = 0
+for coalesce in (False, True):
+    for n in range(0, 20):
+        lines = [ random_line(2010 + i / 20) for i in range(0, 200) ]
+        if n % 2:
+            lines.sort(key=lambda l: parse_ledger_line(l)[1])
+        p = load(lines, coalesce)
+
+        # Somewhere in the last couple of years.
+        extra = random_line(2018)
+        replayed += p.insert_transaction(parse_ledger_line(extra))
+
+        # It goes after the last line not dated later.
+        where = len(lines)
+        while where > 0 and parse_ledger_line(lines[where - 1])[1] > \
+              parse_ledger_line(extra)[1]:
+            where -= 1
+
+        fresh = load(lines[:where] + [ extra ] + lines[where:], coalesce)
+
+        if state(p) != state(fresh):
+            print 'FAIL: inserting %s (coalesce %s) differs from a fresh ' \
+                  'load' % (extra, coalesce)
+            sys.exit(1)
+
+print '40 insertions, %d transactions replayed of %d' % (replayed, 40 * 200)
+if replayed >= 40 * 200 / 2:
+    print 'FAIL: replayed too much'
+    sys.exit(1)
+
+print 'Done!'
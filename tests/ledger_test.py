@@ -0,0 +1,64 @@
+#
+# Parse a generated ledger with the parallel bulk loader and make sure it
+# agrees with the line at a time parser, bad line numbers included.
+#
+
+import sys
+import time
+
+from st_ledger  import *
+from st_testing import temp_file
+
+print 'Testing ledger parsing!'
+
+lines = 200000
+if len(sys.argv) > 1:
+    lines = int(sys.argv[1])
+
+text = list()
+bad = list()
+for i in range(0, lines):
+    if i % 50000 == 7:
+        text.append('Mar 99, 2016 | BUY 1 NVDA 1.00\n')
+        bad.append(i + 1)
+    elif i % 3 == 0:
+        text.append('# Just a comment\n')
+    else:
+        text.append('Mar %02d, 2016 | BUY %d NVDA %.2f # lot %d\n' %
+                    (i % 28 + 1, i % 50 + 1, 10.0 + i % 100, i))
+path = temp_file(''.join(text))
+
+start = time.time()
+serial = list()
+serial_bad = list()
+nr = 0
+for line in open(path):
+    nr += 1
+    try:
+        tr = parse_ledger_line(line)
+    except LedgerError:
+        serial_bad.append(nr)
+        continue
+    if tr:
+        serial.append(tr)
+print 'Serial:   %d transactions in %.2f seconds' % (len(serial),
+                                                     time.time() - start)
+
+start = time.time()
+errors = list()
+parallel = list(load_ledger(path, errors, workers=4))
+print 'Parallel: %d transactions in %.2f seconds' % (len(parallel),
+                                                     time.time() - start)
+
+if parallel != serial:
+    print 'FAIL: parallel parse does not match the serial one'
+    sys.exit(1)
+
+parallel_bad = [ e.line_no for e in errors ]
+print 'Bad lines: %s' % parallel_bad
+
+if parallel_bad != bad or serial_bad != bad:
+    print 'FAIL: expected bad lines %s' % bad
+    sys.exit(1)
+
+print 'Done!'
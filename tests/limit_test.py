@@ -0,0 +1,190 @@
+#
+# Check the token bucket keeps to its budget and serves high priority
+# callers first, that single-flight coalesces concurrent calls, and that a
+# refresh fetches what's on screen first.
+#
+
+import sys
+import time
+import threading
+
+from st_limit  import *
+from st_stats  import st_stats_snapshot, st_stats_counter
+from portfolio import refresh_queue, Portfolio
+from st_provider import ProviderError
+
+print 'Testing rate limiting!'
+
+# 20 requests/second, no burst to speak of.
+bucket = TokenBucket(20.0, 1.0)
+
+start = time.time()
+for i in range(0, 10):
+    bucket.acquire()
+elapsed = time.time() - start
+
+print '10 requests took %.2f seconds' % elapsed
+if elapsed < 0.4:
+    print 'FAIL: bucket let requests through too fast'
+    sys.exit(1)
+
+# Queue a bunch of low priority callers and then a high priority one. The
+# high priority caller should get through before most of the low ones.
+order = list()
+order_lock = threading.Lock()
+
+def take(name, prio):
+    bucket.acquire(prio)
+    order_lock.acquire()
+    order.append(name)
+    order_lock.release()
+
+threads = list()
+for i in range(0, 8):
+    t = threading.Thread(target=take, args=('low', PRIORITY_LOW))
+    t.start()
+    threads.append(t)
+
+time.sleep(.05)
+t = threading.Thread(target=take, args=('high', PRIORITY_HIGH))
+t.start()
+threads.append(t)
+
+for t in threads:
+    t.join()
+
+print 'Order: %s' % ' '.join(order)
+if order.index('high') > 2:
+    print 'FAIL: high priority request was not served first'
+    sys.exit(1)
+
+# Single flight: 10 threads asking for the same key should do the work once.
+flight = SingleFlight()
+calls = [ 0 ]
+
+def slow():
+    calls[0] += 1
+    time.sleep(.2)
+    return 42
+
+results = list()
+def ask():
+    results.append(flight.do('NVDA', slow))
+
+threads = [ threading.Thread(target=ask) for i in range(0, 10) ]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+print 'Calls: %d, coalesced: %d, results: %s' % (calls[0], flight.coalesced,
+                                                 results)
+if calls[0] != 1 or results != [ 42 ] * 10:
+    print 'FAIL: calls were not coalesced'
+    sys.exit(1)
+
+# A high priority caller joining a low priority call that is still queued
+# for a token moves it up the queue.
+bucket = TokenBucket(10.0, 1.0)
+bucket.acquire()
+order = list()
+
+flight = SingleFlight(lambda key, prio: bucket.promote(key, prio))
+
+def keyed(prio):
+    bucket.acquire(prio, 'X')
+    return 'X'
+
+threads = [ threading.Thread(target=take, args=('low', PRIORITY_LOW))
+            for i in range(0, 6) ]
+for t in threads:
+    t.start()
+
+time.sleep(.05)
+results = list()
+def ask(prio):
+    results.append(flight.do('X', keyed, prio))
+    order_lock.acquire()
+    order.append('joined')
+    order_lock.release()
+
+for prio in (PRIORITY_LOW, PRIORITY_HIGH):
+    t = threading.Thread(target=ask, args=(prio,))
+    t.start()
+    threads.append(t)
+    time.sleep(.02)
+
+for t in threads:
+    t.join()
+
+print 'Order: %s' % ' '.join(order)
+if results != [ 'X', 'X' ] or order.index('joined') > 2:
+    print 'FAIL: joining did not raise the priority of the queued call'
+    sys.exit(1)
+
+# Fetch order: visible rows, then the ones just off screen, then the rest,
+# each in list order.
+class Fake(object):
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+    def refresh(self, priority):
+        fetched.append(self.ticker)
+
+    def __repr__(self):
+        return self.ticker
+
+fetched = list()
+stocks = [ Fake(t) for t in 'ABCDEFGH' ]
+tiers = { 'G' : TIER_VISIBLE, 'C' : TIER_VISIBLE, 'E' : TIER_NEARBY }
+
+refresh_queue(FetchQueue(stocks, tiers))
+print 'Fetched: %s' % ' '.join(fetched)
+if fetched != list('CGEABDFH'):
+    print 'FAIL: visible stocks were not fetched first'
+    sys.exit(1)
+
+if 'refresh.visible' not in st_stats_snapshot()['latency']:
+    print 'FAIL: time to a complete screen was not recorded'
+    sys.exit(1)
+
+# The view changes half way through: what's left is reordered.
+queue = FetchQueue(stocks, tiers)
+first = queue.take(3)
+queue.set_tiers({ 'H' : TIER_VISIBLE, 'B' : TIER_NEARBY })
+rest = queue.take(100)
+print 'Reordered: %s / %s' % (first, rest)
+if first != [ stocks[2], stocks[6], stocks[4] ] or \
+   [ s.ticker for s in rest ] != list('HBADF') or queue.take():
+    print 'FAIL: queue was not reordered'
+    sys.exit(1)
+
+# One stock failing doesn't stop the rest being fetched.
+class Broken(Fake):
+    def refresh(self, priority):
+        raise ProviderError('All quote providers failed')
+
+del fetched[:]
+landed = list()
+errors = st_stats_counter('refresh.errors')
+refresh_queue(FetchQueue([ stocks[0], Broken('X'), stocks[1] ]),
+              landed=landed.extend)
+print 'With a failure: fetched %s, landed %s' % (fetched, landed)
+if fetched != [ 'A', 'B' ] or landed != [ stocks[0], stocks[1] ] or \
+   st_stats_counter('refresh.errors') != errors + 1:
+    print 'FAIL: a failed fetch abandoned the refresh'
+    sys.exit(1)
+
+# A drained queue is still the caller's queue: refreshing with it fetches
+# nothing rather than starting over with every asset.
+class Held(Portfolio):
+    def __init__(self):
+        self.assets = stocks
+
+del fetched[:]
+Held().refresh(queue=queue)
+if fetched:
+    print 'FAIL: drained queue was replaced by a fresh one: %s' % fetched
+    sys.exit(1)
+
+print 'Done!'
@@ -13,6 +13,9 @@ for i in range(1, len(sys.argv)):
 
     portfolio = Portfolio(sys.argv[i])
 
+    for e in portfolio.errors:
+        print 'Skipped %s' % e
+
     # for tr in portfolio.transactions:
     #     if tr.tr_type == Transaction.BUY or tr.tr_type == Transaction.SELL:
     #         print '%-12s | %-12s %s @ %-8.2f (nr=%d)' % (tr.tr_date,
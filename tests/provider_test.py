@@ -0,0 +1,251 @@
+#
+# Run a couple of local stand-in quote providers with injected latency and
+# failures, and check that requests hedge, fail over and trip the circuit
+# breakers as they should. Then check field projection, compression and
+# conditional requests.
+#
+
+import sys
+import gzip
+import json
+import time
+import urlparse
+import threading
+import StringIO
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer   import ThreadingMixIn
+
+from st_provider import *
+from st_query    import *
+from st_stats    import st_stats_counter
+
+print 'Testing quote providers!'
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.hits += 1
+
+        time.sleep(server.delay)
+
+        if server.fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        if server.broken_304:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        # A full quote has a lot more in it than st needs.
+        quote = { 'symbol'      : 'NVDA',
+                  'latestPrice' : 250.0,
+                  'provider'    : server.name }
+        for i in range(0, 50):
+            quote['otherField%d' % i] = 'x' * 20
+
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        if 'filter' in query:
+            fields = query['filter'][0].split(',') + [ 'provider' ]
+            quote = dict([ (k, v) for k, v in quote.items() if k in fields ])
+
+        body = json.dumps(quote, sort_keys=True)
+        etag = '"%x"' % (hash(body) & 0xffffffff)
+
+        if server.etags and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        headers = [ ('Content-Type', 'application/json') ]
+        if server.etags:
+            headers.append(('ETag', etag))
+
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO.StringIO()
+            z = gzip.GzipFile(fileobj=buf, mode='wb')
+            z.write(body)
+            z.close()
+            body = buf.getvalue()
+            headers.append(('Content-Encoding', 'gzip'))
+
+        self.send_response(200)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StandIn(ThreadingMixIn, HTTPServer):
+    """
+    A provider that answers every quote request after delay seconds, or
+    with a 500 if fail is set.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, name):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+
+        self.name  = name
+        self.delay = 0.0
+        self.fail  = False
+        self.etags = False
+        self.hits  = 0
+
+        # Answer 304 whatever was asked.
+        self.broken_304 = False
+
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+primary = StandIn('primary')
+secondary = StandIn('secondary')
+
+p1 = Provider(primary.url(), 'primary', max_failures=3, reset_timeout=1.0)
+p2 = Provider(secondary.url(), 'secondary', max_failures=3,
+              reset_timeout=1.0)
+providers = ProviderSet([ p1, p2 ])
+
+def fetch():
+    start = time.time()
+    obj = providers.get('stock/NVDA/quote')
+    return (obj['provider'], (time.time() - start) * 1000)
+
+def expect(what, provider, max_ms=None):
+    got, ms = fetch()
+    print '%-40s %-10s %7.1f ms' % (what, got, ms)
+    if got != provider:
+        print 'FAIL: expected an answer from %s' % provider
+        sys.exit(1)
+    if max_ms and ms > max_ms:
+        print 'FAIL: took longer than %d ms' % max_ms
+        sys.exit(1)
+
+# Warm up so the primary has a p95 to hedge on.
+for i in range(0, MIN_HEDGE_SAMPLES):
+    fetch()
+print 'primary p95 %.1f ms, hedging after %.1f ms' % (
+    p1.latency.percentile(95), p1.hedge_delay() * 1000)
+
+expect('healthy primary', 'primary')
+if secondary.hits:
+    print 'FAIL: secondary was sent requests while primary was healthy'
+    sys.exit(1)
+
+# A slow primary gets hedged: the secondary answers well before the primary
+# would have.
+primary.delay = 1.0
+expect('slow primary is hedged', 'secondary', 500)
+primary.delay = 0.0
+
+# Primary down: every request fails over, and after max_failures the
+# breaker opens and the primary isn't bothered any more.
+primary.fail = True
+for i in range(0, p1.max_failures):
+    expect('primary failing (%d)' % (i + 1), 'secondary')
+
+if p1.state != Provider.OPEN:
+    print 'FAIL: breaker should be open, is %s' % p1.state
+    sys.exit(1)
+
+hits = primary.hits
+expect('breaker open', 'secondary')
+if primary.hits != hits:
+    print 'FAIL: request sent to a provider with an open breaker'
+    sys.exit(1)
+
+# After the reset timeout a single trial request goes through. The primary
+# is back, so the breaker closes.
+primary.fail = False
+time.sleep(p1.reset_timeout)
+expect('breaker half-open, primary back', 'primary')
+if p1.state != Provider.CLOSED:
+    print 'FAIL: breaker should be closed, is %s' % p1.state
+    sys.exit(1)
+
+# Everything down.
+primary.fail = True
+secondary.fail = True
+try:
+    fetch()
+    print 'FAIL: expected a ProviderError'
+    sys.exit(1)
+except ProviderError, e:
+    print 'all providers down: %s' % e
+
+# Bandwidth: st_query asks for just the fields it needs, compressed, and
+# conditionally once it has an ETag.
+primary.fail = False
+secondary.fail = False
+primary.etags = True
+time.sleep(p1.reset_timeout)
+
+before = st_stats_counter('query.bytes')
+decoded = st_stats_counter('query.bytes.decoded')
+full = providers.get('stock/NVDA/quote')
+wire = st_stats_counter('query.bytes') - before
+decoded = st_stats_counter('query.bytes.decoded') - decoded
+
+print 'full quote %d bytes, %d bytes on the wire' % (decoded, wire)
+if wire >= decoded:
+    print 'FAIL: response was not compressed'
+    sys.exit(1)
+
+st_query_set_providers([ primary.url() ])
+
+before = st_stats_counter('query.bytes')
+quote = st_query_quote('NVDA')
+wire = st_stats_counter('query.bytes') - before
+
+print 'full quote %d fields, projected %d fields, %d bytes on the wire' % (
+    len(full), len(quote), wire)
+if sorted(quote.keys()) != [ 'latestPrice', 'provider', 'symbol' ]:
+    print 'FAIL: projection not applied: %s' % sorted(quote.keys())
+    sys.exit(1)
+
+not_modified = st_stats_counter('query.not_modified')
+before = st_stats_counter('query.bytes')
+again = st_query_quote('NVDA')
+wire = st_stats_counter('query.bytes') - before
+
+print 'second fetch: %d bytes, %d not modified' % (
+    wire, st_stats_counter('query.not_modified') - not_modified)
+if again != quote or wire or \
+   st_stats_counter('query.not_modified') != not_modified + 1:
+    print 'FAIL: expected a 304 reusing the first answer'
+    sys.exit(1)
+
+# A 304 to a request we sent no validators with is a provider failure: it
+# counts against the breaker and the request fails over.
+primary.broken_304 = True
+p1 = Provider(primary.url(), 'primary', max_failures=3, reset_timeout=1.0)
+p2 = Provider(secondary.url(), 'secondary', max_failures=3,
+              reset_timeout=1.0)
+providers = ProviderSet([ p1, p2 ])
+
+try:
+    p1.get('stock/NVDA/quote')
+    print 'FAIL: bare 304 was taken as an answer'
+    sys.exit(1)
+except ProviderError:
+    pass
+
+expect('primary 304s with nothing cached', 'secondary')
+if p1.failures != 1:
+    print 'FAIL: bare 304 was not counted against the breaker'
+    sys.exit(1)
+
+primary.shutdown()
+secondary.shutdown()
+
+print 'Done!'
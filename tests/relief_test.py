@@ -0,0 +1,115 @@
+#
+# Replay ledgers under each lot relief strategy. A small hand worked ledger
+# checks the numbers; a big generated one checks that the parallel replay
+# agrees with the serial one.
+#
+
+import sys
+import time
+import random
+
+from st_relief  import *
+from st_testing import temp_file
+
+print 'Testing lot relief strategies!'
+
+def ledger(lines):
+    errors = list()
+    trades = ledger_trades(temp_file('\n'.join(lines) + '\n'), errors)
+
+    if errors:
+        print 'FAIL: unexpected parse errors: %s' % errors
+        sys.exit(1)
+
+    return trades
+
+def close(a, b):
+    return abs(a - b) < 1e-6
+
+# Three lots, then a sale of 150 at $30 two years after the first buy.
+trades = ledger([ '# Three lots of NVDA.',
+                  'Jan 04, 2016 | DEPOSIT 10000',
+                  'Jan 04, 2016 | BUY 100 NVDA 10.00',
+                  'Jun 01, 2017 | BUY 100 NVDA 40.00',
+                  'Nov 01, 2017 | BUY 100 NVDA 20.00',
+                  'Jan 05, 2018 | SELL 150 NVDA 30.00 # Some of it' ])
+
+if len(trades) != 4:
+    print 'FAIL: expected 4 trades, got %d' % len(trades)
+    sys.exit(1)
+
+# strategy: (short term, long term, remaining cost basis)
+expected = {
+    # 100 @ 10 (long) + 50 @ 40 (short).
+    FIFO     : (-500.0, 2000.0, 50 * 40.0 + 100 * 20.0),
+    # 100 @ 20 (short) + 50 @ 40 (short).
+    LIFO     : (500.0, 0.0, 100 * 10.0 + 50 * 40.0),
+    # 100 @ 40 (short) + 50 @ 20 (short).
+    HIFO     : (-500.0, 0.0, 100 * 10.0 + 50 * 20.0),
+}
+
+for r in compare(trades):
+    print r
+    short, long, basis = expected[r.strategy]
+    if not close(r.short_term, short) or not close(r.long_term, long) or \
+       not close(r.cost_basis, basis):
+        print 'FAIL: expected short %.2f long %.2f basis %.2f' % (short, long,
+                                                                 basis)
+        sys.exit(1)
+    if not close(r.proceeds, 150 * 30.0) or r.unmatched or r.lots != 2:
+        print 'FAIL: bad proceeds, unmatched shares or lot count'
+        sys.exit(1)
+
+# Selling more than there is.
+r = replay(ledger([ 'Mar 01, 2016 | BUY 10 AMD 5.00',
+                    'Mar 02, 2016 | SELL 15 AMD 6.00' ]), FIFO)
+if r.unmatched != 5 or not close(r.realized(), 10.0) or r.lots:
+    print 'FAIL: oversold ledger: unmatched %.2f realized %.2f' % (
+        r.unmatched, r.realized())
+    sys.exit(1)
+
+# Holding periods straddling a year, and a leap day.
+import datetime
+d = datetime.datetime
+if long_term(d(2016, 3, 1), d(2017, 3, 1)) or \
+   not long_term(d(2016, 3, 1), d(2017, 3, 2)) or \
+   long_term(d(2016, 2, 29), d(2017, 3, 1)) or \
+   not long_term(d(2016, 2, 29), d(2017, 3, 2)):
+    print 'FAIL: long_term() is wrong'
+    sys.exit(1)
+
+# A big ledger: parallel and serial replays must agree exactly.
+nr = 200000
+if len(sys.argv) > 1:
+    nr = int(sys.argv[1])
+
+random.seed(7)
+tickers = [ 'NVDA', 'AMD', 'INTC', 'AAPL', 'MSFT', 'GOOG', 'IBM', 'QCOM' ]
+lines = list()
+for i in range(0, nr):
+    month = 'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()[i % 12]
+    date = '%s %02d, %d' % (month, i % 28 + 1, 2010 + i * 10 / nr)
+    op = 'SELL' if random.random() < 0.3 else 'BUY'
+    lines.append('%s | %s %d %s %.2f' % (date, op, random.randint(1, 100),
+                                         random.choice(tickers),
+                                         random.uniform(10.0, 100.0)))
+trades = ledger(lines)
+
+start = time.time()
+serial = compare(trades, workers=1)
+print 'Serial:   %d trades, %d strategies in %.2f seconds' % (
+    len(trades), len(serial), time.time() - start)
+
+start = time.time()
+parallel = compare(trades, workers=4)
+print 'Parallel: %d trades, %d strategies in %.2f seconds' % (
+    len(trades), len(parallel), time.time() - start)
+
+for r in parallel:
+    print r
+
+if serial != parallel:
+    print 'FAIL: parallel replay does not match the serial one'
+    sys.exit(1)
+
+print 'Done!'
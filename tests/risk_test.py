@@ -0,0 +1,122 @@
+#
+# Monte Carlo risk on synthetic daily history: check results are reproducible
+# with a seed, don't depend on the number of workers, and that the numbers
+# make sense (correlation kept, ES beyond VaR, and so on).
+#
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import numpy as np
+
+import st_query
+
+# No quotes from anywhere: holdings are valued at their last close.
+st_query.API_URL = 'http://127.0.0.1:1/'
+
+from st_risk   import *
+from portfolio import Portfolio
+from stock     import Stock
+
+print 'Testing risk simulation!'
+
+# Two years of NVDA and AMD that move together, plus a calm INTC.
+random.seed(3)
+hist = tempfile.NamedTemporaryFile(suffix='.csv', delete=False)
+prices = { 'NVDA' : 200.0, 'AMD' : 100.0, 'INTC' : 50.0 }
+for day in range(0, 500):
+    date = '%04d-%02d-%02d' % (2016 + day / 250, (day / 21) % 12 + 1,
+                               day % 21 + 1)
+    market = random.gauss(0.0, 0.02)
+    prices['NVDA'] *= np.exp(market * 1.5 + random.gauss(0.0, 0.005))
+    prices['AMD'] *= np.exp(market * 1.5 + random.gauss(0.0, 0.005))
+    prices['INTC'] *= np.exp(random.gauss(0.0, 0.005))
+    for t in sorted(prices.keys()):
+        hist.write('%s,%s,%.4f\n' % (date, t, prices[t]))
+hist.close()
+
+closes = load_daily_closes(hist.name)
+os.unlink(hist.name)
+
+returns = returns_matrix(closes, [ 'NVDA', 'AMD' ])
+corr = np.corrcoef(returns, rowvar=False)[0][1]
+print 'history: %d days, NVDA/AMD correlation %.2f' % (len(returns), corr)
+
+a = simulate(returns, [ 5000.0, 5000.0 ], 10, 10000, seed=42, workers=1)
+b = simulate(returns, [ 5000.0, 5000.0 ], 10, 10000, seed=42, workers=1)
+if not np.array_equal(a, b):
+    print 'FAIL: same seed, different results'
+    sys.exit(1)
+
+# Lots of work so that the pool is really used.
+start = time.time()
+serial = simulate(returns, [ 5000.0, 5000.0 ], 20, 500000, seed=7, workers=1)
+t_serial = time.time() - start
+start = time.time()
+pooled = simulate(returns, [ 5000.0, 5000.0 ], 20, 500000, seed=7, workers=2)
+t_pooled = time.time() - start
+print '500k paths: serial %.2fs, 2 workers %.2fs' % (t_serial, t_pooled)
+if not np.array_equal(serial, pooled):
+    print 'FAIL: results depend on the number of workers'
+    sys.exit(1)
+
+# Correlated holdings don't diversify: a 50/50 NVDA/AMD split should be
+# nearly as risky as all NVDA, and much riskier than NVDA/INTC.
+def var(tickers):
+    r = returns_matrix(closes, tickers)
+    vals = [ 10000.0 / len(tickers) ] * len(tickers)
+    return RiskReport(10000.0, simulate(r, vals, 10, 20000, seed=1),
+                      10).var()
+
+v_nvda = var([ 'NVDA' ])
+v_pair = var([ 'NVDA', 'AMD' ])
+v_mixed = var([ 'NVDA', 'INTC' ])
+print '10d VaR95 on $10k: NVDA %.0f, NVDA+AMD %.0f, NVDA+INTC %.0f' % (
+    v_nvda, v_pair, v_mixed)
+if not (v_pair > 0.85 * v_nvda and v_mixed < 0.7 * v_pair):
+    print 'FAIL: correlation not reflected'
+    sys.exit(1)
+
+# A portfolio, valued from the last closes. TSLA has a quote but no history
+# so it is held at today's value; XYZ has neither and can't be valued.
+ledger = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+ledger.write('Jan 02, 2015 | DEPOSIT 100000\n'
+             'Jan 03, 2015 | BUY 10 NVDA 50\n'
+             'Jan 03, 2015 | BUY 20 AMD 20\n'
+             'Jan 03, 2015 | BUY 5 TSLA 200\n'
+             'Jan 03, 2015 | BUY 7 XYZ 10\n')
+ledger.close()
+p = Portfolio(ledger.name)
+os.unlink(ledger.name)
+
+Stock.set_data('TSLA', { 'symbol' : 'TSLA', 'latestPrice' : 300.0 })
+
+def last(t):
+    return closes[t][max(closes[t].keys())]
+
+start = 100000 + 10 * last('NVDA') + 20 * last('AMD') + 5 * 300.0
+
+for method in (BOOTSTRAP, NORMAL):
+    report = portfolio_risk(p, closes, horizon=10, paths=20000,
+                            method=method, seed=5)
+    floor = report.start - 2 * report.var()
+    print '%-10s %s' % (method, report.describe(floor))
+
+    if report.missing != [ 'TSLA' ] or report.unpriced != [ 'XYZ' ]:
+        print 'FAIL: TSLA and XYZ should be reported'
+        sys.exit(1)
+    if abs(report.start - start) > 1e-6 or \
+       'not valued: XYZ' not in report.describe():
+        print 'FAIL: expected a start of $%.2f without XYZ' % start
+        sys.exit(1)
+    if not (0 < report.var() <= report.expected_shortfall()):
+        print 'FAIL: expected 0 < VaR <= ES'
+        sys.exit(1)
+    if not (report.prob_below(floor) < 0.05 < report.prob_below(report.start)):
+        print 'FAIL: bad floor probabilities'
+        sys.exit(1)
+
+print 'Done!'
@@ -0,0 +1,70 @@
+#
+# Check the price ring buffers wrap without growing and that sparklines are
+# rendered at sample time, not at draw time.
+#
+
+import sys
+
+from st_spark import *
+from stock    import Stock
+
+print 'Testing sparklines!'
+
+ring = PriceRing(5)
+for p in range(0, 12):
+    ring.add(float(p))
+
+got = [ ring[i] for i in range(0, len(ring)) ]
+print 'ring of 5 after 12 prices:   %s' % got
+if got != [ 7.0, 8.0, 9.0, 10.0, 11.0 ]:
+    print 'FAIL: expected the last 5 prices, oldest first'
+    sys.exit(1)
+
+rising = ring.render(5)
+print 'rising:                      %s' % rising
+if rising != ''.join([ SPARK_CHARS[i] for i in (0, 2, 4, 5, 7) ]):
+    print 'FAIL: bad rising sparkline'
+    sys.exit(1)
+
+flat = PriceRing(4)
+for i in range(0, 4):
+    flat.add(10.0)
+if flat.render() != SPARK_CHARS[3] * 4:
+    print 'FAIL: bad flat sparkline'
+    sys.exit(1)
+
+# A long session: the buffers stay where they are and the same size.
+sparks = SparkLines()
+stocks = [ Stock('S%02d' % i) for i in range(0, 20) ]
+
+for i in range(0, 20):
+    Stock.set_data(stocks[i].ticker, { 'symbol'      : stocks[i].ticker,
+                                       'latestPrice' : 100.0 })
+sparks.sample(stocks)
+
+where = dict([ (t, r.prices.buffer_info()) for t, r in sparks.rings.items() ])
+
+for n in range(0, 3 * RING_SIZE):
+    for s in stocks:
+        Stock.set_data(s.ticker, { 'symbol'      : s.ticker,
+                                   'latestPrice' : 100.0 + n % 50 })
+    sparks.sample(stocks)
+
+for t, r in sparks.rings.items():
+    if r.prices.buffer_info() != where[t] or len(r) != RING_SIZE:
+        print 'FAIL: ring for %s moved or grew' % t
+        sys.exit(1)
+print '%d samples each for %d stocks, rings unchanged' % (3 * RING_SIZE + 1,
+                                                         len(stocks))
+
+line = sparks.line('S00')
+print 'sparkline:                   %s' % line
+if sparks.line('S00') is not line or len(line.decode('utf-8')) != SPARK_WIDTH:
+    print 'FAIL: drawing should reuse the rendered sparkline'
+    sys.exit(1)
+
+if sparks.line('NOPE') != '':
+    print 'FAIL: unsampled stocks have no sparkline'
+    sys.exit(1)
+
+print 'Done!'
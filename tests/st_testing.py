@@ -0,0 +1,58 @@
+#
+# Helpers shared by the tests: scratch files that are cleaned up however the
+# test ends, and a check that prints what it compared.
+#
+
+import os
+import sys
+import atexit
+import tempfile
+
+# Scratch files to remove when the test exits.
+__temp_files = list()
+
+def __remove_temp_files():
+    for path in __temp_files:
+        if os.path.exists(path):
+            os.unlink(path)
+
+atexit.register(__remove_temp_files)
+
+def temp_path(suffix='.txt'):
+    """
+    Return the name of a scratch file that doesn't exist yet, for code that
+    writes its own files (logs, dumps). Whatever ends up there is removed
+    when the test exits.
+    """
+
+    f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    f.close()
+    os.unlink(f.name)
+
+    __temp_files.append(f.name)
+
+    return f.name
+
+def temp_file(text, suffix='.txt'):
+    """
+    Write text (a ledger, a watchlist, ...) to a scratch file and return its
+    name. It's removed when the test exits, pass or fail.
+    """
+
+    path = temp_path(suffix)
+
+    f = open(path, 'w')
+    f.write(text)
+    f.close()
+
+    return path
+
+def check(what, got, want):
+    """
+    Print what was got and fail the test if it isn't what was wanted.
+    """
+
+    print '%-12s %s' % (what, got)
+    if got != want:
+        print 'FAIL: expected %s' % (want,)
+        sys.exit(1)
@@ -0,0 +1,97 @@
+#
+# Start up benchmark: how long from launching st to the first frame, and to
+# the first portfolio being drawn. st is run in a pseudo terminal with
+# --bench-startup against a generated ledger.
+#
+# Usage: startup_bench.py [ledger lines] [runs]
+#
+
+import os
+import re
+import sys
+import pty
+import time
+import fcntl
+import struct
+import select
+import termios
+import tempfile
+
+lines = 100000
+runs = 5
+
+if len(sys.argv) > 1:
+    lines = int(sys.argv[1])
+if len(sys.argv) > 2:
+    runs = int(sys.argv[2])
+
+# Only buys and deposits: sells need quotes to pick lots, and we don't want
+# the network in the way of a start up benchmark.
+ledger = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+ledger.write('Jan 02, 2015 | DEPOSIT 1000000\n')
+tickers = [ 'NVDA', 'AMD', 'INTC', 'AAPL', 'MSFT', 'GOOG', 'AMZN', 'TSLA' ]
+for i in range(0, lines):
+    ledger.write('Mar %02d, 2016 | BUY %d %s %.2f # lot %d\n' %
+                 (i % 28 + 1, i % 50 + 1, tickers[i % len(tickers)],
+                  10.0 + i % 100, i))
+ledger.close()
+
+st = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                  '..', 'pysrc', 'st.py')
+
+def run_once():
+    """
+    Run st once; returns (wall ms, first frame ms, portfolio frame ms).
+    """
+
+    start = time.time()
+    pid, fd = pty.fork()
+
+    if pid == 0:
+        os.environ['TERM'] = 'xterm'
+        os.execv(sys.executable,
+                 [ sys.executable, st, '--bench-startup', ledger.name ])
+
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', 40, 120, 0, 0))
+
+    out = ''
+    while True:
+        r, _, _ = select.select([ fd ], [], [], 30.0)
+        if not r:
+            break
+        try:
+            data = os.read(fd, 4096)
+        except OSError:
+            break
+        if not data:
+            break
+        out += data
+
+    os.waitpid(pid, 0)
+    wall = (time.time() - start) * 1000.0
+
+    m = re.search(r'first_frame_ms=([\d.]+) portfolio_frame_ms=([\d.]+)', out)
+    if not m:
+        print 'st did not report start up times!'
+        sys.exit(1)
+
+    return (wall, float(m.group(1)), float(m.group(2)))
+
+print 'Start up benchmark: %d ledger lines, %d runs' % (lines, runs)
+
+results = list()
+for i in range(0, runs):
+    results.append(run_once())
+    print '  run %d: wall %8.1f ms  first frame %8.1f ms  portfolio %8.1f ms' \
+        % ((i + 1,) + results[-1])
+
+def median(vals):
+    vals = sorted(vals)
+    return vals[len(vals) / 2]
+
+print 'Median: wall %8.1f ms  first frame %8.1f ms  portfolio %8.1f ms' % (
+    median([ r[0] for r in results ]),
+    median([ r[1] for r in results ]),
+    median([ r[2] for r in results ]))
+
+os.unlink(ledger.name)
@@ -0,0 +1,49 @@
+#
+# Check that the stats histograms and the JSON dump make sense.
+#
+
+import sys
+import json
+
+from st_stats   import *
+from st_testing import temp_path
+
+print 'Testing stats!'
+
+@timed('test.func')
+def func(x):
+    return x * 2
+
+for i in range(0, 100):
+    func(i)
+
+for ms in range(1, 101):
+    st_stats_record('test.latency', ms)
+
+st_stats_count('stock.cache.hit', 3)
+st_stats_count('stock.cache.miss')
+
+h = st_stats_histogram('test.latency')
+print 'p50 = %.2f  p95 = %.2f  max = %.2f' % (h.percentile(50),
+                                              h.percentile(95), h.max)
+
+if h.percentile(50) != 50 or h.percentile(95) != 100 or h.max != 100:
+    print 'FAIL: bad percentiles'
+    sys.exit(1)
+
+if st_stats_hit_rate('stock.cache') != 0.75:
+    print 'FAIL: bad hit rate'
+    sys.exit(1)
+
+path = temp_path(suffix='.json')
+st_stats_dump(path)
+snap = json.load(open(path))
+
+if snap['latency']['test.func']['count'] != 100:
+    print 'FAIL: bad dump: %s' % snap
+    sys.exit(1)
+
+for l in st_stats_lines():
+    print l
+
+print 'Done!'
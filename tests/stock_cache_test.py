@@ -0,0 +1,73 @@
+#
+# Make sure reads from the stock cache never block once there's a quote, even
+# a stale one, and that stale reads schedule a revalidation.
+#
+
+import sys
+import time
+
+import st_query
+
+from stock    import *
+from st_stats import st_stats_counter
+
+# Nothing should reach the network here; point any stray fetches somewhere
+# that fails fast.
+st_query.API_URL = 'http://127.0.0.1:1/'
+
+print 'Testing stale-while-revalidate reads!'
+
+Stock.set_data('NVDA', { 'symbol'         : 'NVDA',
+                         'companyName'    : 'NVIDIA Corporation',
+                         'latestPrice'    : 231.4,
+                         'change'         : 1.2,
+                         'changePercent'  : 0.0052,
+                         'open'           : 230.0,
+                         'avgTotalVolume' : 1000000 })
+
+s = Stock('NVDA')
+
+if s.stale() or s.age() is None:
+    print 'FAIL: fresh quote looks stale'
+    sys.exit(1)
+
+# Pretend the quote is ancient.
+Stock.max_age = 0.0
+time.sleep(.01)
+
+start = time.time()
+price = s.price()
+elapsed = time.time() - start
+
+print 'Stale read of %s took %.4f seconds' % (repr(s), elapsed)
+
+if price != 231.4 or elapsed > 0.05:
+    print 'FAIL: stale read did not return the cached quote straight away'
+    sys.exit(1)
+
+if not st_stats_counter('stock.revalidate'):
+    print 'FAIL: no revalidation was scheduled'
+    sys.exit(1)
+
+# With a push feed nothing is stale, however old, and nothing is
+# revalidated behind the feed's back.
+Stock.set_data('AMD', { 'symbol' : 'AMD', 'latestPrice' : 10.0 })
+Stock.max_age = None
+time.sleep(.01)
+
+revalidated = st_stats_counter('stock.revalidate')
+s = Stock('AMD')
+s.price()
+if s.stale() or st_stats_counter('stock.revalidate') != revalidated:
+    print 'FAIL: quote revalidated with no max age'
+    sys.exit(1)
+
+# A stock that's never been quoted sorts as None rather than blocking.
+if stock_key_price(Stock('NOPE')) is not None:
+    print 'FAIL: unquoted stock should sort as None'
+    sys.exit(1)
+
+# Let the (failing) background revalidations finish up.
+time.sleep(.5)
+
+print 'Done!'
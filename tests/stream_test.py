@@ -0,0 +1,152 @@
+#
+# Replay some ticks through the stand-in feed server and make sure a quote
+# stream applies them to the stock cache - including after the feed drops
+# and comes back, and by polling when there's no feed at all.
+#
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import urlparse
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import st_query
+
+# The only quotes fetched here are the ones that fail on purpose.
+st_query.API_URL = 'http://127.0.0.1:1/'
+
+from st_feed_server import FeedServer, load_ticks
+from st_stream      import QuoteStream
+from stock          import Stock
+from st_stats       import st_stats_counter
+from st_query       import st_query_set_providers
+
+print 'Testing quote stream!'
+
+# Deltas only make sense on top of a full quote.
+Stock.set_data('NVDA', { 'symbol'         : 'NVDA',
+                         'companyName'    : 'NVIDIA Corporation',
+                         'latestPrice'    : 231.4,
+                         'change'         : 1.2,
+                         'changePercent'  : 0.0052,
+                         'open'           : 230.0,
+                         'avgTotalVolume' : 1000000 })
+
+ticks = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+for i in range(0, 50):
+    ticks.write('{"symbol": "NVDA", "latestPrice": %d.0, "change": 1.0}\n' % i)
+    ticks.write('{"symbol": "AMD", "latestPrice": %d.5}\n' % i)
+ticks.close()
+
+server = FeedServer(('127.0.0.1', 0), load_ticks(ticks.name), rate=200.0)
+server.start()
+
+stream = QuoteStream(server.url(), [ 'NVDA', 'AMD' ], retry_interval=0.1)
+stream.start()
+
+# Get part way through the replay...
+stream.updated.wait(10)
+time.sleep(.1)
+stream.stop()
+
+first_id = stream.last_id
+print 'Stopped at event %s: NVDA = %s' % (first_id,
+                                          Stock('NVDA').get_data())
+
+# And resume from where we left off.
+stream.start()
+deadline = time.time() + 10
+while time.time() < deadline and stream.last_id != '98':
+    time.sleep(.05)
+stream.stop()
+server.stop()
+
+nvda = Stock('NVDA').get_data()
+
+if nvda['latestPrice'] != 49.0 or nvda['change'] != 1.0:
+    print 'FAIL: NVDA did not end on the last tick: %s' % nvda
+    sys.exit(1)
+
+if int(stream.last_id) <= int(first_id):
+    print 'FAIL: stream did not resume (%s -> %s)' % (first_id, stream.last_id)
+    sys.exit(1)
+
+# AMD ticks arrived before AMD ever had a quote: rather than make up a quote
+# out of a price and nothing else, they were dropped and a full quote asked
+# for (which failed here).
+amd = Stock('AMD')
+print 'AMD = %s, %d deltas dropped' % (amd.cached_data(),
+                                       st_stats_counter('stock.delta_dropped'))
+if amd.cached_data() is not None or amd.has_quote() or \
+   not st_stats_counter('stock.delta_dropped'):
+    print 'FAIL: delta without a quote to merge into was applied'
+    sys.exit(1)
+
+os.unlink(ticks.name)
+
+# An empty replay on a loop just ends the stream.
+empty = FeedServer(('127.0.0.1', 0), list(), rate=0, loop=True)
+errors = list()
+empty.handle_error = lambda request, address: errors.append(address)
+empty.start()
+stream = QuoteStream(empty.url(), [ 'NVDA' ], retry_interval=0.1)
+stream.start()
+time.sleep(.3)
+stream.stop()
+empty.stop()
+
+if errors or stream.failures:
+    print 'FAIL: empty looping replay broke the feed'
+    sys.exit(1)
+
+# No feed at all: after a few failed connects the stream polls the provider
+# for its tickers instead.
+class BatchHandler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        quotes = dict()
+        for symb in query['symbols'][0].split(','):
+            quotes[symb] = { 'quote' : { 'symbol'      : symb,
+                                         'latestPrice' : 42.0 } }
+
+        body = json.dumps(quotes)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+provider = HTTPServer(('127.0.0.1', 0), BatchHandler)
+t = threading.Thread(target=provider.serve_forever)
+t.daemon = True
+t.start()
+
+st_query_set_providers([ 'http://127.0.0.1:%d/' % provider.server_address[1] ])
+
+stream = QuoteStream('http://127.0.0.1:1/', [ 'INTC' ], poll_interval=0.1,
+                     retry_interval=0.1, max_failures=2)
+stream.start()
+
+deadline = time.time() + 10
+while time.time() < deadline and not Stock('INTC').cached_data():
+    time.sleep(.05)
+polling = stream.polling
+stream.stop()
+provider.shutdown()
+
+intc = Stock('INTC').cached_data()
+print 'Feed down, polling %s: INTC = %s' % (polling, intc)
+if not polling or not intc or intc['latestPrice'] != 42.0:
+    print 'FAIL: no quotes by polling with the feed down'
+    sys.exit(1)
+
+# Let the (failing) background fetches finish up.
+time.sleep(.5)
+
+print 'Done!'
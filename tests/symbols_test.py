@@ -0,0 +1,115 @@
+#
+# Build a symbol directory of ~10k symbols from a cache file and check prefix
+# search, the daily refresh logic and the incremental row filter.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+import st_query
+
+# Nothing listens here: any attempt to fetch the directory fails fast.
+st_query.API_URL = 'http://127.0.0.1:1/'
+
+from st_symbols import *
+from stock      import Stock
+
+print 'Testing symbol search!'
+
+random.seed(7)
+
+words = [ 'Advanced', 'Micro', 'Devices', 'Apple', 'Applied', 'Materials',
+          'Intel', 'Nvidia', 'Corp', 'Holdings', 'Energy', 'Bank', 'Global',
+          'Systems', 'Capital', 'Group', 'Pharma', 'Technologies' ]
+
+pairs = [ [ 'AMD', 'Advanced Micro Devices Inc.' ],
+          [ 'AAPL', 'Apple Inc.' ],
+          [ 'AMAT', 'Applied Materials, Inc.' ],
+          [ 'NVDA', 'NVIDIA Corporation' ] ]
+for i in range(0, 10000):
+    pairs.append([ 'Z%04d' % i, ' '.join(random.sample(words, 3)) ])
+
+cache = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+json.dump(pairs, cache)
+cache.close()
+
+directory = SymbolDirectory(cache.name)
+if not directory.fresh():
+    print 'FAIL: a brand new cache should be fresh'
+    sys.exit(1)
+
+start = time.time()
+nr = directory.load()
+print 'loaded %d symbols in %.1f ms' % (nr, (time.time() - start) * 1000)
+if nr != len(pairs):
+    print 'FAIL: expected %d symbols' % len(pairs)
+    sys.exit(1)
+
+def expect(prefix, want, limit=10):
+    start = time.time()
+    got = directory.search(prefix, limit)
+    ms = (time.time() - start) * 1000
+    print 'search %-8s %6.3f ms  %s' % (repr(prefix), ms, got[0:6])
+    if got[0:len(want)] != want:
+        print 'FAIL: expected %s first' % want
+        sys.exit(1)
+    return got
+
+expect('am', [ 'AMAT', 'AMD' ])
+expect('nvd', [ 'NVDA' ])
+expect('appl', [ 'AAPL' ])             # By company name.
+expect('applied', [ 'AMAT' ])
+expect('micro', [ 'AMD' ])
+if len(expect('z', [ 'Z0000', 'Z0001' ], 50)) != 50:
+    print 'FAIL: search should stop at the limit'
+    sys.exit(1)
+expect('qqqq', [])
+
+# A day old cache gets refetched; with the provider down the old cache still
+# gets used.
+old = time.time() - MAX_AGE - 60
+os.utime(cache.name, (old, old))
+if directory.fresh():
+    print 'FAIL: a day old cache is stale'
+    sys.exit(1)
+
+stale = SymbolDirectory(cache.name)
+if stale.load() != len(pairs):
+    print 'FAIL: stale cache not used when the provider is down'
+    sys.exit(1)
+os.unlink(cache.name)
+
+# Filter as you type over 10k holdings.
+stocks = [ Stock(t) for t, _ in pairs ]
+f = SymbolFilter(stocks, directory)
+
+worst = 0
+for c in 'applied':
+    start = time.time()
+    f.push(c)
+    worst = max(worst, (time.time() - start) * 1000)
+    print 'filter %-8s %5d rows' % (repr(f.query), len(f.result()))
+
+print 'slowest keystroke %.2f ms' % worst
+if [ s.ticker for s in f.result() if not s.ticker.startswith('Z') ] != \
+   [ 'AMAT' ]:
+    print 'FAIL: expected AMAT to match "applied"'
+    sys.exit(1)
+
+for i in range(0, 3):
+    f.pop()
+if f.query != 'appl' or 'AAPL' not in [ s.ticker for s in f.result() ]:
+    print 'FAIL: backspace should widen the filter again'
+    sys.exit(1)
+
+for i in range(0, 10):
+    f.pop()
+if len(f.result()) != len(stocks):
+    print 'FAIL: empty filter should show everything'
+    sys.exit(1)
+
+print 'Done!'
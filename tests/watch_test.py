@@ -0,0 +1,59 @@
+#
+# Load a big watchlist, fake up quotes for it and check the top movers
+# selection against a full sort.
+#
+
+import sys
+import time
+import random
+
+from st_watch   import *
+from stock      import Stock
+from st_testing import temp_file
+
+print 'Testing watchlists!'
+
+nr = 10000
+random.seed(42)
+
+wl = Watchlist(temp_file('# A big watchlist\n' +
+                         ''.join([ 'w%05d\n' % i for i in range(0, nr) ])))
+if len(wl.assets) != nr:
+    print 'FAIL: loaded %d symbols, expected %d' % (len(wl.assets), nr)
+    sys.exit(1)
+
+# Leave a few without quotes.
+for s in wl.assets[10:]:
+    Stock.set_data(s.ticker, { 'symbol'        : s.ticker,
+                               'latestPrice'   : random.uniform(1, 500),
+                               'changePercent' : random.uniform(-0.2, 0.2),
+                               'latestVolume'  : random.randint(0, 10**7) })
+
+start = time.time()
+for i in range(0, 100):
+    top = wl.top_movers(30)
+elapsed = (time.time() - start) / 100
+
+want = sorted([ s for s in wl.assets if s.cached_data() ],
+              key=lambda s: abs(s.cached_data()['changePercent']),
+              reverse=True)[0:30]
+
+print 'Top 30 of %d in %.2f ms: %s ...' % (nr, elapsed * 1000,
+                                           ' '.join([ s.ticker
+                                                      for s in top[0:5] ]))
+
+if top != want:
+    print 'FAIL: top movers do not match a full sort'
+    sys.exit(1)
+
+if wl.nr_quoted() != nr - 10:
+    print 'FAIL: expected %d quoted' % (nr - 10)
+    sys.exit(1)
+
+busiest = wl.top_movers(1, mover_key_volume)[0]
+if busiest.cached_data()['latestVolume'] != \
+   max([ s.cached_data()['latestVolume'] for s in wl.assets[10:] ]):
+    print 'FAIL: wrong most active symbol'
+    sys.exit(1)
+
+print 'Done!'